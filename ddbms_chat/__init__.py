@@ -8,7 +8,8 @@ logging.basicConfig(
 )
 
 level = logging.CRITICAL
-if os.getenv("DDBMS_CHAT_DEBUG") or os.getenv("DDBMS_CHAT_DEBUG_ONLY"):
+# DDBMS_CHAT_TRACE selects components, see ddbms_chat.tracing
+if os.getenv("DDBMS_CHAT_DEBUG") or os.getenv("DDBMS_CHAT_TRACE"):
     level = logging.DEBUG
 
 log = logging.getLogger("ddbms_chat")
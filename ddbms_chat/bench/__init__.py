@@ -0,0 +1,8 @@
+"""
+benchmarks: synthetic data (datagen), the query workload (workload) and the
+runner reporting latency percentiles, bytes shipped and plan sizes (runner)
+
+    python -m ddbms_chat.bench generate --messages 1000000 --out bench-data
+    python -m ddbms_chat.bench load --data bench-data
+    python -m ddbms_chat.bench run --site 1 --queries 500 --json results.json
+"""
@@ -0,0 +1,185 @@
+import argparse
+from pathlib import Path
+
+from ddbms_chat.bench.datagen import DataSpec, generate, write_csv
+from ddbms_chat.bench.loadgen import (
+    CHAT_MIX,
+    print_load_report,
+    run_load,
+    write_load_report,
+)
+from ddbms_chat.bench.runner import (
+    print_summary,
+    run_benchmark,
+    summarize,
+    write_results,
+)
+from ddbms_chat.bench.workload import WORKLOAD
+from ddbms_chat.phase1.app_tables import setup_tables
+from ddbms_chat.phase2.app_tables import fill_app_tables
+from ddbms_chat.phase2.ingest import ingest_csv
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.sim.cluster import NetworkModel, SimCluster
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser):
+    defaults = DataSpec()
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--groups", type=int, default=defaults.groups)
+    parser.add_argument("--messages", type=int, default=defaults.messages)
+    parser.add_argument("--skew", type=float, default=defaults.skew)
+    parser.add_argument("--max-group-size", type=int, default=defaults.max_group_size)
+    parser.add_argument("--days", type=int, default=defaults.days)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def add_sim_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--sim", type=int, metavar="N_SITES", help="run on a simulated cluster"
+    )
+    parser.add_argument(
+        "--data", type=Path, help="data for the simulated cluster, generated if missing"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=NetworkModel.latency, help="seconds, one way"
+    )
+    parser.add_argument(
+        "--bandwidth", type=float, default=NetworkModel.bandwidth, help="bytes/second"
+    )
+    parser.add_argument(
+        "--replicas", type=int, default=1, help="copies of every simulated fragment"
+    )
+
+
+def spec_from_args(args) -> DataSpec:
+    return DataSpec(
+        users=args.users,
+        groups=args.groups,
+        messages=args.messages,
+        skew=args.skew,
+        max_group_size=args.max_group_size,
+        days=args.days,
+        seed=args.seed,
+    )
+
+
+parser = argparse.ArgumentParser(prog="python -m ddbms_chat.bench")
+subparsers = parser.add_subparsers(dest="command", required=True)
+
+generate_parser = subparsers.add_parser("generate", help="write synthetic csv files")
+add_spec_arguments(generate_parser)
+generate_parser.add_argument("--out", type=Path, required=True)
+
+load_parser = subparsers.add_parser(
+    "load", help="create the fragments and load data through the fragmentation path"
+)
+add_spec_arguments(load_parser)
+load_parser.add_argument(
+    "--data", type=Path, help="directory written by generate, generated if missing"
+)
+
+run_parser = subparsers.add_parser("run", help="run the workload")
+add_spec_arguments(run_parser)
+run_parser.add_argument(
+    "--site", type=int, help="coordinator site id, only plan queries if missing"
+)
+run_parser.add_argument("--queries", type=int, default=200)
+run_parser.add_argument("--warmup", type=int, default=10)
+run_parser.add_argument("--query-seed", type=int, default=1)
+run_parser.add_argument("--json", type=Path, help="write all results to this file")
+add_sim_arguments(run_parser)
+
+loadgen_parser = subparsers.add_parser(
+    "loadgen", help="run the concurrent chat workload, reads and 2pc writes"
+)
+add_spec_arguments(loadgen_parser)
+loadgen_parser.add_argument("--site", type=int, help="coordinator site id")
+loadgen_parser.add_argument("--concurrency", type=int, default=8)
+loadgen_parser.add_argument("--duration", type=float, default=30, help="seconds")
+loadgen_parser.add_argument(
+    "--think-time", type=float, default=0.5, help="mean seconds between operations"
+)
+loadgen_parser.add_argument("--op-seed", type=int, default=1)
+loadgen_parser.add_argument("--json", type=Path, help="write the report to this file")
+add_sim_arguments(loadgen_parser)
+
+args = parser.parse_args()
+spec = spec_from_args(args)
+
+if args.command == "generate":
+    write_csv(generate(spec), args.out)
+elif args.command == "load":
+    setup_tables(
+        catalog.fragments,
+        catalog.tables,
+        catalog.columns,
+        catalog.allocation,
+        catalog.sites,
+    )
+    if args.data:
+        ingest_csv(args.data)
+    else:
+        fill_app_tables(generate(spec))
+elif args.command == "run" and args.sim:
+    network = NetworkModel(args.latency, args.bandwidth)
+    with SimCluster(args.sim, network, replicas=args.replicas) as cluster:
+        if args.data:
+            cluster.load_csv(args.data)
+        else:
+            cluster.load(generate(spec))
+        results = run_benchmark(
+            WORKLOAD,
+            spec,
+            cluster.coordinator_site,
+            args.queries,
+            args.warmup,
+            args.query_seed,
+            lambda: cluster.clock.now,
+        )
+    print_summary(summarize(results), f"Benchmark (simulated, {args.sim} sites)")
+elif args.command == "run":
+    site = catalog.sites.where(id=args.site)[0] if args.site else None
+    results = run_benchmark(
+        WORKLOAD, spec, site, args.queries, args.warmup, args.query_seed
+    )
+    print_summary(summarize(results), "Benchmark" if site else "Benchmark (plan only)")
+
+elif args.command == "loadgen" and args.sim:
+    network = NetworkModel(args.latency, args.bandwidth)
+    # concurrent users compete for the network, so it costs real time
+    with SimCluster(
+        args.sim, network, realtime=True, replicas=args.replicas
+    ) as cluster:
+        if args.data:
+            cluster.load_csv(args.data)
+        else:
+            cluster.load(generate(spec))
+        report = run_load(
+            CHAT_MIX,
+            spec,
+            cluster.coordinator_site,
+            args.concurrency,
+            args.duration,
+            args.think_time,
+            args.op_seed,
+        )
+    print_load_report(report, f"Load (simulated, {args.sim} sites)")
+elif args.command == "loadgen":
+    if args.site is None:
+        parser.error("loadgen needs --site or --sim")
+    site = catalog.sites.where(id=args.site)[0]
+    report = run_load(
+        CHAT_MIX,
+        spec,
+        site,
+        args.concurrency,
+        args.duration,
+        args.think_time,
+        args.op_seed,
+    )
+    print_load_report(report)
+
+if args.command == "run" and args.json:
+    write_results(args.json, spec, results)
+elif args.command == "loadgen" and args.json:
+    write_load_report(args.json, spec, report)
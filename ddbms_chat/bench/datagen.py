@@ -0,0 +1,177 @@
+"""
+synthetic chat data at configurable scale
+
+group sizes and user activity follow zipf distributions (a few huge groups, a
+few very active users), messages are spread over `days` days with a daily
+cycle and a growing trend. the same seed always generates the same data
+"""
+import csv
+import math
+import random
+from dataclasses import dataclass, fields
+from datetime import datetime
+from itertools import accumulate
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+from ddbms_chat.phase2.app_tables import make_model
+from ddbms_chat.phase2.syscat import catalog
+
+WORDS = (
+    "hi hello hey ok okay yes no maybe sure thanks lol what when where why how "
+    "meeting today tomorrow tonight lunch dinner coffee call later now soon "
+    "done working on it see you there good great nice cool awesome sorry"
+).split()
+
+STATUSES = ["hi", "bye", "busy", "available", "away", "at work", "sleeping"]
+
+# relative activity per hour of day, lowest at 4am and highest at 8pm
+HOURLY_WEIGHTS = [1 + math.cos((hour - 20) * math.pi / 12) for hour in range(24)]
+
+
+@dataclass
+class DataSpec:
+    users: int = 1000
+    groups: int = 200
+    messages: int = 100_000
+    # zipf exponent of group sizes and user activity
+    skew: float = 1.1
+    max_group_size: int = 200
+    days: int = 90
+    # timestamp of the last day, defaults to the sample data in app_tables
+    end: int = 1647302400
+    seed: int = 117
+
+
+class ZipfSampler:
+    """
+    draws items with probability proportional to 1 / rank ** s
+    """
+
+    def __init__(self, items: Sequence, s: float, rng: random.Random):
+        self.items = items
+        self.cum_weights = list(
+            accumulate(1 / rank**s for rank in range(1, len(items) + 1))
+        )
+        self.rng = rng
+
+    def sample(self, k: int = 1) -> List:
+        return self.rng.choices(self.items, cum_weights=self.cum_weights, k=k)
+
+
+def _models() -> Dict:
+    return {
+        table.name: make_model(table.name, catalog.columns.where(table=table.id).items)
+        for table in catalog.tables
+    }
+
+
+def _sentence(rng: random.Random) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+
+
+def _message_timestamps(spec: DataSpec, rng: random.Random) -> List[int]:
+    start = spec.end - spec.days * 86400
+    # later days are busier
+    day_weights = [1 + 2 * day / max(spec.days - 1, 1) for day in range(spec.days)]
+    days = rng.choices(range(spec.days), weights=day_weights, k=spec.messages)
+    hours = rng.choices(range(24), weights=HOURLY_WEIGHTS, k=spec.messages)
+
+    return sorted(
+        start + day * 86400 + hour * 3600 + rng.randrange(3600)
+        for day, hour in zip(days, hours)
+    )
+
+
+def generate(spec: DataSpec = DataSpec()) -> Dict[str, List]:
+    """
+    rows of every application table, in the format `fill_app_tables` expects
+    """
+    rng = random.Random(spec.seed)
+    models = _models()
+
+    start = spec.end - spec.days * 86400
+    user_ids = list(range(1, spec.users + 1))
+    group_ids = list(range(1, spec.groups + 1))
+
+    users = [
+        models["user"](
+            id=i,
+            name=f"user{i}",
+            username=f"u{i}",
+            last_seen=datetime.fromtimestamp(rng.randrange(start, spec.end)),
+            status=rng.choice(STATUSES),
+            phone=f"{9000000000 + i}",
+            email=f"u{i}@chat.example",
+        )
+        for i in user_ids
+    ]
+
+    # active users (low ids) create and join more groups
+    active_users = ZipfSampler(user_ids, spec.skew, rng)
+
+    groups = []
+    group_members = []
+    members: Dict[int, List[int]] = {}
+    for group_id, created_by in zip(group_ids, active_users.sample(spec.groups)):
+        groups.append(
+            models["group"](id=group_id, gname=f"g{group_id}", created_by=created_by)
+        )
+
+        # zipf sizes: the first groups are the largest
+        size = max(2, min(spec.users, int(spec.max_group_size / group_id**spec.skew)))
+        group_users = {created_by}
+        while len(group_users) < size:
+            group_users.update(active_users.sample(size - len(group_users)))
+        members[group_id] = sorted(group_users)
+
+        for user_id in members[group_id]:
+            group_members.append(models["group_member"](group=group_id, user=user_id))
+
+    # bigger groups get more messages
+    group_weights = list(accumulate(len(members[g]) for g in group_ids))
+    message_groups = rng.choices(group_ids, cum_weights=group_weights, k=spec.messages)
+
+    messages = [
+        models["message"](
+            id=i + 1,
+            mgroup=group_id,
+            author=rng.choice(members[group_id]),
+            content=_sentence(rng),
+            sent_at=datetime.fromtimestamp(sent_at),
+        )
+        for i, (group_id, sent_at) in enumerate(
+            zip(message_groups, _message_timestamps(spec, rng))
+        )
+    ]
+
+    return {
+        "user": users,
+        "group": groups,
+        "message": messages,
+        "group_member": group_members,
+    }
+
+
+def write_csv(table_rows: Dict[str, List], directory: Path):
+    """
+    write the rows as csv files readable by `read_app_rows_from_csv`
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+
+    for table_name, rows in table_rows.items():
+        if len(rows) == 0:
+            continue
+
+        with open(directory / f"{table_name}.csv", "w", newline="") as f:
+            names = [field.name for field in fields(rows[0])]
+            writer = csv.writer(f)
+            writer.writerow(names)
+            for row in rows:
+                values = (getattr(row, name) for name in names)
+                writer.writerow(
+                    [
+                        int(value.timestamp()) if type(value) is datetime else value
+                        for value in values
+                    ]
+                )
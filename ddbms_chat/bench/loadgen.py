@@ -0,0 +1,353 @@
+"""
+closed-loop load generator for a concurrent chat workload
+
+every virtual user runs in its own thread: it picks an operation from the mix,
+waits for it to finish, thinks for an exponentially distributed time and
+repeats. reads go through the query planner and executor, updates through
+`tx_2pc`, inserts through `tx_insert` and multi-statement writes through
+`tx_batch`, so aborted votes show up as abort rates
+"""
+import json
+import random
+import threading
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from itertools import count
+from secrets import token_hex
+from time import perf_counter, sleep
+from typing import Dict, Iterator, List, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from ddbms_chat.bench.datagen import STATUSES, WORDS, DataSpec
+from ddbms_chat.bench.runner import mean, percentile
+from ddbms_chat.bench.workload import ParamSampler, query_mix, render
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.phase2.fast_parser import parse_select_query
+from ddbms_chat.phase2.query_tree import build_query_tree
+from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
+from ddbms_chat.phase3.utils import client_requests
+from ddbms_chat.phase4.utils import tx_2pc, tx_batch, tx_insert
+
+
+@dataclass
+class LoadOp:
+    name: str
+    # "read" or "write"
+    kind: str
+    # string.Template, parameters: those of ParamSampler plus $MEMBER,
+    # $MESSAGE, $NEW_GROUP, $NEW_MESSAGE, $NOW, $STATUS and $TEXT. the
+    # statements of a write separated by ";" run as one transaction
+    sql: str
+    # relative frequency in the mix
+    weight: float = 1
+
+
+CHAT_MIX = [
+    LoadOp(
+        "open-group",
+        "read",
+        "select M.`content`, M.`sent_at` from `message` M "
+        "where M.`mgroup` = $GROUP and M.`sent_at` > '$SINCE'",
+        weight=4,
+    ),
+    LoadOp(
+        "check-unseen",
+        "read",
+        "select G.`gname`, M.`content` "
+        "from `group` G, `message` M, `group_member` GM, `user` U "
+        "where GM.`user` = $ID and U.`id` = $ID and GM.`group` = G.`id` "
+        "and M.`mgroup` = G.`id` and M.`sent_at` > U.`last_seen`",
+        weight=2,
+    ),
+    LoadOp(
+        "list-groups",
+        "read",
+        "select G.`gname` from `group` G, `group_member` GM "
+        "where GM.`user` = $ID and G.`id` = GM.`group`",
+    ),
+    LoadOp(
+        "update-last-seen",
+        "write",
+        "update `user` set `last_seen` = '$NOW' where `id` = $ID",
+        weight=3,
+    ),
+    LoadOp(
+        "send-message",
+        "write",
+        "insert into `message` (`id`, `mgroup`, `author`, `content`, `sent_at`) "
+        "values ($NEW_MESSAGE, $GROUP, $ID, '$TEXT', '$NOW')",
+        weight=2,
+    ),
+    LoadOp(
+        "edit-message",
+        "write",
+        "update `message` set `content` = '$TEXT' where `id` = $MESSAGE",
+    ),
+    LoadOp(
+        "set-status",
+        "write",
+        "update `user` set `status` = '$STATUS' where `id` = $ID",
+        weight=0.5,
+    ),
+    LoadOp(
+        "create-group",
+        "write",
+        "insert into `group` (`id`, `gname`, `created_by`) "
+        "values ($NEW_GROUP, 'g$NEW_GROUP', $ID); "
+        "insert into `group_member` (`group`, `user`) "
+        "values ($NEW_GROUP, $ID), ($NEW_GROUP, $MEMBER)",
+        weight=0.5,
+    ),
+]
+
+
+class LoadParamSampler(ParamSampler):
+    """
+    query parameters plus the values written by the write operations
+
+    new message and group ids come from `message_ids` and `group_ids`, shared
+    by all virtual users so inserts don't collide
+    """
+
+    def __init__(
+        self,
+        spec: DataSpec,
+        seed: int,
+        message_ids: Optional[Iterator[int]] = None,
+        group_ids: Optional[Iterator[int]] = None,
+    ):
+        super().__init__(spec, seed)
+        if message_ids is None:
+            message_ids = count(spec.messages + 1)
+        if group_ids is None:
+            group_ids = count(spec.groups + 1)
+        self.message_ids = message_ids
+        self.group_ids = group_ids
+
+    def sample(self) -> Dict[str, str]:
+        params = super().sample()
+        params["MESSAGE"] = str(self.rng.randint(1, self.spec.messages))
+        params["NEW_MESSAGE"] = str(next(self.message_ids))
+        params["NEW_GROUP"] = str(next(self.group_ids))
+        # another user, joining the new group with its creator
+        params["MEMBER"] = str(int(params["ID"]) % self.spec.users + 1)
+        params["NOW"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        params["STATUS"] = self.rng.choice(STATUSES)
+        params["TEXT"] = " ".join(self.rng.choices(WORDS, k=self.rng.randint(1, 12)))
+        return params
+
+
+@dataclass
+class OpResult:
+    name: str
+    kind: str
+    # seconds since the start of the run
+    start: float
+    latency: float
+    # "ok" for reads, the commit outcome for writes, "error" if it raised
+    outcome: str
+
+
+@dataclass
+class LoadReport:
+    duration: float
+    concurrency: int
+    think_time: float
+    results: List[OpResult] = field(default_factory=list)
+    # (seconds since the start, {site name: requests sent to it per second})
+    site_load: List = field(default_factory=list)
+
+
+def _run_op(op: LoadOp, sql: str, site: Site) -> str:
+    query_id = f"q{token_hex(3)}s{site.id}"
+
+    statements = [statement for statement in sql.split(";") if statement.strip()]
+    if op.kind == "write" and len(statements) > 1:
+        return tx_batch(statements, query_id)
+    if op.kind == "write" and sql.lstrip().lower().startswith("insert"):
+        return tx_insert(sql, query_id)
+    if op.kind == "write":
+        return tx_2pc(sql, query_id)
+
+    select_query = parse_select_query(sql)
+    plan = plan_execution(build_query_tree(select_query), query_id)
+    execute_plan(plan, query_id, site, select_query)
+    return "ok"
+
+
+def _requests_by_site() -> Dict[str, float]:
+    totals: Dict[str, float] = {}
+    # labels are (site, route, status)
+    for (site_name, _, _), value in client_requests.values().items():
+        totals[site_name] = totals.get(site_name, 0) + value
+    return totals
+
+
+def run_load(
+    mix: List[LoadOp],
+    spec: DataSpec,
+    site: Site,
+    concurrency: int = 8,
+    duration: float = 30,
+    think_time: float = 0.5,
+    seed: int = 1,
+    sample_interval: float = 1,
+) -> LoadReport:
+    """
+    drive `concurrency` virtual users against `site` for `duration` seconds
+
+    `think_time` is the mean pause between the operations of one user
+    """
+    report = LoadReport(duration, concurrency, think_time)
+    results_lock = threading.Lock()
+    stop = threading.Event()
+    message_ids = count(spec.messages + 1)
+    group_ids = count(spec.groups + 1)
+    start = perf_counter()
+
+    def virtual_user(user: int):
+        rng = random.Random(seed * 1000 + user)
+        params = LoadParamSampler(spec, seed * 1000 + user, message_ids, group_ids)
+
+        while not stop.is_set():
+            op = query_mix(mix, 1, rng)[0]
+            sql = render(op, params.sample())
+
+            op_start = perf_counter()
+            try:
+                outcome = _run_op(op, sql, site)
+            except Exception as e:
+                print(f"{op.name} failed: {e}")
+                outcome = "error"
+            result = OpResult(
+                op.name,
+                op.kind,
+                op_start - start,
+                perf_counter() - op_start,
+                outcome,
+            )
+            with results_lock:
+                report.results.append(result)
+
+            if think_time > 0:
+                stop.wait(rng.expovariate(1 / think_time))
+
+    def sample_site_load():
+        previous = _requests_by_site()
+        while not stop.wait(sample_interval):
+            current = _requests_by_site()
+            report.site_load.append(
+                (
+                    round(perf_counter() - start, 3),
+                    {
+                        name: (current[name] - previous.get(name, 0)) / sample_interval
+                        for name in sorted(current)
+                    },
+                )
+            )
+            previous = current
+
+    threads = [
+        threading.Thread(target=virtual_user, args=(i,), daemon=True)
+        for i in range(concurrency)
+    ]
+    threads.append(threading.Thread(target=sample_site_load, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # operations still running at the deadline finish late
+    report.duration = perf_counter() - start
+    return report
+
+
+def summarize_load(report: LoadReport) -> List[Dict]:
+    by_name: Dict[str, List[OpResult]] = {}
+    for result in report.results:
+        by_name.setdefault(result.name, []).append(result)
+    by_name["all"] = report.results
+
+    summary = []
+    for name, op_results in by_name.items():
+        latencies = [r.latency for r in op_results]
+        writes = [r for r in op_results if r.kind == "write"]
+        summary.append(
+            {
+                "op": name,
+                "count": len(op_results),
+                "ops_per_s": len(op_results) / report.duration,
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "mean_ms": mean(latencies) * 1000,
+                "abort_rate": (
+                    sum(r.outcome == "abort" for r in writes) / len(writes)
+                    if writes
+                    else None
+                ),
+                "errors": sum(r.outcome == "error" for r in op_results),
+            }
+        )
+
+    return summary
+
+
+def print_load_report(report: LoadReport, title: str = "Load"):
+    console = Console()
+
+    table = Table(
+        title=f"{title}: {report.concurrency} users, "
+        f"{report.think_time * 1000:.0f} ms think time, {report.duration:.1f} s"
+    )
+    columns = ["op", "count", "ops/s", "p50 ms", "p95 ms", "p99 ms", "mean ms"]
+    columns += ["abort rate", "errors"]
+    for column in columns:
+        table.add_column(column)
+
+    for row in summarize_load(report):
+        abort_rate = row["abort_rate"]
+        table.add_row(
+            row["op"],
+            str(row["count"]),
+            f"{row['ops_per_s']:.1f}",
+            f"{row['p50_ms']:.1f}",
+            f"{row['p95_ms']:.1f}",
+            f"{row['p99_ms']:.1f}",
+            f"{row['mean_ms']:.1f}",
+            "-" if abort_rate is None else f"{abort_rate:.1%}",
+            str(row["errors"]),
+        )
+    console.print(table)
+
+    if len(report.site_load) == 0:
+        return
+
+    site_names = sorted({name for _, load in report.site_load for name in load})
+    site_table = Table(title="Requests per second sent to each site")
+    site_table.add_column("t (s)")
+    for name in site_names:
+        site_table.add_column(name)
+    for t, load in report.site_load:
+        site_table.add_row(
+            f"{t:.0f}", *[f"{load.get(name, 0):.0f}" for name in site_names]
+        )
+    console.print(site_table)
+
+
+def write_load_report(path, spec: DataSpec, report: LoadReport):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "spec": asdict(spec),
+                "summary": summarize_load(report),
+                "report": asdict(report),
+            },
+            f,
+            indent=2,
+        )
@@ -0,0 +1,175 @@
+"""
+run a workload and report latency percentiles, bytes shipped and plan sizes
+"""
+import json
+import math
+import random
+from dataclasses import asdict, dataclass
+from secrets import token_hex
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from ddbms_chat.bench.datagen import DataSpec
+from ddbms_chat.bench.workload import BenchQuery, ParamSampler, query_mix, render
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.phase2.fast_parser import parse_select_query
+from ddbms_chat.phase2.query_tree import build_query_tree
+from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
+
+
+@dataclass
+class QueryResult:
+    name: str
+    sql: str
+    # seconds, parse + plan + execute
+    latency: float
+    plan_time: float
+    # simulated network time, part of latency (simulated clusters only)
+    network_time: float
+    steps: int
+    bytes_shipped: int
+    rows: int
+
+
+def run_query(
+    query: BenchQuery,
+    sql: str,
+    site: Optional[Site],
+    network_clock: Optional[Callable[[], float]] = None,
+) -> QueryResult:
+    """
+    run one query with `site` as coordinator, or only plan it without a site
+
+    `network_clock` returns the simulated network time spent so far
+    """
+    query_id = f"q{token_hex(3)}s{site.id if site else 0}"
+
+    network_start = network_clock() if network_clock else 0
+    start = perf_counter()
+    select_query = parse_select_query(sql)
+    plan = plan_execution(build_query_tree(select_query), query_id)
+    plan_time = perf_counter() - start
+
+    step_stats = []
+    rows = []
+    if site is not None:
+        rows = execute_plan(plan, query_id, site, select_query, step_stats)
+
+    network_time = network_clock() - network_start if network_clock else 0
+
+    return QueryResult(
+        query.name,
+        sql,
+        perf_counter() - start + network_time,
+        plan_time,
+        network_time,
+        len(plan),
+        sum(stats["bytes_shipped"] or 0 for stats in step_stats),
+        len(rows),
+    )
+
+
+def run_benchmark(
+    workload: List[BenchQuery],
+    spec: DataSpec,
+    site: Optional[Site],
+    n_queries: int = 200,
+    warmup: int = 10,
+    seed: int = 1,
+    network_clock: Optional[Callable[[], float]] = None,
+) -> List[QueryResult]:
+    """
+    run `n_queries` queries of the workload mix, after `warmup` unmeasured ones
+    """
+    rng = random.Random(seed)
+    params = ParamSampler(spec, seed)
+
+    results = []
+    for i, query in enumerate(query_mix(workload, warmup + n_queries, rng)):
+        sql = render(query, params.sample())
+        result = run_query(query, sql, site, network_clock)
+        if i >= warmup:
+            results.append(result)
+
+    return results
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    nearest rank percentile
+    """
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def mean(values: List[float]) -> float:
+    return sum(values) / len(values) if values else 0
+
+
+def summarize(results: List[QueryResult]) -> List[Dict]:
+    by_name: Dict[str, List[QueryResult]] = {}
+    for result in results:
+        by_name.setdefault(result.name, []).append(result)
+    by_name["all"] = results
+
+    summary = []
+    for name, query_results in by_name.items():
+        latencies = [r.latency for r in query_results]
+        summary.append(
+            {
+                "query": name,
+                "count": len(query_results),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": max(latencies, default=0) * 1000,
+                "plan_ms": mean([r.plan_time for r in query_results]) * 1000,
+                "network_ms": mean([r.network_time for r in query_results]) * 1000,
+                "bytes_shipped": mean([r.bytes_shipped for r in query_results]),
+                "steps": mean([r.steps for r in query_results]),
+            }
+        )
+
+    return summary
+
+
+def print_summary(summary: List[Dict], title: str = "Benchmark"):
+    table = Table(title=title)
+    columns = ["query", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"]
+    columns += ["plan ms", "network ms", "avg bytes shipped", "avg steps"]
+    for column in columns:
+        table.add_column(column)
+
+    for row in summary:
+        table.add_row(
+            row["query"],
+            str(row["count"]),
+            f"{row['p50_ms']:.1f}",
+            f"{row['p95_ms']:.1f}",
+            f"{row['p99_ms']:.1f}",
+            f"{row['max_ms']:.1f}",
+            f"{row['plan_ms']:.2f}",
+            f"{row['network_ms']:.2f}",
+            f"{row['bytes_shipped']:.0f}",
+            f"{row['steps']:.1f}",
+        )
+
+    Console().print(table)
+
+
+def write_results(path, spec: DataSpec, results: List[QueryResult]):
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "spec": asdict(spec),
+                "summary": summarize(results),
+                "results": [asdict(result) for result in results],
+            },
+            f,
+            indent=2,
+        )
@@ -0,0 +1,105 @@
+"""
+the QUERIES.md workload plus parameterized variants
+"""
+import random
+from dataclasses import dataclass
+from datetime import datetime
+from string import Template
+from typing import Dict, List
+
+from ddbms_chat.bench.datagen import DataSpec, ZipfSampler
+
+
+@dataclass
+class BenchQuery:
+    name: str
+    # string.Template, parameters: $ID (user), $GROUP, $SINCE (datetime)
+    sql: str
+    # relative frequency in the mix
+    weight: float = 1
+
+
+WORKLOAD = [
+    # QUERIES.md
+    BenchQuery(
+        "user-groups",
+        "select G.`gname` from `group` G, `group_member` GM "
+        "where GM.`user` = $ID and G.`id` = GM.`group`",
+    ),
+    BenchQuery("admin-groups", "select * from `group` where `created_by` = $ID"),
+    BenchQuery(
+        "group-messages",
+        "select U.`name`, M.`sent_at`, M.`content` from `message` M, `user` U "
+        "where M.`mgroup` = $GROUP and M.`author` = U.id",
+    ),
+    BenchQuery(
+        "unseen-messages",
+        "select G.`gname`, M.`content` "
+        "from `group` G, `message` M, `group_member` GM, `user` U "
+        "where GM.`user` = $ID and U.`id` = $ID and GM.`group` = G.`id` "
+        "and M.`mgroup` = G.`id` and M.`sent_at` > U.`last_seen`",
+    ),
+    # variants
+    BenchQuery(
+        "recent-group-messages",
+        "select M.`content`, M.`sent_at` from `message` M "
+        "where M.`mgroup` = $GROUP and M.`sent_at` > '$SINCE'",
+        weight=3,
+    ),
+    BenchQuery(
+        "user-profile",
+        "select U.`name`, U.`status`, U.`last_seen` from `user` U where U.`id` = $ID",
+        weight=3,
+    ),
+    BenchQuery(
+        "group-members",
+        "select U.`name` from `user` U, `group_member` GM "
+        "where GM.`group` = $GROUP and GM.`user` = U.`id`",
+        weight=2,
+    ),
+    BenchQuery(
+        "author-in-group",
+        "select M.`content` from `message` M "
+        "where M.`author` = $ID and M.`mgroup` = $GROUP",
+    ),
+    BenchQuery(
+        "messages-per-group",
+        "select M.`mgroup`, count(M.`id`) from `message` M group by M.`mgroup`",
+        weight=0.2,
+    ),
+]
+
+
+class ParamSampler:
+    """
+    query parameters, skewed the same way as the generated data: popular users
+    and groups are queried more often
+    """
+
+    def __init__(self, spec: DataSpec, seed: int):
+        self.rng = random.Random(seed)
+        self.spec = spec
+        self.users = ZipfSampler(range(1, spec.users + 1), spec.skew, self.rng)
+        self.groups = ZipfSampler(range(1, spec.groups + 1), spec.skew, self.rng)
+
+    def sample(self) -> Dict[str, str]:
+        # mostly the last few hours, like clients catching up
+        since = self.spec.end - int(self.rng.expovariate(1 / 6) * 3600)
+        return {
+            "ID": str(self.users.sample()[0]),
+            "GROUP": str(self.groups.sample()[0]),
+            "SINCE": datetime.fromtimestamp(since).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def render(query: BenchQuery, params: Dict[str, str]) -> str:
+    return Template(query.sql).substitute(params)
+
+
+def query_mix(
+    workload: List[BenchQuery], n: int, rng: random.Random
+) -> List[BenchQuery]:
+    """
+    `n` queries drawn from the workload according to their weights
+    """
+    return rng.choices(workload, weights=[q.weight for q in workload], k=n)
@@ -8,3 +8,31 @@ PROJECT_ROOT = Path(__file__).parent.parent
 HOSTNAME = uname().nodename.lower()
 
 RUN_OFFLINE = bool(os.getenv("RUN_OFFLINE"))
+
+# render query trees to png files (qt.png, qt-loc.png, ...) in the background
+RENDER_QUERY_TREES = bool(os.getenv("DDBMS_CHAT_RENDER"))
+
+# bulk load app tables with LOAD DATA LOCAL INFILE where the server allows it
+BULK_LOAD_LOCAL_INFILE = bool(os.getenv("DDBMS_CHAT_LOCAL_INFILE"))
+
+# seconds a 2pc participant has to answer, a prepare that times out counts as
+# a vote to abort
+TX_TIMEOUT = float(os.getenv("DDBMS_CHAT_TX_TIMEOUT", "5"))
+# presumed abort 2pc: aborts are neither forced to the coordinator's log nor
+# acknowledged
+TX_PRESUMED_ABORT = bool(os.getenv("DDBMS_CHAT_TX_PRESUMED_ABORT"))
+# reply to the client once the commit decision is durable, before the
+# participants acknowledge it
+TX_EARLY_REPLY = bool(os.getenv("DDBMS_CHAT_TX_EARLY_REPLY"))
+
+# reads see one snapshot of all sites, as of a hybrid logical clock timestamp.
+# DDBMS_CHAT_SNAPSHOT_READS=0 reads whatever each step finds
+SNAPSHOT_READS = os.getenv("DDBMS_CHAT_SNAPSHOT_READS", "1") != "0"
+
+# append-only logs of the 2pc coordinator (the REPL) and participants (the daemon)
+TX_LOG_DIR = Path(os.getenv("DDBMS_CHAT_TX_LOG_DIR", PROJECT_ROOT))
+COORDINATOR_TX_LOG_PATH = TX_LOG_DIR / "tx-coordinator.log"
+PARTICIPANT_TX_LOG_PATH = TX_LOG_DIR / "tx-participant.log"
+
+# client side metrics of the REPL, served by the daemon at /metrics/coordinator
+COORDINATOR_METRICS_PATH = PROJECT_ROOT / ".coordinator-metrics.prom"
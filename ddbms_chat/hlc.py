@@ -0,0 +1,45 @@
+"""
+hybrid logical clock of this process
+
+timestamps are milliseconds since the epoch shifted left by `LOGICAL_BITS`,
+plus a counter for events within the same millisecond. every request between
+sites carries the sender's clock in `HLC_HEADER` and every response the
+receiver's, so a timestamp taken after a message is larger than every
+timestamp taken before it was sent, at any site, while staying close to
+physical time
+"""
+from threading import Lock
+from time import time
+
+LOGICAL_BITS = 16
+
+HLC_HEADER = "X-Hlc-Timestamp"
+
+
+def _physical() -> int:
+    return int(time() * 1000) << LOGICAL_BITS
+
+
+class HybridClock:
+    def __init__(self):
+        self._last = 0
+        self._lock = Lock()
+
+    def now(self) -> int:
+        """
+        a timestamp larger than every one returned or seen before
+        """
+        with self._lock:
+            self._last = max(self._last + 1, _physical())
+            return self._last
+
+    def update(self, remote: int) -> int:
+        """
+        account for a timestamp received from another site
+        """
+        with self._lock:
+            self._last = max(self._last + 1, remote + 1, _physical())
+            return self._last
+
+
+clock = HybridClock()
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 
 @dataclass
@@ -72,3 +72,19 @@ class SelectQuery:
                 self.limit,
             )
         )
+
+
+@dataclass
+class InsertQuery:
+    table: str
+    columns: List[str]
+    # one list of values per row, in the order of `columns`
+    rows: List[List[Any]]
+
+
+@dataclass
+class UpdateQuery:
+    table: str
+    # column name -> new value, as written in the query
+    assignments: Dict[str, str]
+    where: Optional[ConditionAnd] = None
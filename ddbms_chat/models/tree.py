@@ -69,6 +69,8 @@ class RelationNode(TreeNode):
         self.name = name
         self.is_localized: bool = False
         self.site_id: int = -1
+        # a base relation with a copy on every site, read wherever it's needed
+        self.broadcast: bool = False
 
     def __str__(self) -> str:
         return f"<{self.name}{' *' if not self.is_localized else ' @ site ' + str(self.site_id)}>"
@@ -66,13 +66,19 @@ def setup_tables(
         else:
             columns = column_list.where(table=table)
 
+        # every replica of the fragment
         if type(allocation_list[0].fragment) is int:
-            site = allocation_list.where(fragment=fragment.id)[0].site
+            allocations = allocation_list.where(fragment=fragment.id)
         else:
-            site = allocation_list.where(fragment=fragment)[0].site
+            allocations = allocation_list.where(fragment=fragment)
 
-        if type(site) is int:
-            site = site_list.where(id=site)[0]
+        sites = [
+            site_list.where(id=a.site)[0] if type(a.site) is int else a.site
+            for a in allocations
+        ]
+        if table.fragment_type == "B":
+            # broadcast tables have a copy on every site
+            sites = site_list.items
 
         if table.fragment_type == "V":
             vsplit_cols: PyQL[Column] = PyQL([])
@@ -83,9 +89,10 @@ def setup_tables(
 
         sql = create_table_sql(fragment.name, columns)
 
-        try:
-            with DBConnection(site) as cursor:
-                cursor.execute(sql)
-        except Exception as e:
-            print(sql)
-            raise e
+        for site in sites:
+            try:
+                with DBConnection(site) as cursor:
+                    cursor.execute(sql)
+            except Exception as e:
+                print(sql)
+                raise e
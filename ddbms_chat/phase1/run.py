@@ -1,3 +1,5 @@
+from time import time
+
 from ddbms_chat.phase1 import db, syscat_tables, app_tables
 from ddbms_chat.syscat.sites import SITES
 from ddbms_chat.utils import DBConnection
@@ -11,10 +13,16 @@ def print_boxed(text: str):
 
 
 def setup_system_catalog():
+    version = int(time() * 1000)
     message_function_map = [
         ("Creating database", db.recreate_db, False),
         ("Creating system catalog tables", syscat_tables.setup_tables, True),
         ("Filling system catalog tables", syscat_tables.fill_tables, True),
+        (
+            "Stamping system catalog version",
+            lambda cursor: syscat_tables.write_syscat_version(cursor, version),
+            True,
+        ),
     ]
 
     for message, func, connect_db in message_function_map:
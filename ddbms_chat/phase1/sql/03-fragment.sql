@@ -1,7 +1,7 @@
 CREATE TABLE IF NOT EXISTS `L117`.`fragment` (
   `id` INT NOT NULL AUTO_INCREMENT,
   `name` VARCHAR(45) NOT NULL,
-  `logic` VARCHAR(45) NOT NULL,
+  `logic` VARCHAR(512) NOT NULL,
   `parent` INT NOT NULL,
   `table` INT NOT NULL,
   PRIMARY KEY (`id`),
@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS `L117`.`syscat_version` (
+  `id` INT NOT NULL,
+  `version` BIGINT NOT NULL,
+  PRIMARY KEY (`id`))
+ENGINE = InnoDB
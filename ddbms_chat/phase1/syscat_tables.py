@@ -43,3 +43,14 @@ def fill_tables(
                 f"insert into `{table_name.lower()}`({','.join(keys)}) values ({','.join(['%s'] * len(keys))})",
                 tuple(values),
             )
+
+
+def write_syscat_version(cursor: Cursor, version: int):
+    """
+    stamp the system catalog with a version
+
+    nodes compare this against their cached copy to decide whether to reload
+    """
+    cursor.execute(
+        "replace into `syscat_version` (`id`, `version`) values (1, %s)", (version,)
+    )
@@ -0,0 +1,638 @@
+"""
+hand written tokenizer and recursive descent parser for the supported dialect
+
+produces SelectQuery / UpdateQuery / InsertQuery directly, without going through
+sqlparse
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from ddbms_chat.models.query import (
+    Condition,
+    ConditionAnd,
+    ConditionOr,
+    InsertQuery,
+    SelectQuery,
+    UpdateQuery,
+)
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.tracing import get_tracer
+
+tracer = get_tracer("phase2.fast_parser")
+
+KEYWORDS = {
+    "AND",
+    "AS",
+    "ASC",
+    "BY",
+    "DESC",
+    "FROM",
+    "GROUP",
+    "HAVING",
+    "INNER",
+    "INSERT",
+    "INTO",
+    "JOIN",
+    "LIKE",
+    "LIMIT",
+    "ON",
+    "OR",
+    "ORDER",
+    "SELECT",
+    "SET",
+    "UPDATE",
+    "VALUES",
+    "WHERE",
+}
+
+TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+|--[^\n]*|/\*.*?\*/)
+    |(?P<quoted>`[^`]+`)
+    |(?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    |(?P<op><=|>=|<>|!=|=|<|>)
+    |(?P<sign>[+-])
+    |(?P<punct>[(),;.*])
+    |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+@dataclass
+class Token:
+    kind: str
+    value: str
+    pos: int
+
+
+def tokenize(sql: str) -> List[Token]:
+    tokens = []
+    pos = 0
+
+    while pos < len(sql):
+        match = TOKEN_RE.match(sql, pos)
+        if match is None:
+            raise ValueError(f"Unexpected character {sql[pos]!r} at position {pos}")
+
+        kind = match.lastgroup
+        value = match.group()
+        assert kind
+
+        if kind == "word":
+            if value.upper() in KEYWORDS:
+                tokens.append(Token("keyword", value.upper(), pos))
+            else:
+                tokens.append(Token("ident", value.lower(), pos))
+        elif kind == "quoted":
+            tokens.append(Token("ident", value[1:-1].lower(), pos))
+        elif kind != "ws":
+            tokens.append(Token(kind, value, pos))
+
+        pos = match.end()
+
+    tokens.append(Token("eof", "", pos))
+    return tokens
+
+
+# (function, qualifier, name) of a column reference, before alias resolution
+ColumnRef = Tuple[Optional[str], Optional[str], str]
+Operand = Union[ColumnRef, str]
+
+
+@dataclass
+class RawCondition:
+    lhs: Operand
+    op: str
+    rhs: Operand
+
+
+@dataclass
+class RawConditionList:
+    combiner: type
+    conditions: List[Union[RawCondition, "RawConditionList"]]
+
+
+@dataclass
+class RawSelect:
+    columns: Optional[List[ColumnRef]] = None
+    tables: List[Tuple[str, str]] = field(default_factory=list)
+    conditions: List[Union[RawCondition, RawConditionList]] = field(
+        default_factory=list
+    )
+    group_by: Optional[List[ColumnRef]] = None
+    having: Optional[Union[RawCondition, RawConditionList]] = None
+    limit: Optional[int] = None
+
+
+class Parser:
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.tokens = tokenize(sql)
+        self.idx = 0
+
+    # token helpers
+
+    @property
+    def current(self) -> Token:
+        return self.tokens[self.idx]
+
+    def peek(self, offset: int = 1) -> Token:
+        return self.tokens[min(self.idx + offset, len(self.tokens) - 1)]
+
+    def advance(self) -> Token:
+        token = self.current
+        self.idx += 1
+        return token
+
+    def at(self, kind: str, value: Optional[str] = None) -> bool:
+        token = self.current
+        return token.kind == kind and (value is None or token.value == value)
+
+    def accept(self, kind: str, value: Optional[str] = None) -> Optional[Token]:
+        if self.at(kind, value):
+            return self.advance()
+        return None
+
+    def expect(self, kind: str, value: Optional[str] = None) -> Token:
+        token = self.accept(kind, value)
+        if token is None:
+            raise ValueError(
+                f"Expected {value or kind} at position {self.current.pos}, "
+                f"found {self.current.value or 'end of query'!r}"
+            )
+        return token
+
+    def accept_keyword(self, *values: str) -> bool:
+        for i, value in enumerate(values):
+            if not (self.peek(i).kind == "keyword" and self.peek(i).value == value):
+                return False
+        self.idx += len(values)
+        return True
+
+    def expect_end(self):
+        self.accept("punct", ";")
+        self.expect("eof")
+
+    # grammar
+
+    def column_ref(self) -> ColumnRef:
+        name = self.expect("ident").value
+        if self.accept("punct", "."):
+            return None, name, self.expect("ident").value
+        return None, None, name
+
+    def select_item(self) -> ColumnRef:
+        if (
+            self.at("ident")
+            and self.peek().kind == "punct"
+            and self.peek().value == "("
+        ):
+            func = self.advance().value
+            self.expect("punct", "(")
+            _, qualifier, name = self.column_ref()
+            self.expect("punct", ")")
+            return func, qualifier, name
+
+        return self.column_ref()
+
+    def signed_number(self) -> str:
+        """
+        source text of a number with an optional leading sign
+        """
+        sign = self.advance().value if self.at("sign") else ""
+        return sign + self.expect("number").value
+
+    def operand(self) -> Operand:
+        if self.at("number") or self.at("sign"):
+            return self.signed_number()
+        if self.at("string"):
+            return self.advance().value
+        if self.at("ident"):
+            return self.select_item()
+
+        raise ValueError(
+            f"Expected column or value at position {self.current.pos}, "
+            f"found {self.current.value or 'end of query'!r}"
+        )
+
+    def comparison(self) -> RawCondition:
+        lhs = self.operand()
+
+        if self.at("op") or self.at("keyword", "LIKE"):
+            op = self.advance().value
+        else:
+            raise ValueError(f"Expected comparison at position {self.current.pos}")
+
+        return RawCondition(lhs, op, self.operand())
+
+    def primary(self) -> Union[RawCondition, RawConditionList]:
+        if self.accept("punct", "("):
+            condition = self.expression()
+            self.expect("punct", ")")
+            return condition
+
+        return self.comparison()
+
+    def _combine(self, combiner: type, operand_fn):
+        conditions = [operand_fn()]
+        keyword = "AND" if combiner is ConditionAnd else "OR"
+
+        while self.accept("keyword", keyword):
+            conditions.append(operand_fn())
+
+        if len(conditions) == 1:
+            return conditions[0]
+
+        # A && (B && C) -> A && B && C
+        flattened = []
+        for condition in conditions:
+            if type(condition) is RawConditionList and condition.combiner is combiner:
+                flattened += condition.conditions
+            else:
+                flattened.append(condition)
+
+        return RawConditionList(combiner, flattened)
+
+    def conjunction(self):
+        return self._combine(ConditionAnd, self.primary)
+
+    def expression(self):
+        return self._combine(ConditionOr, self.conjunction)
+
+    def table_ref(self) -> Tuple[str, str]:
+        name = self.expect("ident").value
+        self.accept("keyword", "AS")
+        alias = self.accept("ident")
+        return name, alias.value if alias else name
+
+    def select(self) -> RawSelect:
+        raw = RawSelect()
+        self.expect("keyword", "SELECT")
+
+        if self.accept("punct", "*"):
+            raw.columns = None
+        else:
+            raw.columns = [self.select_item()]
+            while self.accept("punct", ","):
+                raw.columns.append(self.select_item())
+
+        self.expect("keyword", "FROM")
+        raw.tables.append(self.table_ref())
+
+        while True:
+            if self.accept("punct", ","):
+                raw.tables.append(self.table_ref())
+            elif self.accept_keyword("JOIN") or self.accept_keyword("INNER", "JOIN"):
+                raw.tables.append(self.table_ref())
+                self.expect("keyword", "ON")
+                raw.conditions.append(self.expression())
+            else:
+                break
+
+        if self.accept("keyword", "WHERE"):
+            raw.conditions.append(self.expression())
+
+        if self.accept_keyword("GROUP", "BY"):
+            raw.group_by = [self.column_ref()]
+            while self.accept("punct", ","):
+                raw.group_by.append(self.column_ref())
+
+            if self.accept("keyword", "HAVING"):
+                raw.having = self.expression()
+
+        # order_by is not in the scope, parse and drop it
+        if self.accept_keyword("ORDER", "BY"):
+            while True:
+                self.column_ref()
+                if not self.accept("keyword", "ASC"):
+                    self.accept("keyword", "DESC")
+                if not self.accept("punct", ","):
+                    break
+
+        if self.accept("keyword", "LIMIT"):
+            token = self.expect("number")
+            try:
+                raw.limit = int(token.value)
+            except ValueError:
+                raise ValueError("LIMIT should be an integer")
+
+        self.expect_end()
+        return raw
+
+    def update(self) -> Tuple[str, Dict[str, str], Optional[RawConditionList]]:
+        self.expect("keyword", "UPDATE")
+        table = self.expect("ident").value
+        self.expect("keyword", "SET")
+
+        assignments = {}
+        while True:
+            _, _, column = self.column_ref()
+            self.expect("op", "=")
+            assignments[column] = self.value_expression()
+            if not self.accept("punct", ","):
+                break
+
+        where = self.expression() if self.accept("keyword", "WHERE") else None
+        self.expect_end()
+        return table, assignments, where
+
+    def insert(self) -> Tuple[str, Optional[List[str]], List[List[Any]]]:
+        self.expect("keyword", "INSERT")
+        self.expect("keyword", "INTO")
+        table = self.expect("ident").value
+
+        columns = None
+        if self.accept("punct", "("):
+            columns = [self.expect("ident").value]
+            while self.accept("punct", ","):
+                columns.append(self.expect("ident").value)
+            self.expect("punct", ")")
+
+        self.expect("keyword", "VALUES")
+        rows = [self.value_row()]
+        while self.accept("punct", ","):
+            rows.append(self.value_row())
+
+        self.expect_end()
+        return table, columns, rows
+
+    def value_row(self) -> List[Any]:
+        self.expect("punct", "(")
+        values = [self.literal()]
+        while self.accept("punct", ","):
+            values.append(self.literal())
+        self.expect("punct", ")")
+        return values
+
+    def literal(self) -> Any:
+        """
+        a number, string or NULL as a python value
+        """
+        if self.at("number") or self.at("sign"):
+            value = self.signed_number()
+            return float(value) if any(c in value for c in ".eE") else int(value)
+        if self.at("string"):
+            value = self.advance().value
+            quote = value[0]
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+            return value.replace(quote * 2, quote)
+        if self.accept("ident", "null"):
+            return None
+
+        raise ValueError(
+            f"Expected value at position {self.current.pos}, "
+            f"found {self.current.value or 'end of query'!r}"
+        )
+
+    def value_expression(self) -> str:
+        """
+        source text of the value in a SET clause, up to the next `,` or WHERE
+        """
+        start = self.current.pos
+        depth = 0
+
+        while not self.at("eof"):
+            token = self.current
+            if token.kind == "punct" and token.value == "(":
+                depth += 1
+            elif token.kind == "punct" and token.value == ")":
+                depth -= 1
+            elif depth == 0 and (
+                (token.kind == "punct" and token.value in ",;")
+                or (token.kind == "keyword" and token.value == "WHERE")
+            ):
+                break
+            self.advance()
+
+        value = self.sql[start : self.current.pos].strip()
+        if not value:
+            raise ValueError(f"Expected value at position {start}")
+
+        return value
+
+
+def _find_relation_for_column(column_name: str, tables: List[str]) -> str:
+    candidate_tables = []
+    for table_name in tables:
+        table = catalog.tables.where(name=table_name)[0]
+        if len(catalog.columns.where(name=column_name, table=table.id)) == 1:
+            candidate_tables.append(table_name)
+
+    if len(candidate_tables) == 1:
+        return candidate_tables[0]
+
+    if len(candidate_tables) > 1:
+        raise ValueError(
+            f"Available tables {candidate_tables} for column {column_name}"
+        )
+
+    raise ValueError(f"No table found for column {column_name}")
+
+
+def _resolve_column(column: ColumnRef, table_alias_map: Dict[str, str]) -> str:
+    func, qualifier, name = column
+
+    if qualifier is None:
+        table = _find_relation_for_column(name, list(table_alias_map.values()))
+    elif qualifier in table_alias_map:
+        table = table_alias_map[qualifier]
+    else:
+        raise ValueError(f"Unknown table {qualifier} referenced in columns")
+
+    return f"{func}({table}.{name})" if func else f"{table}.{name}"
+
+
+def _resolve_operand(operand: Operand, table_alias_map: Dict[str, str]) -> str:
+    if type(operand) is str:
+        return operand
+
+    try:
+        return _resolve_column(operand, table_alias_map)  # type: ignore
+    except ValueError:
+        # not a column, keep it as written
+        func, qualifier, name = operand  # type: ignore
+        name = f"{qualifier}.{name}" if qualifier else name
+        return f"{func}({name})" if func else name
+
+
+def _resolve_condition(
+    condition: Union[RawCondition, RawConditionList], table_alias_map: Dict[str, str]
+) -> Union[Condition, ConditionAnd, ConditionOr]:
+    if type(condition) is RawCondition:
+        return Condition(
+            _resolve_operand(condition.lhs, table_alias_map),
+            condition.op,
+            _resolve_operand(condition.rhs, table_alias_map),
+        )
+
+    assert type(condition) is RawConditionList
+    return condition.combiner(
+        [_resolve_condition(c, table_alias_map) for c in condition.conditions]
+    )
+
+
+def _as_condition_and(
+    conditions: List[Union[Condition, ConditionAnd, ConditionOr]]
+) -> Optional[ConditionAnd]:
+    flattened = []
+    for condition in conditions:
+        if type(condition) is ConditionAnd:
+            flattened += condition.conditions
+        else:
+            flattened.append(condition)
+
+    return ConditionAnd(flattened) if flattened else None
+
+
+def _build_select(raw: RawSelect) -> SelectQuery:
+    table_alias_map = {}
+    table_names = []
+
+    for name, alias in raw.tables:
+        if len(catalog.tables.where(name=name)) == 0:
+            raise ValueError(f"Unknown table {name}")
+        table_alias_map[alias] = name
+        if name not in table_names:
+            table_names.append(name)
+
+    if raw.columns is None:
+        columns = []
+        for table_name in table_names:
+            table = catalog.tables.where(name=table_name)[0]
+            columns += [
+                f"{table.name}.{c.name}" for c in catalog.columns.where(table=table.id)
+            ]
+    else:
+        columns = []
+        for column in raw.columns:
+            resolved = _resolve_column(column, table_alias_map)
+            if resolved not in columns:
+                columns.append(resolved)
+
+    where = _as_condition_and(
+        [_resolve_condition(c, table_alias_map) for c in raw.conditions]
+    )
+
+    group_by = None
+    if raw.group_by:
+        group_by = [_resolve_column(c, table_alias_map) for c in raw.group_by]
+
+    having = None
+    if raw.having is not None:
+        having = _as_condition_and([_resolve_condition(raw.having, table_alias_map)])
+
+    return SelectQuery(columns, table_names, where, group_by, having, raw.limit)
+
+
+def parse_select_query(sql: str) -> SelectQuery:
+    with tracer.span("parse", statement="select"):
+        return _build_select(Parser(sql).select())
+
+
+def parse_update_query(sql: str) -> UpdateQuery:
+    with tracer.span("parse", statement="update"):
+        table, assignments, where = Parser(sql).update()
+
+    if len(catalog.tables.where(name=table)) == 0:
+        raise ValueError(f"Unknown table {table}")
+
+    table_alias_map = {table: table}
+    where_condition = None
+    if where is not None:
+        where_condition = _as_condition_and(
+            [_resolve_condition(where, table_alias_map)]
+        )
+
+    return UpdateQuery(table, assignments, where_condition)
+
+
+def parse_insert_query(sql: str) -> InsertQuery:
+    with tracer.span("parse", statement="insert"):
+        table_name, columns, rows = Parser(sql).insert()
+
+    tables = catalog.tables.where(name=table_name)
+    if len(tables) == 0:
+        raise ValueError(f"Unknown table {table_name}")
+
+    table_columns = [c.name for c in catalog.columns.where(table=tables[0].id)]
+    if columns is None:
+        columns = table_columns
+
+    unknown = [c for c in columns if c not in table_columns]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown} in table {table_name}")
+
+    for row in rows:
+        if len(row) != len(columns):
+            raise ValueError(
+                f"Expected {len(columns)} values per row, found {len(row)}: {row}"
+            )
+
+    return InsertQuery(table_name, columns, rows)
+
+
+def parse_query(sql: str) -> Union[SelectQuery, UpdateQuery, InsertQuery]:
+    tokens = tokenize(sql)
+    match tokens[0].value:
+        case "SELECT":
+            return parse_select_query(sql)
+        case "UPDATE":
+            return parse_update_query(sql)
+        case "INSERT":
+            return parse_insert_query(sql)
+        case unk:
+            raise ValueError(f"Unsupported statement {unk or 'empty query'}")
+
+
+if __name__ == "__main__":
+    from timeit import timeit
+
+    from rich.console import Console
+    from rich.table import Table
+
+    from ddbms_chat.phase2.parser import parse_select, parse_sql
+
+    # QUERIES.md workload
+    workload = [
+        "select G.`gname` from `group` G, `group_member` GM "
+        "where GM.`user` = 1 and G.`id` = GM.`group`;",
+        "select * from `group` where `created_by` = 1;",
+        "select U.`name`, M.`sent_at`, M.`content` from `message` M, `user` U "
+        "where M.`mgroup` = 1 and M.`author` = U.id;",
+        "select G.`gname`, M.`content` "
+        "from `group` G, `message` M, `group_member` GM, `user` U "
+        "where GM.`user` = 1 and U.`id` = 1 and GM.`group` = G.`id` "
+        "and M.`mgroup` = G.`id` and M.`sent_at` > U.`last_seen`;",
+        # signed numbers and exponents
+        "select * from `group` where `created_by` = -1;",
+        "select * from `group` where `created_by` = 1.5e3;",
+        "select * from `group` where `created_by` = -1 and `id` < -1.5E-2;",
+    ]
+    n_runs = 200
+
+    table = Table(title=f"Parser benchmark ({n_runs} runs per query)")
+    for column in [
+        "query",
+        "same where",
+        "sqlparse (ms)",
+        "fast_parser (ms)",
+        "speedup",
+    ]:
+        table.add_column(column)
+
+    for i, sql in enumerate(workload):
+        same = parse_select(parse_sql(sql)).where == parse_select_query(sql).where
+        old = timeit(lambda: parse_select(parse_sql(sql)), number=n_runs) / n_runs
+        new = timeit(lambda: parse_select_query(sql), number=n_runs) / n_runs
+        table.add_row(
+            str(i + 1),
+            str(same),
+            f"{old * 1000:.3f}",
+            f"{new * 1000:.3f}",
+            f"{old / new:.1f}x",
+        )
+
+    Console().print(table)
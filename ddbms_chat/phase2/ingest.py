@@ -0,0 +1,401 @@
+"""
+streaming ingestion of app tables
+
+rows arrive in chunks (read from csv files or sliced from in-memory rows),
+are converted column by column with numpy, routed to their fragments and
+handed to one writer thread per site over a bounded queue. only a few chunks
+are in flight at a time, so memory stays flat however large the input is.
+DH tables are resolved through a parent key -> fragment map collected while
+their parent table streams by, not through the parent rows
+"""
+import csv
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from queue import Queue
+from threading import Barrier, BrokenBarrierError, Event, Thread
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ddbms_chat.config import BULK_LOAD_LOCAL_INFILE
+from ddbms_chat.models.syscat import Fragment, Site, Table
+from ddbms_chat.phase2.routing import FragmentRouter, KeyMap, get_router
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.utils import DBConnection, debug_log
+
+# rows per chunk
+CHUNK_SIZE = 50_000
+# chunks waiting per site writer
+QUEUE_SIZE = 4
+
+# column name -> values of one chunk
+Chunk = Dict[str, np.ndarray]
+
+
+def insert_rows_sql(fragment_name: str, columns: Sequence[str]) -> str:
+    """
+    parameterized insert of one row, for executemany
+    """
+    return (
+        f"insert into `{fragment_name}` ({','.join(f'`{c}`' for c in columns)}) "
+        f"values ({','.join(['%s'] * len(columns))})"
+    )
+
+
+def _infile_value(value) -> str:
+    if value is None:
+        return "\\N"
+    if type(value) is datetime:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _load_data_local_infile(cursor, fragment_name: str, columns: List[str], rows):
+    """
+    insert the rows through a temporary file in the default LOAD DATA format
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".tsv", encoding="utf-8") as f:
+        for row in rows:
+            f.write("\t".join(map(_infile_value, row)) + "\n")
+        f.flush()
+
+        cursor.execute(
+            f"load data local infile %s into table `{fragment_name}` "
+            f"character set utf8mb4 ({','.join(f'`{c}`' for c in columns)})",
+            (f.name,),
+        )
+
+
+def _local_infile_allowed(cursor) -> bool:
+    if getattr(cursor, "dialect", "mysql") != "mysql":
+        return False
+
+    cursor.execute("select @@local_infile as allowed")
+    return bool(cursor.fetchone()["allowed"])
+
+
+def local_datetime_strings(timestamps: np.ndarray) -> np.ndarray:
+    """
+    unix timestamps as local 'YYYY-MM-DD HH:MM:SS', like datetime.fromtimestamp
+    """
+    seconds = timestamps.astype(np.int64)
+    # utc offsets only change on hour boundaries, look them up once per hour
+    hours, inverse = np.unique(seconds // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(h * 3600).tm_gmtoff for h in hours.tolist()])
+    local = (seconds + offsets[inverse.reshape(-1)]).astype("datetime64[s]")
+    return np.char.replace(np.datetime_as_string(local, unit="s"), "T", " ")
+
+
+def convert_column(values: List[str], column_type: str) -> np.ndarray:
+    """
+    csv strings of one column to the column's type
+    """
+    if column_type == "str":
+        return np.array(values, dtype=object)
+    if column_type == "datetime":
+        return local_datetime_strings(np.array(values, dtype=np.float64))
+    # ints and foreign keys (typed with the referenced model), like make_model
+    return np.array(values, dtype=np.int64)
+
+
+def _replicas_of_fragment(fragment: Fragment) -> List[Site]:
+    return [
+        catalog.sites.where(id=site_id)[0] for site_id in catalog.replicas(fragment.id)
+    ]
+
+
+class SiteWriter(Thread):
+    """
+    inserts the rows queued for one site, in one transaction
+
+    writers commit together once all of them inserted their rows. if any writer
+    fails before that, the others drain their queues without inserting and roll
+    back. the commits themselves aren't atomic, a site failing to commit leaves
+    the sites that already did committed
+    """
+
+    def __init__(self, site: Site, local_infile: bool, failed: Event):
+        super().__init__(name=f"writer-{site.id}", daemon=True)
+        self.site = site
+        self.local_infile = local_infile
+        self.failed = failed
+        self.queue: Queue = Queue(QUEUE_SIZE)
+        self.error: Optional[Exception] = None
+        self.n_rows = 0
+        # shared by the writers of a load, set before the queue is closed
+        self.barrier: Optional[Barrier] = None
+
+    def put(self, fragment: Fragment, columns: List[str], rows: List[Tuple]):
+        self.queue.put((fragment, columns, rows))
+
+    def close(self):
+        self.queue.put(None)
+
+    def run(self):
+        closed = False
+        try:
+            with DBConnection(self.site, local_infile=self.local_infile) as cursor:
+                use_infile = self.local_infile and _local_infile_allowed(cursor)
+                cursor.execute("begin")
+
+                while (item := self.queue.get()) is not None:
+                    if self.failed.is_set():
+                        continue
+
+                    fragment, columns, rows = item
+                    debug_log(
+                        "inserting %s rows into %s @ site %s",
+                        len(rows),
+                        fragment.name,
+                        self.site.id,
+                    )
+                    if use_infile:
+                        _load_data_local_infile(cursor, fragment.name, columns, rows)
+                    else:
+                        sql = insert_rows_sql(fragment.name, columns)
+                        cursor.executemany(sql, rows)
+                    self.n_rows += len(rows)
+
+                closed = True
+                assert self.barrier
+                try:
+                    self.barrier.wait()
+                except BrokenBarrierError:
+                    # another writer failed
+                    self.failed.set()
+                cursor.execute("rollback" if self.failed.is_set() else "commit")
+        except Exception as e:
+            self.error = e
+            self.failed.set()
+            # unblock the producer
+            while not closed and self.queue.get() is not None:
+                pass
+            if self.barrier is not None:
+                self.barrier.abort()
+
+
+def _rows(chunk: Chunk, columns: Sequence[str], mask=None) -> List[Tuple]:
+    arrays = [chunk[c] if mask is None else chunk[c][mask] for c in columns]
+    return list(zip(*[array.tolist() for array in arrays]))
+
+
+class Ingestion:
+    """
+    routes chunks of app table rows to per site writers
+
+        ingestion = Ingestion()
+        for chunk in chunks:
+            ingestion.write_chunk(table, chunk)
+        ingestion.finish()
+
+    tables have to arrive parents first, see `table_order`
+    """
+
+    def __init__(self, local_infile: bool = BULK_LOAD_LOCAL_INFILE):
+        self.local_infile = local_infile
+        self.failed = Event()
+        self.writers: Dict[int, SiteWriter] = {}
+        # parent table name -> mapped key column, for the DH tables being loaded
+        self.parent_keys: Dict[str, str] = {}
+        # parent table name -> (key chunks, fragment index chunks)
+        self._key_chunks: Dict[str, Tuple[List, List]] = {}
+        self.key_maps: Dict[str, KeyMap] = {}
+
+    def expect_children(self, table_names: Sequence[str]):
+        """
+        collect parent keys for the DH tables among `table_names`
+        """
+        for table_name in table_names:
+            table = catalog.tables.where(name=table_name)[0]
+            if table.fragment_type == "DH":
+                router = get_router(table_name)
+                self.parent_keys[router.parent.table.name] = router.mapped_key
+                self._key_chunks.setdefault(router.parent.table.name, ([], []))
+
+    def _writer(self, site: Site) -> SiteWriter:
+        if site.id not in self.writers:
+            writer = SiteWriter(site, self.local_infile, self.failed)
+            writer.start()
+            self.writers[site.id] = writer
+        return self.writers[site.id]
+
+    def _put(self, fragment: Fragment, columns: List[str], rows: List[Tuple]):
+        if len(rows) == 0:
+            return
+        if self.failed.is_set():
+            self.finish()
+        # every replica gets the rows
+        for site in _replicas_of_fragment(fragment):
+            self._writer(site).put(fragment, columns, rows)
+
+    def _route(self, router: FragmentRouter, chunk: Chunk, n: int) -> np.ndarray:
+        table_name = router.table.name
+        if router.table.fragment_type in ("H", "CH"):
+            indexes = router.route_arrays(chunk, n)
+        else:
+            parent_name = router.parent.table.name
+            if parent_name in self._key_chunks and parent_name not in self.key_maps:
+                keys, parent_indexes = self._key_chunks.pop(parent_name)
+                self.key_maps[parent_name] = KeyMap(
+                    np.concatenate(keys), np.concatenate(parent_indexes)
+                )
+            indexes = router.route_arrays(chunk, n, self.key_maps.get(parent_name))
+
+        if table_name in self._key_chunks:
+            keys, parent_indexes = self._key_chunks[table_name]
+            keys.append(chunk[self.parent_keys[table_name]])
+            parent_indexes.append(indexes.astype(np.int32))
+
+        return indexes
+
+    def write_chunk(self, table: Table, chunk: Chunk):
+        columns = list(chunk)
+        n = len(chunk[columns[0]]) if columns else 0
+        if n == 0:
+            return
+
+        debug_log("Routing %s rows of %s", n, table.name)
+        fragments = catalog.fragments.where(table=table.id)
+
+        if table.fragment_type in ("-", "B"):
+            self._put(fragments[0], columns, _rows(chunk, columns))
+        elif table.fragment_type == "V":
+            for fragment in fragments:
+                fragment_columns = fragment.logic.split(",")
+                self._put(fragment, fragment_columns, _rows(chunk, fragment_columns))
+        elif table.fragment_type in ("H", "CH", "DH"):
+            router = get_router(table.name)
+            indexes = self._route(router, chunk, n)
+            for i, fragment in enumerate(router.fragments):
+                self._put(fragment, columns, _rows(chunk, columns, indexes == i))
+        else:
+            raise ValueError(f"Unknown fragment type {table.fragment_type}")
+
+    def finish(self) -> int:
+        """
+        wait for the writers, returns the number of rows inserted
+        """
+        barrier = Barrier(max(len(self.writers), 1))
+        for writer in self.writers.values():
+            writer.barrier = barrier
+            writer.close()
+        for writer in self.writers.values():
+            writer.join()
+
+        writers, self.writers = list(self.writers.values()), {}
+        errors = [w.error for w in writers if w.error is not None]
+        if errors:
+            raise errors[0]
+
+        return sum(w.n_rows for w in writers)
+
+
+def table_order(table_names: Sequence[str]) -> List[Table]:
+    """
+    tables of `table_names` with the parents of DH tables first
+    """
+    ordered: List[Table] = []
+
+    def visit(table_name: str):
+        table = catalog.tables.where(name=table_name)[0]
+        if table in ordered:
+            return
+        if table.fragment_type == "DH":
+            parent_name = get_router(table_name).parent.table.name
+            if parent_name in table_names:
+                visit(parent_name)
+        ordered.append(table)
+
+    for table_name in table_names:
+        tables = catalog.tables.where(name=table_name)
+        if len(tables) != 1:
+            raise ValueError(f"Table {table_name} not present in system catalog")
+        visit(table_name)
+
+    return ordered
+
+
+def read_csv_chunks(
+    path: Path, table: Table, chunk_size: int = CHUNK_SIZE
+) -> Iterator[Chunk]:
+    """
+    chunks of a csv file with a header row, converted to the column types
+    """
+    column_types = {c.name: c.type for c in catalog.columns.where(table=table.id)}
+
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        unknown = set(header) - set(column_types)
+        if unknown:
+            raise ValueError(f"Unknown columns {sorted(unknown)} in {path}")
+
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if len(rows) == 0:
+                break
+
+            yield {
+                name: convert_column(list(values), column_types[name])
+                for name, values in zip(header, zip(*rows))
+            }
+
+
+def ingest_csv(
+    csv_root: Path,
+    chunk_size: int = CHUNK_SIZE,
+    local_infile: bool = BULK_LOAD_LOCAL_INFILE,
+) -> int:
+    """
+    stream `<table>.csv` of every app table in `csv_root` into the fragments,
+    returns the number of rows inserted
+    """
+    table_names = [
+        table.name
+        for table in catalog.tables
+        if (csv_root / f"{table.name}.csv").exists()
+    ]
+
+    ingestion = Ingestion(local_infile)
+    ingestion.expect_children(table_names)
+    for table in table_order(table_names):
+        for chunk in read_csv_chunks(csv_root / f"{table.name}.csv", table, chunk_size):
+            ingestion.write_chunk(table, chunk)
+
+    return ingestion.finish()
+
+
+def ingest_rows(
+    table_rows: Dict[str, List],
+    chunk_size: int = CHUNK_SIZE,
+    local_infile: bool = BULK_LOAD_LOCAL_INFILE,
+) -> int:
+    """
+    insert in-memory rows (model instances per table name) into the fragments
+    """
+    ingestion = Ingestion(local_infile)
+    ingestion.expect_children(list(table_rows))
+    for table in table_order(list(table_rows)):
+        rows = table_rows[table.name]
+        if len(rows) == 0:
+            continue
+
+        columns = list(vars(rows[0]))
+        for start in range(0, len(rows), chunk_size):
+            chunk_rows = rows[start : start + chunk_size]
+            chunk = {}
+            for column in columns:
+                values = [getattr(row, column) for row in chunk_rows]
+                chunk[column] = np.empty(len(values), dtype=object)
+                chunk[column][:] = values
+                # numeric columns as numbers, for the fragment predicates
+                if all(type(value) is int for value in values):
+                    chunk[column] = chunk[column].astype(np.int64)
+            ingestion.write_chunk(table, chunk)
+
+    return ingestion.finish()
@@ -14,17 +14,9 @@ from sqlparse.sql import (
 from sqlparse.tokens import Punctuation
 
 from ddbms_chat.models.query import Condition, ConditionAnd, ConditionOr, SelectQuery
-from ddbms_chat.phase2.syscat import read_syscat
+from ddbms_chat.phase2.syscat import catalog
 from ddbms_chat.utils import debug_log
 
-(
-    syscat_allocation,
-    syscat_columns,
-    syscat_fragments,
-    syscat_sites,
-    syscat_tables,
-) = read_syscat()
-
 
 def extract_names_from_func_col(func_col: str):
     """
@@ -85,13 +77,13 @@ def _fill_table_from_syscat(column_names: List[str]) -> List[str]:
             )
             continue
 
-        possible_cols = syscat_columns.where(name=column_name.strip("`"))
+        possible_cols = catalog.columns.where(name=column_name.strip("`"))
         if len(possible_cols) != 1:
             raise ValueError(f"Couldn't identify the relation for column {column_name}")
 
         resolved_column_names.append(
             add_function_to_column(
-                column_func, syscat_tables.where(id=possible_cols[0].id)[0].name
+                column_func, catalog.tables.where(id=possible_cols[0].id)[0].name
             )
         )
 
@@ -101,8 +93,8 @@ def _fill_table_from_syscat(column_names: List[str]) -> List[str]:
 def _find_relation_for_column(column_name: str, tables: List[str]):
     candidate_tables = []
     for table in tables:
-        s_table = syscat_tables.where(name=table)[0]
-        if len(syscat_columns.where(name=column_name, table=s_table.id)) == 1:
+        s_table = catalog.tables.where(name=table)[0]
+        if len(catalog.columns.where(name=column_name, table=s_table.id)) == 1:
             candidate_tables.append(table)
 
     if len(candidate_tables) == 1:
@@ -395,10 +387,10 @@ def parse_select(sql: Statement) -> SelectQuery:
 
     if columns == ["*"]:
         for table in tables:
-            s_table = syscat_tables.where(name=table.value.strip("`"))[0]
+            s_table = catalog.tables.where(name=table.value.strip("`"))[0]
             columns = [
                 f"{s_table.name}.{c.name}"
-                for c in syscat_columns.where(table=s_table.id)
+                for c in catalog.columns.where(table=s_table.id)
             ]
 
     table_alias_map, table_names, column_names = _resolve_column_aliases(
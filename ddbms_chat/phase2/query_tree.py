@@ -1,6 +1,6 @@
 import re
 from collections import defaultdict
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Set, Union
 
 import networkx as nx
 
@@ -13,25 +13,18 @@ from ddbms_chat.models.tree import (
     SelectionNode,
     UnionNode,
 )
-from ddbms_chat.phase2.parser import (
-    extract_names_from_func_col,
-    parse_select,
-    parse_sql,
-)
-from ddbms_chat.phase2.syscat import read_syscat
-from ddbms_chat.phase2.utils import to_pydot
+from ddbms_chat.phase2.fast_parser import parse_select_query
+from ddbms_chat.phase2.parser import extract_names_from_func_col
+from ddbms_chat.phase2.replicas import choose_replica
+from ddbms_chat.phase2.routing import candidate_fragments, get_router
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.phase2.utils import render_query_tree
+from ddbms_chat.tracing import get_tracer
 from ddbms_chat.utils import PyQL, debug_log
 
-# from z3 import And, Or, Solver, sat, simplify
-
+tracer = get_tracer("phase2.query_tree")
 
-(
-    syscat_allocation,
-    syscat_columns,
-    syscat_fragments,
-    syscat_sites,
-    syscat_tables,
-) = read_syscat()
+# from z3 import And, Or, Solver, sat, simplify
 
 
 def _find_columns_used_by_condition(
@@ -225,11 +218,14 @@ def construct_z3_from_condition(
 
 
 def get_relevant_fragments_for_relation(
-    fragments: PyQL, fragment_type: str, columns_used_in_query: Dict
+    fragments: PyQL,
+    fragment_type: str,
+    columns_used_in_query: Dict,
+    condition: Union[Condition, ConditionAnd, ConditionOr, None] = None,
 ) -> List:
     relation_name = re.sub(r"_\d+$", "", fragments[0].name)
-    table: Table = syscat_tables.where(name=relation_name)[0]
-    pkey: Column = syscat_columns.where(table=table.id, pk=1)[0]
+    table: Table = catalog.tables.where(name=relation_name)[0]
+    pkey: Column = catalog.columns.where(table=table.id, pk=1)[0]
 
     relevant_fragments = []
 
@@ -249,13 +245,17 @@ def get_relevant_fragments_for_relation(
             if len(column_list) > 1:
                 relevant_fragments.append(fragment)
 
-    if fragment_type == "H":
-        # TODO: make optimization
-        return fragments.items
+    if fragment_type in ("H", "CH", "DH"):
+        # rows pinned to some fragments by equalities in the relation's selection
+        fragment_ids = None
+        if condition is not None:
+            fragment_ids = candidate_fragments(get_router(relation_name), condition)
+        if fragment_ids is None:
+            return fragments.items
 
-    if fragment_type == "DH":
-        # TODO: make optimization
-        return fragments.items
+        debug_log("Pruned %s to fragments %s", relation_name, fragment_ids)
+        # a condition no row satisfies still reads one fragment
+        return [f for f in fragments if f.id in fragment_ids] or fragments.items[:1]
 
     return relevant_fragments
 
@@ -272,8 +272,10 @@ def optimize_and_localize_query_tree(qt: nx.DiGraph, node_map: Dict):
             relation_attached_selects[relation_node.name] = parent_node
 
     # localize query tree
-    qt = localize_query_tree(qt, relations, columns_used_in_query)
-    to_pydot(qt).write_png("qt-loc.png")
+    qt = localize_query_tree(
+        qt, relations, columns_used_in_query, relation_attached_selects
+    )
+    render_query_tree(qt, "qt-loc.png")
 
     relation_nodes = []
 
@@ -292,12 +294,12 @@ def optimize_and_localize_query_tree(qt: nx.DiGraph, node_map: Dict):
 
         debug_log("%s", "----" * 15)
         debug_log("Trying to find relation %s", relation_name)
-        table: Table = syscat_tables.where(name=relation_name)[0]
+        table: Table = catalog.tables.where(name=relation_name)[0]
         debug_log("Trying to find fragment %s", fragment_name)
-        fragment: Fragment = syscat_fragments.where(table=table.id, name=fragment_name)[
-            0
-        ]
-        pkey: Column = syscat_columns.where(table=table.id, pk=1)[0]
+        fragment: Fragment = catalog.fragments.where(
+            table=table.id, name=fragment_name
+        )[0]
+        pkey: Column = catalog.columns.where(table=table.id, pk=1)[0]
 
         if table.fragment_type == "V":
             fragment_cols = set(map(lambda x: x.lower(), fragment.logic.split(",")))
@@ -312,7 +314,7 @@ def optimize_and_localize_query_tree(qt: nx.DiGraph, node_map: Dict):
             debug_log("Final list: %s", column_list)
         else:
             fragment_cols = set(
-                [col.name for col in syscat_columns.where(table=table.id)]
+                [col.name for col in catalog.columns.where(table=table.id)]
             )
             column_list = list(columns_used_in_query[relation_name])
 
@@ -358,8 +360,8 @@ def optimize_and_localize_query_tree(qt: nx.DiGraph, node_map: Dict):
             fragment_name = relation_node.name
             relation_name = re.sub(r"_\d+$", "", fragment_name)
 
-            table: Table = syscat_tables.where(name=relation_name)[0]
-            fragment: Fragment = syscat_fragments.where(
+            table: Table = catalog.tables.where(name=relation_name)[0]
+            fragment: Fragment = catalog.fragments.where(
                 table=table.id, name=fragment_name
             )[0]
 
@@ -418,26 +420,47 @@ def optimize_and_localize_query_tree(qt: nx.DiGraph, node_map: Dict):
 
 
 def localize_query_tree(
-    qt: nx.DiGraph, nodes: List[RelationNode], columns_used_in_query: Dict
+    qt: nx.DiGraph,
+    nodes: List[RelationNode],
+    columns_used_in_query: Dict,
+    relation_attached_selects: Optional[Dict[str, SelectionNode]] = None,
 ):
     """
-    localize all relations
+    localize all relations, reading every fragment from one of its replicas
+
+    horizontal fragments that hold no rows satisfying the selection directly
+    above their relation (`relation_attached_selects`) are left out
     """
+    relation_attached_selects = relation_attached_selects or {}
+    # sites the query reads from so far
+    chosen_sites: Set[int] = set()
+
+    def site_of(fragment: Fragment) -> int:
+        site_id = choose_replica(fragment, chosen_sites)
+        chosen_sites.add(site_id)
+        return site_id
+
     for relation_node in nodes:
-        tables = syscat_tables.where(name=relation_node.name)
+        tables = catalog.tables.where(name=relation_node.name)
 
         assert len(tables) == 1, f"Table {relation_node.name} not found"
         table: Table = tables[0]
 
-        pkey: Column = syscat_columns.where(table=table.id, pk=1)[0]
+        pkey: Column = catalog.columns.where(table=table.id, pk=1)[0]
 
         if table.fragment_type == "-":
-            fragment = syscat_fragments.where(table=table.id)[0]
+            fragment = catalog.fragments.where(table=table.id)[0]
+            new_relation_root = RelationNode(relation_node.name)
+            new_relation_root.is_localized = True
+            new_relation_root.site_id = site_of(fragment)
+            qt.add_node(new_relation_root, shape="rectangle", style="filled")
+        elif table.fragment_type == "B":
+            # any copy will do, it doesn't pull the other fragments to its site
+            fragment = catalog.fragments.where(table=table.id)[0]
             new_relation_root = RelationNode(relation_node.name)
             new_relation_root.is_localized = True
-            new_relation_root.site_id = syscat_allocation.where(fragment=fragment.id)[
-                0
-            ].site
+            new_relation_root.broadcast = True
+            new_relation_root.site_id = choose_replica(fragment, chosen_sites)
             qt.add_node(new_relation_root, shape="rectangle", style="filled")
         else:
             get_node = (
@@ -446,20 +469,32 @@ def localize_query_tree(
                 else UnionNode()
             )
 
-            fragments = syscat_fragments.where(table=table.id)
+            fragments = catalog.fragments.where(table=table.id)
 
             new_relation_root = get_node(
                 f"{fragments[0].name}.{pkey.name}", f"{fragments[1].name}.{pkey.name}"
             )
 
+            select = relation_attached_selects.get(relation_node.name)
             relevant_fragments = get_relevant_fragments_for_relation(
-                fragments, table.fragment_type, columns_used_in_query
+                fragments,
+                table.fragment_type,
+                columns_used_in_query,
+                select.condition if select is not None else None,
             )
 
+            if len(relevant_fragments) == 1 and table.fragment_type != "V":
+                # a union of one fragment is the fragment
+                new_relation_root = RelationNode(relevant_fragments[0].name)
+                new_relation_root.is_localized = True
+                new_relation_root.site_id = site_of(relevant_fragments[0])
+                qt.add_node(new_relation_root, shape="rectangle", style="filled")
+                relevant_fragments = []
+
             for fragment in relevant_fragments[:2]:
                 rel_node = RelationNode(fragment.name)
                 rel_node.is_localized = True
-                rel_node.site_id = syscat_allocation.where(fragment=fragment.id)[0].site
+                rel_node.site_id = site_of(fragment)
                 qt.add_node(rel_node, shape="rectangle", style="filled")
 
                 qt.add_edge(new_relation_root, rel_node)
@@ -467,7 +502,7 @@ def localize_query_tree(
             for fragment in relevant_fragments[2:]:
                 rel_node = RelationNode(fragment.name)
                 rel_node.is_localized = True
-                rel_node.site_id = syscat_allocation.where(fragment=fragment.id)[0].site
+                rel_node.site_id = site_of(fragment)
                 qt.add_node(rel_node, shape="rectangle", style="filled")
 
                 new_join_node = get_node(
@@ -486,11 +521,13 @@ def localize_query_tree(
 
 
 def build_query_tree(select_query: SelectQuery) -> nx.DiGraph:
-    qt, node_map = build_naive_query_tree(select_query)
-    to_pydot(qt).write_png("qt.png")
+    with tracer.span("build_naive_query_tree"):
+        qt, node_map = build_naive_query_tree(select_query)
+    render_query_tree(qt, "qt.png")
 
-    qt = optimize_and_localize_query_tree(qt, node_map)
-    to_pydot(qt).write_png("qt-opt.png")
+    with tracer.span("optimize_and_localize_query_tree"):
+        qt = optimize_and_localize_query_tree(qt, node_map)
+    render_query_tree(qt, "qt-opt.png")
 
     return qt
 
@@ -515,7 +552,6 @@ if __name__ == "__main__":
     # test_query = "select min(mgroup) from message"
     # test_query = "select sum(id) from message group by mgroup"
 
-    parsed_query = parse_sql(test_query)
-    select_query = parse_select(parsed_query)
+    select_query = parse_select_query(test_query)
 
     build_query_tree(select_query)
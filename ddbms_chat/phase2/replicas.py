@@ -0,0 +1,83 @@
+"""
+which replica of a fragment a read uses
+
+writes go to every replica of a fragment, a read needs one. the localizer
+picks it per query: a site the query already reads other fragments from saves
+shipping them, then the site with the fewest requests in flight from this
+process, then the local site. sites with equal scores take turns, so
+sequential queries spread over the replicas too
+
+broadcast tables have a copy on every site, so reading them from the local
+site is free. the execution planner moves them next to whatever they are
+joined with anyway
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+from typing import Dict, Optional, Set
+
+from ddbms_chat.config import HOSTNAME
+from ddbms_chat.models.syscat import Fragment
+from ddbms_chat.phase2.syscat import catalog
+
+# site id -> requests sent to it that haven't been answered yet
+in_flight: Dict[int, int] = defaultdict(int)
+_in_flight_lock = Lock()
+
+# rotates the order of replicas that are equally good
+_turns = count()
+
+
+@contextmanager
+def track_request(site_id: Optional[int]):
+    """
+    count a request to `site_id` as in flight while the block runs
+    """
+    if site_id is None:
+        yield
+        return
+
+    with _in_flight_lock:
+        in_flight[site_id] += 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            in_flight[site_id] -= 1
+
+
+def _local_site_id() -> Optional[int]:
+    sites = catalog.sites.where(name=HOSTNAME)
+    return sites[0].id if len(sites) > 0 else None
+
+
+def is_broadcast(fragment: Fragment) -> bool:
+    """
+    whether the fragment belongs to a table with a copy on every site
+    """
+    return catalog.tables.where(id=fragment.table)[0].fragment_type == "B"
+
+
+def choose_replica(fragment: Fragment, chosen_sites: Set[int]) -> int:
+    """
+    site the query reads `fragment` from, given the sites it reads from already
+    """
+    replicas = catalog.replicas(fragment.id)
+    if len(replicas) == 1:
+        return replicas[0]
+
+    local_site_id = _local_site_id()
+    if is_broadcast(fragment) and local_site_id in replicas:
+        return local_site_id
+
+    turn = next(_turns)
+    return min(
+        replicas,
+        key=lambda site_id: (
+            site_id not in chosen_sites,
+            in_flight[site_id],
+            site_id != local_site_id,
+            (replicas.index(site_id) + turn) % len(replicas),
+        ),
+    )
@@ -0,0 +1,540 @@
+"""
+route rows of horizontally (H), hash (CH) and derived horizontally (DH)
+fragmented tables to their fragments
+
+fragment predicates such as `id%4==0` are parsed once and compiled into
+functions of the columns they use. a predicate evaluates either one row or a
+whole batch of numpy column arrays, so the loaders route a batch in one pass
+per fragment and the write path routes single rows with the same code
+
+hash fragmented tables spread the hash of one column over a fixed number of
+slots, and every fragment owns some of them: `id#256:0-63,128` holds the rows
+whose `id` hashes to slots 0 to 63 or 128 of 256. a new fragment takes an even
+share of the slots from the others, so only the rows of those slots move
+"""
+import ast
+import math
+import re
+import zlib
+from decimal import Decimal
+from threading import Lock
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+from ddbms_chat.models.query import Condition, ConditionAnd, ConditionOr
+from ddbms_chat.models.syscat import Fragment, Table
+from ddbms_chat.phase2.syscat import catalog
+
+# the subset of python fragment predicates are written in
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.USub,
+    ast.UAdd,
+    ast.BinOp,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+)
+
+
+class _Vectorize(ast.NodeTransformer):
+    """
+    rewrite boolean operators into their elementwise numpy equivalents
+    """
+
+    def visit_BoolOp(self, node: ast.BoolOp):
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        expr = node.values[0]
+        for value in node.values[1:]:
+            expr = ast.BinOp(expr, op, value)
+        return expr
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(ast.Invert(), node.operand)
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+
+        # a < b < c -> (a < b) & (b < c)
+        left = node.left
+        expr = None
+        for op, right in zip(node.ops, node.comparators):
+            comparison = ast.Compare(left, [op], [right])
+            if expr is None:
+                expr = comparison
+            else:
+                expr = ast.BinOp(expr, ast.BitAnd(), comparison)
+            left = right
+        return expr
+
+
+def _compile_function(body: ast.expr, args: List[str], logic: str):
+    function = ast.Expression(
+        ast.Lambda(
+            ast.arguments(
+                posonlyargs=[],
+                args=[ast.arg(arg) for arg in args],
+                kwonlyargs=[],
+                kw_defaults=[],
+                defaults=[],
+            ),
+            body,
+        )
+    )
+    ast.fix_missing_locations(function)
+    return eval(compile(function, f"<predicate {logic}>", "eval"), {"__builtins__": {}})
+
+
+class Predicate:
+    """
+    a compiled fragment predicate
+    """
+
+    def __init__(self, logic: str):
+        try:
+            tree = ast.parse(logic.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid fragment predicate {logic!r}") from e
+
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(
+                    f"Unsupported {type(node).__name__} in fragment predicate {logic!r}"
+                )
+
+        self.logic = logic
+        self.columns = sorted(
+            {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+        )
+        self._row_function = _compile_function(tree.body, self.columns, logic)
+        vectorized = _Vectorize().visit(ast.parse(logic.strip(), mode="eval"))
+        self._array_function = _compile_function(vectorized.body, self.columns, logic)
+
+    def __repr__(self) -> str:
+        return f"Predicate({self.logic!r})"
+
+    def __call__(self, values: Mapping) -> bool:
+        return bool(self._row_function(*[values[c] for c in self.columns]))
+
+    def evaluate_arrays(self, columns: Mapping[str, np.ndarray], n: int) -> np.ndarray:
+        """
+        boolean mask of the `n` rows given as column arrays
+        """
+        result = self._array_function(*[columns[c] for c in self.columns])
+        # predicates without columns evaluate to a scalar
+        return np.broadcast_to(np.asarray(result, dtype=bool), (n,))
+
+
+class KeyMap:
+    """
+    parent key -> parent fragment index, for routing DH rows in batches
+    """
+
+    def __init__(self, keys: np.ndarray, fragment_indexes: np.ndarray):
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.fragment_indexes = fragment_indexes[order]
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (fragment index of every key, mask of the keys that were found)
+        """
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        return self.fragment_indexes[positions], found
+
+
+MASK64 = (1 << 64) - 1
+# slots of the hash fragmented tables this project creates, the most fragments
+# they can be split into
+HASH_SLOTS = 256
+# `<column>#<number of slots>:<slot ranges>`
+HASH_LOGIC_RE = re.compile(r"^\s*(\w+)\s*#\s*(\d+)\s*:\s*([\d\s,-]*)$")
+
+
+def _normalize_key(value) -> Union[int, str]:
+    """
+    what a key hashes as: numbers, and strings holding one, as the integer they
+    equal if there is one, anything else as its string. so `id = '5'` and
+    `id = 5.0` find the rows inserted with `id = 5`
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        for convert in (int, float):
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+
+    if isinstance(value, (bool, np.bool_)):
+        return str(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating, Decimal)):
+        if math.isfinite(value) and value == int(value):
+            return int(value)
+        # the shortest repr, like mysql prints it
+        return str(float(value))
+    return str(value)
+
+
+def hash_key(value) -> int:
+    """
+    64 bit hash of a key, the finalizer of splitmix64 on integers and on the
+    crc32 of anything else. it is stable across processes, unlike `hash`
+    """
+    key = _normalize_key(value)
+    if isinstance(key, int):
+        x = key & MASK64
+    else:
+        x = zlib.crc32(key.encode())
+
+    x ^= x >> 30
+    x = (x * 0xBF58476D1CE4E5B9) & MASK64
+    x ^= x >> 27
+    x = (x * 0x94D049BB133111EB) & MASK64
+    x ^= x >> 31
+    return x
+
+
+def hash_keys(keys: np.ndarray) -> np.ndarray:
+    """
+    `hash_key` of every key, vectorized for integer arrays and float arrays
+    holding integers
+    """
+    keys = np.asarray(keys)
+    if keys.dtype.kind == "f" and len(keys) > 0:
+        finite = np.isfinite(keys).all()
+        if finite and (keys == np.trunc(keys)).all() and (abs(keys) < 2**63).all():
+            keys = keys.astype(np.int64)
+    if keys.dtype.kind not in "iu":
+        return np.array([hash_key(k) for k in keys.tolist()], dtype=np.uint64)
+
+    # negative keys wrap around like in `hash_key`
+    x = keys.astype(np.int64).view(np.uint64)
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def format_slots(slots: Sequence[int]) -> str:
+    """
+    slot ranges of a hash fragment's logic, e.g. `0-63,128`
+    """
+    ranges = []
+    for slot in sorted(slots):
+        if ranges and ranges[-1][1] == slot - 1:
+            ranges[-1][1] = slot
+        else:
+            ranges.append([slot, slot])
+
+    return ",".join(f"{a}" if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+class HashSlots:
+    """
+    the logic of a hash fragment: the column hashed, the number of slots of
+    the table and the slots the fragment owns
+    """
+
+    def __init__(self, logic: str):
+        match = HASH_LOGIC_RE.match(logic)
+        if match is None:
+            raise ValueError(f"Invalid hash fragment logic {logic!r}")
+
+        self.logic = logic
+        self.column = match.group(1)
+        self.n_slots = int(match.group(2))
+        self.slots: List[int] = []
+        for part in match.group(3).split(","):
+            if part.strip() == "":
+                continue
+            first, _, last = part.partition("-")
+            self.slots += range(int(first), int(last or first) + 1)
+
+        if any(slot >= self.n_slots for slot in self.slots):
+            raise ValueError(f"Slot out of range in hash fragment logic {logic!r}")
+
+    def __repr__(self) -> str:
+        return f"HashSlots({self.logic!r})"
+
+
+def split_slots(
+    fragment_slots: Sequence[Sequence[int]], n_slots: int
+) -> Tuple[List[List[int]], List[int]]:
+    """
+    slots of the fragments after adding one more, and the slots of the new one
+
+    the new fragment takes `n_slots / (fragments + 1)` slots, one at a time
+    from whichever fragment owns the most, taking the highest slot so the
+    ranges stay short. the rows of the other slots stay where they are
+    """
+    remaining = [sorted(slots) for slots in fragment_slots]
+    taken: List[int] = []
+    for _ in range(n_slots // (len(remaining) + 1)):
+        donor = max(remaining, key=len)
+        if len(donor) <= 1:
+            break
+        taken.append(donor.pop())
+
+    return remaining, sorted(taken)
+
+
+class FragmentRouter:
+    """
+    routes rows of one H, CH or DH table to the table's fragments
+
+    `fragments` is ordered like the catalog, the batch methods return indexes
+    into it
+    """
+
+    def __init__(self, table: Table):
+        self.table = table
+        self.fragments: List[Fragment] = catalog.fragments.where(table=table.id).items
+
+        if table.fragment_type == "H":
+            self.predicates = [Predicate(f.logic) for f in self.fragments]
+            self.columns = sorted({c for p in self.predicates for c in p.columns})
+        elif table.fragment_type == "CH":
+            slots = [HashSlots(f.logic) for f in self.fragments]
+            if len({(s.column, s.n_slots) for s in slots}) != 1:
+                raise ValueError(
+                    f"Fragments of {table.name} hash different columns or slots"
+                )
+            self.columns = [slots[0].column]
+            self.n_slots = slots[0].n_slots
+
+            # slot -> fragment index
+            self.slot_owner = np.full(self.n_slots, -1, dtype=np.intp)
+            for i, s in enumerate(slots):
+                if (self.slot_owner[s.slots] != -1).any():
+                    raise ValueError(f"Fragments of {table.name} share slots")
+                self.slot_owner[s.slots] = i
+            if (self.slot_owner == -1).any():
+                unowned = np.flatnonzero(self.slot_owner == -1).tolist()
+                raise ValueError(
+                    f"Slots {format_slots(unowned)} of {table.name} have no fragment"
+                )
+        elif table.fragment_type == "DH":
+            # all fragments of a DH table derive from fragments of the same parent
+            self.orig_key, self.mapped_key = self.fragments[0].logic.split("|", 1)[:2]
+            parent_fragment = catalog.fragments.where(id=self.fragments[0].parent)[0]
+            parent_table = catalog.tables.where(id=parent_fragment.table)[0]
+            self.parent = FragmentRouter(parent_table)
+            self.columns = [self.orig_key]
+
+            # parent fragment index -> fragment index
+            fragment_index = {f.parent: i for i, f in enumerate(self.fragments)}
+            self.parent_to_fragment = np.array(
+                [fragment_index[f.id] for f in self.parent.fragments], dtype=np.intp
+            )
+        else:
+            raise ValueError(
+                f"Table {table.name} with fragment type {table.fragment_type} "
+                "isn't horizontally fragmented"
+            )
+
+    def route(
+        self, values: Mapping, parent_values: Optional[Mapping] = None
+    ) -> Fragment:
+        """
+        fragment of one row
+
+        DH rows are routed by evaluating the parent's predicates on the row's
+        key, `parent_values` is only needed when those use other parent columns
+        """
+        if self.table.fragment_type == "H":
+            for fragment, predicate in zip(self.fragments, self.predicates):
+                if predicate(values):
+                    return fragment
+
+            raise ValueError(
+                f"Row {dict(values)} didn't satisfy any fragment predicate"
+            )
+
+        if self.table.fragment_type == "CH":
+            slot = hash_key(values[self.columns[0]]) % self.n_slots
+            return self.fragments[self.slot_owner[slot]]
+
+        if parent_values is None:
+            if any(c != self.mapped_key for c in self.parent.columns):
+                raise ValueError(
+                    f"Routing {self.table.name} needs the parent row, its fragments "
+                    f"depend on {self.parent.columns}"
+                )
+            parent_values = {self.mapped_key: values[self.orig_key]}
+
+        parent_fragment = self.parent.route(parent_values)
+        return next(f for f in self.fragments if f.parent == parent_fragment.id)
+
+    def route_arrays(
+        self,
+        columns: Mapping[str, np.ndarray],
+        n: int,
+        key_map: Optional[KeyMap] = None,
+    ) -> np.ndarray:
+        """
+        fragment index of each of the `n` rows given as column arrays
+
+        DH rows are looked up in `key_map` if given, which also checks that
+        every parent exists
+        """
+        if self.table.fragment_type == "H":
+            if len(self.fragments) == 0 or n == 0:
+                return np.zeros(n, dtype=np.intp)
+
+            masks = np.stack([p.evaluate_arrays(columns, n) for p in self.predicates])
+            matched = masks.any(axis=0)
+            if not matched.all():
+                row = int(np.argmin(matched))
+                values = {c: columns[c][row] for c in self.columns}
+                raise ValueError(f"Row {values} didn't satisfy any fragment predicate")
+
+            # the first matching fragment, like `route`
+            return masks.argmax(axis=0)
+
+        if self.table.fragment_type == "CH":
+            slots = hash_keys(columns[self.columns[0]]) % np.uint64(self.n_slots)
+            return self.slot_owner[slots.astype(np.intp)]
+
+        keys = columns[self.orig_key]
+        if key_map is None:
+            parent_indexes = self.parent.route_arrays({self.mapped_key: keys}, n)
+        else:
+            parent_indexes, found = key_map.lookup(keys)
+            if not found.all():
+                raise ValueError(
+                    "Foreign key constraint broken, couldn't find row with "
+                    f"{self.mapped_key}={keys[np.argmin(found)]} "
+                    f"in {self.parent.table.name}"
+                )
+
+        return self.parent_to_fragment[parent_indexes]
+
+
+_routers: Dict[str, FragmentRouter] = {}
+# catalog relations the cached routers were built from
+_routers_relations = None
+_routers_lock = Lock()
+
+
+def get_router(table_name: str) -> FragmentRouter:
+    """
+    router of a table, rebuilt when the catalog is reloaded
+    """
+    global _routers_relations
+
+    if len(catalog.tables.where(name=table_name)) == 0:
+        # created since the catalog was loaded
+        catalog.refresh(force=True)
+
+    with _routers_lock:
+        if _routers_relations is not catalog.relations:
+            _routers.clear()
+            _routers_relations = catalog.relations
+
+        if table_name not in _routers:
+            tables = catalog.tables.where(name=table_name)
+            if len(tables) == 0:
+                raise ValueError(f"Table {table_name} not present in system catalog")
+            _routers[table_name] = FragmentRouter(tables[0])
+
+        return _routers[table_name]
+
+
+def literal_value(text: str):
+    """
+    python value of a literal in a condition, None if it isn't one
+    """
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"":
+        return text[1:-1].replace(text[0] * 2, text[0])
+
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+
+    return None
+
+
+def candidate_fragments(
+    router: FragmentRouter, condition: Union[Condition, ConditionAnd, ConditionOr]
+) -> Optional[Set[int]]:
+    """
+    ids of the fragments holding the rows that can satisfy `condition`, None if
+    they can't be narrowed down
+
+    rows are pinned to a fragment by equalities between the columns the
+    fragment predicates use and literals, combined with and/or
+    """
+    if type(condition) is ConditionOr:
+        fragment_ids: Set[int] = set()
+        for c in condition.conditions:
+            candidates = candidate_fragments(router, c)
+            if candidates is None:
+                return None
+            fragment_ids |= candidates
+        return fragment_ids
+
+    conditions = [condition] if type(condition) is Condition else condition.conditions
+
+    values = {}
+    for c in conditions:
+        if type(c) is not Condition or c.op != "=":
+            continue
+        for column, literal in ((c.lhs, c.rhs), (c.rhs, c.lhs)):
+            value = literal_value(literal)
+            if "." in column and literal_value(column) is None and value is not None:
+                values[column.split(".", 1)[1]] = value
+
+    result = None
+    if all(column in values for column in router.columns):
+        try:
+            result = {router.route(values).id}
+        except (ValueError, TypeError):
+            # e.g. a DH table whose parent's predicates use other columns, or a
+            # quoted literal compared with a number by a predicate
+            pass
+
+    # nested or-conditions narrow it down further
+    for c in conditions:
+        if type(c) is Condition:
+            continue
+        candidates = candidate_fragments(router, c)
+        if candidates is not None:
+            result = candidates if result is None else result & candidates
+
+    return result
@@ -1,9 +1,13 @@
 import csv
+import os
+import pickle
 from dataclasses import fields
 from datetime import datetime
-from typing import Optional, Tuple
+from threading import RLock
+from time import monotonic, time
+from typing import List, Optional, Tuple
 
-from ddbms_chat.config import PROJECT_ROOT, RUN_OFFLINE
+from ddbms_chat.config import HOSTNAME, PROJECT_ROOT, RUN_OFFLINE
 from ddbms_chat.models.syscat import Allocation, Column, Fragment, Site, Table
 from ddbms_chat.phase1 import db, syscat_tables
 from ddbms_chat.syscat.allocation import ALLOCATION
@@ -14,6 +18,13 @@ from ddbms_chat.syscat.tables import TABLES
 from ddbms_chat.utils import DBConnection, PyQL, debug_log
 
 CSV_ROOT = PROJECT_ROOT / "ddbms_chat/phase2/syscat"
+SNAPSHOT_PATH = PROJECT_ROOT / ".syscat-snapshot.pickle"
+# seconds a loaded catalog is trusted before its version is checked again
+REFRESH_INTERVAL = float(os.getenv("DDBMS_CHAT_SYSCAT_REFRESH", "5"))
+
+SysCatRelations = Tuple[
+    PyQL[Allocation], PyQL[Column], PyQL[Fragment], PyQL[Site], PyQL[Table]
+]
 
 
 def convert_objects_to_ids(obj):
@@ -28,7 +39,7 @@ def convert_objects_to_ids(obj):
 
 def read_syscat(
     site: Optional[Site] = None,
-) -> Tuple[PyQL[Allocation], PyQL[Column], PyQL[Fragment], PyQL[Site], PyQL[Table]]:
+) -> SysCatRelations:
     if RUN_OFFLINE:
         debug_log("Running in offline mode")
         return (
@@ -60,6 +71,218 @@ def read_syscat(
     return tuple(ret)
 
 
+def read_syscat_version(site: Optional[Site] = None) -> Optional[int]:
+    if RUN_OFFLINE:
+        return None
+
+    if site is None:
+        site = SITES[0]
+
+    with DBConnection(site) as cursor:
+        cursor.execute("select `version` from `syscat_version` where `id` = 1")
+        row = cursor.fetchone()
+
+    return None if row is None else row["version"]
+
+
+class SystemCatalog:
+    """
+    process wide system catalog
+
+    the catalog is loaded lazily on first access, either from the local snapshot
+    if its version is still current or from the database. `refresh` compares the cached version with the one
+    stored in the database and reloads if some node bumped it
+    """
+
+    def __init__(self, snapshot_path=SNAPSHOT_PATH, refresh_interval=REFRESH_INTERVAL):
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.version: Optional[int] = None
+
+        self._relations: Optional[SysCatRelations] = None
+        self._checked_at = 0.0
+        self._lock = RLock()
+        # relations given to `install`, never reloaded
+        self._installed = False
+
+    @property
+    def site(self) -> Site:
+        """
+        site to read the catalog from; the local one if this node is part of it
+        """
+        sites = SITES.where(name=HOSTNAME)
+        return sites[0] if len(sites) > 0 else SITES[0]
+
+    @property
+    def relations(self) -> SysCatRelations:
+        if self._relations is None:
+            with self._lock:
+                if self._relations is None:
+                    self._load()
+
+        assert self._relations
+        return self._relations
+
+    @property
+    def allocation(self) -> PyQL[Allocation]:
+        return self.relations[0]
+
+    def replicas(self, fragment_id: int) -> List[int]:
+        """
+        ids of the sites storing a copy of the fragment
+
+        fragments of broadcast tables (fragment type B) are stored on every site
+        and need no allocation
+        """
+        fragment = self.fragments.where(id=fragment_id)[0]
+        if self.tables.where(id=fragment.table)[0].fragment_type == "B":
+            return [site.id for site in self.sites]
+
+        return [
+            allocation.site
+            for allocation in self.allocation.where(fragment=fragment_id)
+        ]
+
+    @property
+    def columns(self) -> PyQL[Column]:
+        return self.relations[1]
+
+    @property
+    def fragments(self) -> PyQL[Fragment]:
+        return self.relations[2]
+
+    @property
+    def sites(self) -> PyQL[Site]:
+        return self.relations[3]
+
+    @property
+    def tables(self) -> PyQL[Table]:
+        return self.relations[4]
+
+    @property
+    def installed(self) -> bool:
+        """
+        whether the catalog was given to `install` rather than stored on the sites
+        """
+        return self._installed
+
+    def install(self, relations: SysCatRelations):
+        """
+        use `relations` instead of the stored catalog until `reset`, for
+        simulated clusters
+        """
+        with self._lock:
+            self._relations = relations
+            self.version = 0
+            self._installed = True
+
+    def reset(self):
+        """
+        forget the loaded catalog, the next access loads it again
+        """
+        with self._lock:
+            self._relations = None
+            self.version = None
+            self._installed = False
+
+    def _load(self):
+        start = time()
+
+        if not RUN_OFFLINE and self._load_snapshot():
+            source = "snapshot"
+        else:
+            self._load_live()
+            source = "offline literals" if RUN_OFFLINE else f"site {self.site.id}"
+
+        debug_log(
+            "Loaded system catalog v%s from %s in %.2fms",
+            self.version,
+            source,
+            (time() - start) * 1000,
+        )
+
+    def _load_live(self, version: Optional[int] = None):
+        if version is None:
+            version = read_syscat_version(self.site)
+
+        self._relations = read_syscat(self.site)
+        self.version = version
+        self._checked_at = monotonic()
+
+        if not RUN_OFFLINE:
+            self._write_snapshot()
+
+    def _load_snapshot(self) -> bool:
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                version, relations = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return False
+
+        # a snapshot from before a migration or ddl would route wrong until
+        # the next refresh, it's only used while it's current
+        if version != read_syscat_version(self.site):
+            return False
+
+        self._relations = relations
+        self.version = version
+        self._checked_at = monotonic()
+        return True
+
+    def _write_snapshot(self):
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump((self.version, self._relations), f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            debug_log("Couldn't write catalog snapshot: %s", e)
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        reload the catalog if its version changed
+
+        the version is only checked once every `refresh_interval` seconds unless
+        `force` is set, which callers that miss a table, fragment or site in the
+        catalog do. returns True if the catalog was reloaded
+        """
+        if RUN_OFFLINE or self._installed:
+            return False
+
+        if not force and monotonic() - self._checked_at < self.refresh_interval:
+            return False
+
+        with self._lock:
+            version = read_syscat_version(self.site)
+            self._checked_at = monotonic()
+
+            if self._relations is not None and version == self.version:
+                return False
+
+            debug_log("Catalog version changed %s -> %s", self.version, version)
+            self._load_live(version)
+
+        return True
+
+    def bump_version(self):
+        """
+        mark the catalog as changed on all sites so that every node reloads it
+        """
+        if self._installed:
+            self.version = (self.version or 0) + 1
+            return
+
+        version = int(time() * 1000)
+        for site in self.sites:
+            with DBConnection(site) as cursor:
+                syscat_tables.write_syscat_version(cursor, version)
+
+        self.refresh(force=True)
+
+
+catalog = SystemCatalog()
+
+
 def read_syscat_rows_from_csv():
     syscat_name_cls = {
         "allocation": Allocation,
@@ -109,9 +332,11 @@ if __name__ == "__main__":
         table_map["column"],
     ]
 
+    version = int(time() * 1000)
     for site in table_map["site"]:
         with DBConnection(site, connect_db=False) as cursor:
             db.recreate_db(cursor)
         with DBConnection(site) as cursor:
             syscat_tables.setup_tables(cursor)
             syscat_tables.fill_tables(cursor, tables)
+            syscat_tables.write_syscat_version(cursor, version)
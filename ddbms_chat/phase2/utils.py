@@ -1,5 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import networkx as nx
 
+from ddbms_chat.config import RENDER_QUERY_TREES
+
+# graphviz is slow, render on a separate thread so that queries don't wait on it
+_render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
 
 # modified version of nx.nx_pydot.to_pydot
 def to_pydot(N):
@@ -64,3 +71,23 @@ def to_pydot(N):
             )
             P.add_edge(edge)
     return P
+
+
+def _write_png(qt: nx.DiGraph, filename: str):
+    try:
+        to_pydot(qt).write_png(filename)
+    except Exception as e:
+        print(f"Couldn't render {filename}: {e}")
+
+
+def render_query_tree(qt: nx.DiGraph, filename: str, force: bool = False):
+    """
+    render query tree to a png file, off the query path
+
+    does nothing unless DDBMS_CHAT_RENDER is set or `force` is passed
+    """
+    if not (RENDER_QUERY_TREES or force):
+        return
+
+    # the planner keeps mutating the tree, render a copy of its current state
+    _render_executor.submit(_write_png, qt.copy(), filename)
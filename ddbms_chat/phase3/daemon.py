@@ -1,23 +1,53 @@
+import re
 import subprocess
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
 from functools import wraps
 from http import HTTPStatus
-from typing import List
+from threading import Condition, Thread
+from time import perf_counter, sleep, time
+from typing import Dict, List, Optional, Tuple
 
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, request
 
-from ddbms_chat.config import DB_NAME, HOSTNAME
-from ddbms_chat.phase2.syscat import read_syscat
+from ddbms_chat.config import COORDINATOR_METRICS_PATH, DB_NAME, HOSTNAME, TX_TIMEOUT
+from ddbms_chat.hlc import HLC_HEADER, clock
+from ddbms_chat.metrics import Counter, Gauge, Histogram, render, route_of
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.phase2.syscat import catalog
 from ddbms_chat.phase3.utils import (
     _process_column_name,
     condition_dict_to_object,
     construct_select_condition_string,
     send_request_to_site,
 )
-from ddbms_chat.utils import DBConnection, debug_log
+from ddbms_chat.phase4.snapshot import ReadSnapshot
+from ddbms_chat.phase4.txlog import (
+    TxRecord,
+    coordinator_log,
+    decision_of,
+    participant_log,
+)
+from ddbms_chat.phase4.xa import (
+    LocalTransaction,
+    finish_recovered,
+    prepared_transactions,
+)
+from ddbms_chat.sim import sqlite
+from ddbms_chat.tracing import continue_trace, drain, get_tracer
+from ddbms_chat.utils import (
+    SQLITE_SITES,
+    DBConnection,
+    debug_log,
+    list_columns,
+    list_relations,
+    relation_sizes,
+)
 
 app = Flask(__name__)
-_, _, _, syscat_sites, _ = read_syscat()
-sites = syscat_sites.where(name=HOSTNAME)
+tracer = get_tracer("phase3.daemon")
+sites = catalog.sites.where(name=HOSTNAME)
 
 # debugging
 if len(sites) == 0:
@@ -27,6 +57,30 @@ else:
     DEBUG = False
     CURRENT_SITE = sites[0]
 
+# site a request is served for when this process serves all sites of a
+# simulated cluster (ddbms_chat.sim)
+served_site_var: ContextVar[Optional[Site]] = ContextVar("served_site", default=None)
+
+
+def served_site() -> Optional[Site]:
+    """
+    site this request is served for, None if the daemon isn't on a node
+    """
+    site = served_site_var.get()
+    if site is None and not DEBUG:
+        return CURRENT_SITE
+    return site
+
+
+def current_site() -> Site:
+    site = served_site()
+    if site is None:
+        abort(
+            HTTPStatus.INTERNAL_SERVER_ERROR,
+            description="Daemon isn't running on a node of the system catalog",
+        )
+    return site
+
 
 def authenticate_request(f):
     @wraps(f)
@@ -35,7 +89,7 @@ def authenticate_request(f):
             return f(*args, **kwargs)
 
         auth_header = request.headers.get("Authorization")
-        if auth_header != CURRENT_SITE.password:
+        if auth_header != current_site().password:
             abort(HTTPStatus.UNAUTHORIZED, description="Wrong credentials provided")
 
         return f(*args, **kwargs)
@@ -43,10 +97,383 @@ def authenticate_request(f):
     return _authenticate_request
 
 
-RUNNING_READ_QUERY = False
-RUNNING_WRITE_QUERY = False
+def traced_request(f):
+    @wraps(f)
+    def _traced_request(*args, **kwargs):
+        with continue_trace(request.headers):
+            if not tracer.enabled:
+                return f(*args, **kwargs)
+
+            site = served_site()
+            with tracer.span(f.__name__, site=site and site.id, **kwargs):
+                return f(*args, **kwargs)
+
+    return _traced_request
+
+
+@dataclass
+class FragmentCapture:
+    """
+    writes committed to a fragment while it is copied to another site
+    """
+
+    migration_id: str
+    # statements (sql and rows) committed since the snapshot the copy reads,
+    # in commit order
+    changes: List[Dict] = field(default_factory=list)
+    # writes to the fragment vote abort, it is about to move
+    frozen: bool = False
+    # a commit with unknown statements was installed, e.g. one recovered after a
+    # restart, the changes can't be replayed
+    incomplete: bool = False
+
+
+@dataclass
+class ParticipantState:
+    running_read_query: bool = False
+    running_write_query: bool = False
+    # txid of the transaction holding running_write_query
+    write_lock_holder: Optional[str] = None
+    # concurrent prepares must not both take the write lock. snapshots wait on
+    # it for the decisions of prepared transactions
+    lock: Condition = field(default_factory=Condition, repr=False)
+    # txid -> transaction prepared at this site, waiting for the decision
+    transactions: Dict[str, LocalTransaction] = field(default_factory=dict)
+    # timestamp of the latest commit installed at this site, commits before a
+    # restart are older than its clock
+    last_commit_ts: int = field(default_factory=clock.now)
+    # query id -> snapshot its steps read base fragments from
+    snapshots: Dict[str, ReadSnapshot] = field(default_factory=dict)
+    # transactions aborted before their prepare arrived, e.g. because it timed
+    # out at the coordinator. their late prepare has to vote abort. ordered, the
+    # oldest are forgotten
+    early_aborts: Dict[str, None] = field(default_factory=dict)
+    # fragment -> writes committed to it during its migration
+    migrations: Dict[str, FragmentCapture] = field(default_factory=dict)
+
+
+# site id -> state, one per site served by this process
+participant_states: Dict[Optional[int], ParticipantState] = defaultdict(
+    ParticipantState
+)
+
+
+def participant_state() -> ParticipantState:
+    site = served_site()
+    return participant_states[site and site.id]
+
+
+def _take_write_lock(state: ParticipantState, txid: str) -> bool:
+    """
+    take the write lock of the site for `txid`, reentrant for its holder so a
+    transaction can prepare several statements at one site
+    """
+    with state.lock:
+        if state.write_lock_holder == txid:
+            return True
+
+        # in the middle of another query
+        if state.running_read_query or state.running_write_query:
+            return False
+
+        state.running_write_query = True
+        state.write_lock_holder = txid
+        return True
+
+
+def _release_write_lock(state: ParticipantState, txid: str):
+    with state.lock:
+        # decisions of transactions that were refused the lock don't release it
+        if state.write_lock_holder == txid:
+            state.running_write_query = False
+            state.write_lock_holder = None
+            state.lock.notify_all()
+
+
+# early aborts a site remembers
+EARLY_ABORTS_KEPT = 1024
+
+# seconds after which a snapshot is closed even if its query never cleaned up,
+# e.g. because its coordinator crashed
+SNAPSHOT_MAX_AGE = 3600
+
+# statement writing to a relation, the only kind prepare accepts
+WRITE_STATEMENT_RE = re.compile(
+    r"^\s*(?:update|insert\s+into|delete\s+from)\s+`?(?P<relation>[^`\s(]+)`?",
+    re.IGNORECASE,
+)
+
+
+# intermediate relations are prefixed with a query id
+QUERY_RELATION_RE = re.compile(r"^q[0-9a-f]{6}s\d+")
+# query and transaction ids end with the site they were started from
+COORDINATOR_SITE_RE = re.compile(r"^q[0-9a-f]+s(\d+)")
+
+
+def _count_intermediate_tables():
+    site = served_site()
+    if site is None:
+        return {}
+
+    with DBConnection(site) as cursor:
+        relations = list_relations(cursor)
+
+    return {(): sum(1 for r in relations if QUERY_RELATION_RE.match(r))}
+
+
+def _lock_holders():
+    holder = participant_state().write_lock_holder
+    return {(holder,): 1} if holder else {}
+
+
+request_seconds = Histogram(
+    "ddbms_chat_request_duration_seconds",
+    "time spent serving requests, by route (/exec/<action> per action)",
+    ["route"],
+)
+requests_served = Counter(
+    "ddbms_chat_requests_total", "requests served by status code", ["route", "status"]
+)
+requests_in_flight = Gauge(
+    "ddbms_chat_requests_in_flight", "requests being served right now"
+)
+fetch_bytes_sent = Counter(
+    "ddbms_chat_fetch_bytes_sent_total", "bytes of table dumps served by /fetch"
+)
+fetch_bytes_received = Counter(
+    "ddbms_chat_fetch_bytes_received_total",
+    "bytes of table dumps fetched from other sites",
+    ["site"],
+)
+votes = Counter("ddbms_chat_2pc_votes_total", "2pc votes sent", ["vote"])
+decisions = Counter(
+    "ddbms_chat_2pc_decisions_total", "2pc global decisions applied", ["decision"]
+)
+fragment_accesses = Counter(
+    "ddbms_chat_fragment_accesses_total",
+    "reads and committed writes of base fragments, by site and access (reads, writes)",
+    ["site", "relation", "access"],
+)
+snapshots_opened = Counter(
+    "ddbms_chat_snapshots_total",
+    "snapshots requested by reads, by outcome (opened, too-old, timeout)",
+    ["outcome"],
+)
+intermediate_tables = Gauge(
+    "ddbms_chat_intermediate_tables",
+    "intermediate relations currently stored at this site",
+    callback=_count_intermediate_tables,
+)
+lock_holders = Gauge(
+    "ddbms_chat_lock_holder",
+    "transaction holding the write lock of this site",
+    ["txid"],
+    callback=_lock_holders,
+)
+
+
+def _log_tx(
+    txid: str, record_type: str, reason: Optional[str] = None, force: bool = False
+):
+    site = served_site()
+    participant_log.write(
+        TxRecord(txid, record_type, site=site and site.id, reason=reason), force
+    )
 
-tx_log_file = open("tx-participant.log", "w+")
+
+def _written_relation(statement: Dict) -> Optional[str]:
+    match = WRITE_STATEMENT_RE.match(statement["sql"])
+    return match and match["relation"]
+
+
+def _count_read(relation_name: str):
+    site = served_site()
+    if site is not None and QUERY_RELATION_RE.match(relation_name) is None:
+        fragment_accesses.inc(site=site.id, relation=relation_name, access="reads")
+
+
+def _record_commit(state: ParticipantState, statements: Optional[List[Dict]]):
+    """
+    count the writes of a commit and capture them for the fragments being
+    migrated, with the lock of `state` held. `statements` is None if they are
+    unknown
+    """
+    if statements is None:
+        for capture in state.migrations.values():
+            capture.incomplete = True
+        return
+
+    site = served_site()
+    for statement in statements:
+        relation = _written_relation(statement)
+        if site is not None and relation is not None:
+            fragment_accesses.inc(site=site.id, relation=relation, access="writes")
+        if relation in state.migrations:
+            state.migrations[relation].changes.append(
+                {"sql": statement["sql"], "args": statement.get("args")}
+            )
+
+
+def _writes_moving_fragment(
+    state: ParticipantState, statements: List[Dict], txid: str
+) -> bool:
+    """
+    whether the statements write a frozen fragment, transactions of the
+    migration itself (`<migration id>-<n>`) still can
+    """
+    with state.lock:
+        return any(
+            capture.frozen
+            and not txid.startswith(f"{capture.migration_id}-")
+            and any(_written_relation(s) == relation for s in statements)
+            for relation, capture in state.migrations.items()
+        )
+
+
+# relation names a step reads
+INPUT_RELATION_KEYS = ("relation_name", "relation1_name", "relation2_name")
+
+
+def _query_snapshot(relation_name: str) -> Optional[ReadSnapshot]:
+    """
+    snapshot of the query an intermediate relation belongs to, if it has one
+    """
+    query_id = QUERY_RELATION_RE.match(relation_name)
+    if query_id is None:
+        return None
+
+    state = participant_state()
+    with state.lock:
+        return state.snapshots.get(query_id[0])
+
+
+def _copy_from_snapshot(
+    snapshot: ReadSnapshot, cursor, select_query: str, target_relation_name: str
+):
+    """
+    create `target_relation_name` from a select of base fragments, with the
+    rows it returns in `snapshot`
+    """
+    # commits installed after the snapshot opened have later timestamps. if
+    # there are none and nothing is prepared, the fragments are still as of
+    # the snapshot and the database can copy the rows itself
+    state = participant_state()
+    with state.lock:
+        last_commit_ts = state.last_commit_ts
+        unchanged = last_commit_ts <= snapshot.ts and len(state.transactions) == 0
+    if unchanged:
+        cursor.execute(f"create table `{target_relation_name}` as {select_query}")
+        with state.lock:
+            unchanged = state.last_commit_ts == last_commit_ts
+        if unchanged:
+            return
+        cursor.execute(f"drop table `{target_relation_name}`")
+
+    # the columns from an empty result, the snapshot can't create tables
+    cursor.execute(f"create table `{target_relation_name}` as {select_query} limit 0")
+    rows = snapshot.select(select_query)
+    if len(rows) == 0:
+        return
+
+    placeholders = ",".join(["%s"] * len(rows[0]))
+    cursor.executemany(
+        f"insert into `{target_relation_name}` values ({placeholders})",
+        [tuple(row.values()) for row in rows],
+    )
+
+
+def _snapshot_copy(snapshot: ReadSnapshot, query_id: str, relation_name: str) -> str:
+    """
+    name of an intermediate relation holding base fragment `relation_name` as
+    of `snapshot`, copied once per query
+    """
+    copy_name = f"{query_id}_snapshot-{relation_name}"
+    with DBConnection(current_site()) as cursor:
+        if copy_name not in list_relations(cursor):
+            _copy_from_snapshot(
+                snapshot, cursor, f"select * from `{relation_name}`", copy_name
+            )
+    return copy_name
+
+
+def _snapshot_inputs(
+    snapshot: ReadSnapshot, payload: Dict
+) -> Tuple[Dict, Optional[ReadSnapshot]]:
+    """
+    the payload of a step of a query reading `snapshot`, and the snapshot if
+    the step reads base fragments only
+
+    intermediate relations are newer than the snapshot and can't be read in
+    it, a step mixing them with base fragments reads copies of the fragments
+    """
+    inputs = [payload[key] for key in INPUT_RELATION_KEYS if key in payload]
+    base = [name for name in inputs if QUERY_RELATION_RE.match(name) is None]
+    if len(base) == 0:
+        return payload, None
+    if len(base) == len(inputs):
+        return payload, snapshot
+
+    query_id = QUERY_RELATION_RE.match(payload["target_relation_name"])[0]
+    payload = dict(payload)
+    for key in INPUT_RELATION_KEYS:
+        if payload.get(key) in base:
+            payload[key] = _snapshot_copy(snapshot, query_id, payload[key])
+    return payload, None
+
+
+def _create_relation(
+    cursor,
+    target_relation_name: str,
+    select_query: str,
+    snapshot: Optional[ReadSnapshot],
+):
+    if snapshot is None:
+        query = f"create table `{target_relation_name}` as {select_query}"
+        debug_log(query)
+        with tracer.span("sql", query=query):
+            cursor.execute(query)
+        return
+
+    with tracer.span("sql", query=select_query, snapshot=snapshot.ts):
+        _copy_from_snapshot(snapshot, cursor, select_query, target_relation_name)
+
+
+@app.before_request
+def start_request_metrics():
+    # not in g, requests between simulated sites nest and share the app context
+    request.environ["ddbms_chat.start"] = perf_counter()
+    requests_in_flight.inc()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = route_of(request.path)
+    start = request.environ["ddbms_chat.start"]
+    request_seconds.observe(perf_counter() - start, route=route)
+    requests_served.inc(route=route, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exc):
+    requests_in_flight.dec()
+
+
+@app.before_request
+def refresh_catalog():
+    catalog.refresh()
+
+
+@app.before_request
+def receive_clock():
+    if HLC_HEADER in request.headers:
+        clock.update(int(request.headers[HLC_HEADER]))
+
+
+@app.after_request
+def send_clock(response):
+    response.headers[HLC_HEADER] = str(clock.now())
+    return response
 
 
 @app.get("/ping")
@@ -56,12 +483,25 @@ def healthcheck():
 
 @authenticate_request
 @app.post("/exec/<action>")
+@traced_request
 def exec_query(action: str):
     payload = request.json
 
     if payload is None:
         abort(HTTPStatus.BAD_REQUEST)
 
+    bytes_shipped = 0
+
+    # base fragments are read from the snapshot of the query, if it has one
+    snapshot = None
+    if action != "fetch":
+        for key in INPUT_RELATION_KEYS:
+            if key in payload:
+                _count_read(payload[key])
+        snapshot = _query_snapshot(payload.get("target_relation_name", ""))
+    if snapshot is not None:
+        payload, snapshot = _snapshot_inputs(snapshot, payload)
+
     match action:
         case "fetch":
             relation_name, site_id, target_relation_name = (
@@ -69,36 +509,49 @@ def exec_query(action: str):
                 payload["site_id"],
                 payload["target_relation_name"],
             )
-            r = send_request_to_site(site_id, "get", f"/fetch/{relation_name}")
+            # the other site reads its base fragment from the query's snapshot
+            query_id = QUERY_RELATION_RE.match(target_relation_name)
+            r = send_request_to_site(
+                site_id,
+                "get",
+                f"/fetch/{relation_name}",
+                params={"query_id": query_id[0]} if query_id else None,
+            )
             if not r.ok:
                 abort(
                     HTTPStatus.INTERNAL_SERVER_ERROR,
                     description=f"Couldn't fetch rows for {relation_name} from site {site_id}",
                 )
             sql = r.json()["table_sql"]
+            bytes_shipped = len(sql)
+            fetch_bytes_received.inc(bytes_shipped, site=site_id)
 
-            processed_sql = []
-            for line in sql.split("\n"):
-                if line.startswith("DROP TABLE IF EXISTS `"):
-                    processed_sql.append(
-                        f"DROP TABLE IF EXISTS `{target_relation_name}`;"
-                    )
-                elif line.startswith("CREATE TABLE `"):
-                    processed_sql.append(f"CREATE TABLE `{target_relation_name}` (")
-                elif line.startswith("LOCK TABLES `"):
-                    processed_sql.append(f"LOCK TABLES `{target_relation_name}` WRITE;")
-                elif line.startswith("INSERT INTO `"):
-                    processed_sql.append(
-                        f"INSERT INTO `{target_relation_name}` "
-                        + line.split("`", 2)[-1]
-                    )
-                elif line.startswith(") ENGINE=InnoDB"):
-                    processed_sql.append(") ENGINE=InnoDB;")
-                elif line.strip():
-                    processed_sql.append(line.strip())
+            with tracer.span("rewrite", bytes=bytes_shipped):
+                processed_sql = []
+                for line in sql.split("\n"):
+                    if line.startswith("DROP TABLE IF EXISTS `"):
+                        processed_sql.append(
+                            f"DROP TABLE IF EXISTS `{target_relation_name}`;"
+                        )
+                    elif line.startswith("CREATE TABLE `"):
+                        processed_sql.append(f"CREATE TABLE `{target_relation_name}` (")
+                    elif line.startswith("LOCK TABLES `"):
+                        processed_sql.append(
+                            f"LOCK TABLES `{target_relation_name}` WRITE;"
+                        )
+                    elif line.startswith("INSERT INTO `"):
+                        processed_sql.append(
+                            f"INSERT INTO `{target_relation_name}` "
+                            + line.split("`", 2)[-1]
+                        )
+                    elif line.startswith(") ENGINE=InnoDB"):
+                        processed_sql.append(") ENGINE=InnoDB;")
+                    elif line.strip():
+                        processed_sql.append(line.strip())
+
+                sql = "\n".join(processed_sql)
 
-            sql = "\n".join(processed_sql)
-            with DBConnection(CURRENT_SITE) as cursor:
+            with DBConnection(current_site()) as cursor, tracer.span("load"):
                 for query in sql.split(";"):
                     if query.strip():
                         debug_log(query.strip())
@@ -109,13 +562,12 @@ def exec_query(action: str):
                 payload["relation2_name"],
                 payload["target_relation_name"],
             )
-            with DBConnection(CURRENT_SITE) as cursor:
+            with DBConnection(current_site()) as cursor:
                 query = (
-                    f"create table `{target_relation_name}` as "
-                    f"select * from `{relation1_name}` union select * from `{relation2_name}`"
+                    f"select * from `{relation1_name}` "
+                    f"union select * from `{relation2_name}`"
                 )
-                debug_log(query)
-                cursor.execute(query)
+                _create_relation(cursor, target_relation_name, query, snapshot)
         case "join":
             relation1_name, relation2_name, join_condition, target_relation_name = (
                 payload["relation1_name"],
@@ -123,15 +575,9 @@ def exec_query(action: str):
                 payload["join_condition"],
                 payload["target_relation_name"],
             )
-            with DBConnection(CURRENT_SITE) as cursor:
-                cursor.execute(
-                    f"select column_name from information_schema.columns where table_name = '{relation1_name}'"
-                )
-                rel1_cols = {list(x.values())[0] for x in cursor.fetchall()}
-                cursor.execute(
-                    f"select column_name from information_schema.columns where table_name = '{relation2_name}'"
-                )
-                rel2_cols = {list(x.values())[0] for x in cursor.fetchall()}
+            with DBConnection(current_site()) as cursor:
+                rel1_cols = set(list_columns(cursor, relation1_name))
+                rel2_cols = set(list_columns(cursor, relation2_name))
 
                 intersection = rel1_cols & rel2_cols
 
@@ -156,12 +602,10 @@ def exec_query(action: str):
 
                 join_condition = condition_dict_to_object(join_condition)
                 query = (
-                    f"create table `{target_relation_name}` as "
                     f"select {','.join(quoted_cols)} from `{relation1_name}` join `{relation2_name}` "
                     f"on {construct_select_condition_string(join_condition, relation1_name, relation2_name, list(rel1_cols), list(rel2_cols))}"
                 )
-                debug_log(query)
-                cursor.execute(query)
+                _create_relation(cursor, target_relation_name, query, snapshot)
         case "select":
             relation_name, select_condition, target_relation_name = (
                 payload["relation_name"],
@@ -169,14 +613,12 @@ def exec_query(action: str):
                 payload["target_relation_name"],
             )
             select_condition = condition_dict_to_object(select_condition)
-            with DBConnection(CURRENT_SITE) as cursor:
+            with DBConnection(current_site()) as cursor:
                 query = (
-                    f"create table `{target_relation_name}` as "
                     f"select * from `{relation_name}` "
                     f"where {construct_select_condition_string(select_condition)}"
                 )
-                debug_log(query)
-                cursor.execute(query)
+                _create_relation(cursor, target_relation_name, query, snapshot)
         case "project":
             relation_name, project_columns, target_relation_name = (
                 payload["relation_name"],
@@ -198,38 +640,87 @@ def exec_query(action: str):
                     quoted_cols.append(f"`{x}`")
                 else:
                     quoted_cols.append(x)
-            with DBConnection(CURRENT_SITE) as cursor:
-                query = (
-                    f"create table `{target_relation_name}` as "
-                    f"select {','.join(quoted_cols)} from `{relation_name}` {group_by_str}"
-                )
-                debug_log(query)
-                cursor.execute(query)
+            with DBConnection(current_site()) as cursor:
+                query = f"select {','.join(quoted_cols)} from `{relation_name}` {group_by_str}"
+                _create_relation(cursor, target_relation_name, query, snapshot)
         case "rename":
             old_name, new_name = payload["old_name"], payload["new_name"]
-            with DBConnection(CURRENT_SITE) as cursor:
+            with DBConnection(current_site()) as cursor:
                 cursor.execute(f"rename table `{old_name}` to `{new_name}`")
         case unk_action:
             abort(HTTPStatus.BAD_REQUEST, description=f"Unknown action {unk_action}")
 
-    return {"success": True}
+    result = {"success": True}
+
+    # EXPLAIN ANALYZE
+    if payload.get("analyze") and "target_relation_name" in payload:
+        with DBConnection(current_site()) as cursor:
+            cursor.execute(
+                f"select count(*) as n_rows from `{payload['target_relation_name']}`"
+            )
+            res = cursor.fetchone()
+        result |= {"rows": res["n_rows"] if res else 0, "bytes_shipped": bytes_shipped}
+
+    return result
+
+
+@authenticate_request
+@app.get("/stats")
+def relation_stats():
+    """
+    estimated size of every relation at this site, used by EXPLAIN, and the
+    reads and writes of base fragments since the daemon started, used by the
+    rebalancer
+    """
+    site = current_site()
+    with DBConnection(site) as cursor:
+        sizes = relation_sizes(cursor)
+
+    for (site_id, relation, access), n in fragment_accesses.values().items():
+        if site_id == site.id and relation in sizes:
+            sizes[relation][access] = int(n)
+    return sizes
 
 
 @authenticate_request
 @app.get("/fetch/<relation_name>")
+@traced_request
 def fetch_relation(relation_name: str):
+    site = current_site()
+    _count_read(relation_name)
+    # base fragments read by a query with a snapshot are dumped as of it
+    query_id = request.args.get("query_id")
+    if query_id is not None and QUERY_RELATION_RE.match(relation_name) is None:
+        state = participant_state()
+        with state.lock:
+            snapshot = state.snapshots.get(query_id)
+        if snapshot is not None:
+            relation_name = _snapshot_copy(snapshot, query_id, relation_name)
+
+    with tracer.span("dump", relation=relation_name):
+        if site.id in SQLITE_SITES:
+            table_sql = sqlite.dump_relation(SQLITE_SITES[site.id], relation_name)
+        else:
+            table_sql = _mysqldump(site, relation_name)
+
+    fetch_bytes_sent.inc(len(table_sql))
+    return {"table_sql": table_sql}
+
+
+def _mysqldump(site: Site, relation_name: str) -> str:
     dump = subprocess.Popen(
         [
             "mysqldump",
-            f"-u{CURRENT_SITE.user}",
-            f"-p{CURRENT_SITE.password}",
+            f"-u{site.user}",
+            f"-p{site.password}",
             DB_NAME,
             relation_name,
         ],
         stdout=subprocess.PIPE,
     )
+    exit_code = dump.wait()
 
-    if (exit_code := dump.wait()) != 0:
+    if exit_code != 0:
         abort(
             HTTPStatus.BAD_REQUEST,
             description=f"mysqldump failed with error code {exit_code}",
@@ -242,20 +733,21 @@ def fetch_relation(relation_name: str):
             continue
         result_lines.append(l)
 
-    return {"table_sql": "\n".join(result_lines)}
+    return "\n".join(result_lines)
 
 
 @authenticate_request
 @app.post("/cleanup/<query_id>")
+@traced_request
 def cleanup(query_id: str):
-    with DBConnection(CURRENT_SITE) as cursor:
-        cursor.execute(
-            "select table_name from information_schema.tables where table_schema = %s",
-            (DB_NAME,),
-        )
-        existing_relations: List[str] = [
-            list(row.values())[0] for row in cursor.fetchall()
-        ]
+    state = participant_state()
+    with state.lock:
+        snapshot = state.snapshots.pop(query_id, None)
+    if snapshot is not None:
+        snapshot.close()
+
+    with DBConnection(current_site()) as cursor:
+        existing_relations = list_relations(cursor)
 
         for relation in existing_relations:
             if relation.startswith(query_id):
@@ -264,108 +756,485 @@ def cleanup(query_id: str):
     return {"success": True}
 
 
+@authenticate_request
+@app.post("/snapshot/open")
+@traced_request
+def open_snapshot():
+    """
+    open a snapshot of this site as of timestamp `ts` for the steps of a query
+
+    transactions prepared here before `ts` may commit at or before it, the
+    snapshot waits for their decisions. if a commit after `ts` is already
+    installed the snapshot can't leave it out, and refuses
+    """
+    state = participant_state()
+    query_id, ts = request.json["query_id"], request.json["ts"]
+    # give up before the reader does
+    deadline = perf_counter() + TX_TIMEOUT / 2
+
+    with state.lock:
+        # transactions preparing from now on are ordered after the snapshot
+        clock.update(ts)
+        while any(
+            t.prepare_ts is not None and t.prepare_ts <= ts
+            for t in state.transactions.values()
+        ):
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                snapshots_opened.inc(outcome="timeout")
+                abort(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    description="Transactions prepared before it are undecided",
+                )
+            state.lock.wait(remaining)
+
+        if state.last_commit_ts > ts:
+            snapshots_opened.inc(outcome="too-old")
+            return {"opened": False, "ts": state.last_commit_ts}
+
+        # snapshots of an earlier attempt, or of queries that never cleaned up
+        stale = [
+            stale_id
+            for stale_id, snapshot in state.snapshots.items()
+            if stale_id == query_id or time() - snapshot.opened_at > SNAPSHOT_MAX_AGE
+        ]
+        for stale_id in stale:
+            state.snapshots.pop(stale_id).close()
+
+        state.snapshots[query_id] = ReadSnapshot(current_site(), ts)
+
+    snapshots_opened.inc(outcome="opened")
+    return {"opened": True, "ts": ts}
+
+
+def _fragment_capture(state: ParticipantState, fragment: str) -> FragmentCapture:
+    capture = state.migrations.get(fragment)
+    if capture is None:
+        abort(HTTPStatus.NOT_FOUND, description=f"{fragment} isn't being migrated")
+    return capture
+
+
+@authenticate_request
+@app.post("/migrate/start")
+@traced_request
+def migrate_start():
+    """
+    open a snapshot of base fragment `fragment` for migration `migration_id`
+    to copy, and capture the writes committed to the fragment after it.
+    without `snapshot`, the writes are only captured so the fragment can be
+    frozen
+    """
+    state = participant_state()
+    migration_id, fragment = request.json["migration_id"], request.json["fragment"]
+
+    with state.lock:
+        if fragment in state.migrations:
+            abort(HTTPStatus.CONFLICT, description=f"{fragment} is already moving")
+        # commits are installed with the lock held, every one is either in the
+        # snapshot or captured
+        state.migrations[fragment] = FragmentCapture(migration_id)
+        if request.json.get("snapshot", True):
+            state.snapshots[migration_id] = ReadSnapshot(current_site(), clock.now())
+
+    return {"success": True}
+
+
+@authenticate_request
+@app.post("/migrate/changes")
+@traced_request
+def migrate_changes():
+    """
+    writes captured for a migrating fragment, from position `after` on
+    """
+    state = participant_state()
+    fragment, after = request.json["fragment"], request.json.get("after", 0)
+
+    with state.lock:
+        capture = _fragment_capture(state, fragment)
+        return {
+            "changes": capture.changes[after:],
+            "position": len(capture.changes),
+            "incomplete": capture.incomplete,
+        }
+
+
+@authenticate_request
+@app.post("/migrate/freeze")
+@traced_request
+def migrate_freeze():
+    """
+    make writes to a migrating fragment vote abort and wait for the transaction
+    that may be writing it to finish, the captured writes are complete after
+    """
+    state = participant_state()
+    fragment = request.json["fragment"]
+    deadline = perf_counter() + TX_TIMEOUT
+
+    with state.lock:
+        capture = _fragment_capture(state, fragment)
+        capture.frozen = True
+        # transactions taking the write lock from now on see the fragment
+        # frozen, only the current holder can still write it
+        holder = state.write_lock_holder
+        while holder is not None and state.write_lock_holder == holder:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                capture.frozen = False
+                abort(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    description=f"Transaction {holder} is still undecided",
+                )
+            state.lock.wait(remaining)
+
+        return {"position": len(capture.changes), "incomplete": capture.incomplete}
+
+
+@authenticate_request
+@app.post("/migrate/finish")
+@traced_request
+def migrate_finish():
+    """
+    stop capturing the writes to a migrating fragment. with `drop`, the
+    fragment moved away and its copy here is dropped
+    """
+    state = participant_state()
+    fragment = request.json["fragment"]
+
+    with state.lock:
+        state.migrations.pop(fragment, None)
+
+    if request.json.get("drop"):
+        with DBConnection(current_site()) as cursor:
+            cursor.execute(f"drop table if exists `{fragment}`")
+
+    return {"success": True}
+
+
 @authenticate_request
 @app.post("/2pc/prepare")
+@traced_request
 def tx_2pc_prepare():
-    global RUNNING_READ_QUERY, RUNNING_WRITE_QUERY
+    """
+    run the statements of a transaction at this site and keep them prepared,
+    without committing, until the coordinator's decision
 
+    votes "vote-commit", "vote-abort" or "vote-read-only" if the statements
+    changed no rows. only a vote to commit waits for the decision
+    """
+    state = participant_state()
     payload = request.json
 
-    sql = payload["sql"]
     txid = payload["txid"]
+    # parameterized statements run with executemany when they have args
+    statements = payload.get("statements") or [{"sql": payload["sql"]}]
 
-    # in the middle of another query
-    if RUNNING_READ_QUERY or RUNNING_WRITE_QUERY:
-        tx_log_file.write(
-            f"{txid}: abort: cant write; in the middle of another query\n"
-        )
+    with state.lock:
+        aborted = txid in state.early_aborts
+        state.early_aborts.pop(txid, None)
+    if aborted:
+        _log_tx(txid, "vote-abort", "already aborted")
+        votes.inc(vote="abort")
         return "vote-abort"
 
-    RUNNING_WRITE_QUERY = True
+    if not _take_write_lock(state, txid):
+        _log_tx(txid, "vote-abort", "in the middle of another query")
+        votes.inc(vote="abort")
+        return "vote-abort"
 
-    split_sql = sql.strip().split()
-    relation_name = split_sql[1].strip("`")
-    sql = " ".join([split_sql[0], f"`{txid}_{relation_name}`", *split_sql[2:]])
+    if not all(WRITE_STATEMENT_RE.match(s["sql"]) for s in statements):
+        _release_write_lock(state, txid)
+        _log_tx(txid, "vote-abort", "not a write statement")
+        votes.inc(vote="abort")
+        return "vote-abort"
 
+    if _writes_moving_fragment(state, statements, txid):
+        _release_write_lock(state, txid)
+        _log_tx(txid, "vote-abort", "fragment is moving")
+        votes.inc(vote="abort")
+        return "vote-abort"
+
+    transaction = None
     try:
-        with DBConnection(CURRENT_SITE) as cursor:
-            create_table_sql = f"create table `{txid}_{relation_name}` as select * from `{relation_name}`"
-            debug_log(create_table_sql)
-            cursor.execute(create_table_sql)
-            debug_log(sql)
-            cursor.execute(sql)
+        transaction = LocalTransaction(current_site(), txid)
+        for statement in statements:
+            transaction.execute(statement["sql"], statement.get("args"))
+
+        read_only = transaction.rows_changed == 0
+        if read_only:
+            transaction.rollback()
+        else:
+            # forced before the branch prepares, a prepared branch no record
+            # mentions would keep its locks forever after a crash. a vote whose
+            # prepare didn't happen finds nothing to finish in recovery
+            _log_tx(txid, "vote-commit", force=True)
+            transaction.prepare()
     except Exception as e:
         print(e)
-        tx_log_file.write(f"{txid}: abort: error\n")
+        if transaction is not None:
+            # unprepared work is rolled back with its connection
+            transaction.close()
+        # a participant voting abort aborts on its own, the coordinator
+        # doesn't send it the decision
+        _release_write_lock(state, txid)
+        _log_tx(txid, "vote-abort", "error")
+        votes.inc(vote="abort")
+        return "vote-abort"
+
+    if read_only:
+        # nothing to commit, the participant leaves the transaction
+        _release_write_lock(state, txid)
+        _log_tx(txid, "vote-read-only")
+        votes.inc(vote="read-only")
+        return "vote-read-only"
+
+    with state.lock:
+        # the decision can't wait for a prepare that timed out, an abort
+        # arriving meanwhile released the write lock
+        aborted = state.write_lock_holder != txid
+        if not aborted:
+            transaction.prepare_ts = clock.now()
+            state.transactions[txid] = transaction
+    if aborted:
+        transaction.rollback()
+        _log_tx(txid, "vote-abort", "aborted while preparing")
+        votes.inc(vote="abort")
         return "vote-abort"
 
-    tx_log_file.write(f"{txid}: vote-commit\n")
+    # the coordinator may decide to commit once it has the vote
+    votes.inc(vote="commit")
     return "vote-commit"
 
 
-@authenticate_request
-@app.post("/2pc/global-commit")
-def tx_2pc_global_commit():
-    global RUNNING_READ_QUERY, RUNNING_WRITE_QUERY
-    RUNNING_WRITE_QUERY = False
+def _finish_transaction(txid: str, commit: bool, commit_ts: Optional[int] = None):
+    state = participant_state()
+    with state.lock:
+        transaction = state.transactions.pop(txid, None)
+        if transaction is None and not commit and state.write_lock_holder != txid:
+            state.early_aborts[txid] = None
+            if len(state.early_aborts) > EARLY_ABORTS_KEPT:
+                del state.early_aborts[next(iter(state.early_aborts))]
 
-    payload = request.json
+        # a snapshot opening meanwhile sees the commit and its timestamp
+        # together
+        if transaction is None:
+            finish_recovered(current_site(), txid, commit)
+        elif commit:
+            transaction.commit()
+        else:
+            transaction.rollback()
 
-    txid = payload["txid"]
+        if commit:
+            _record_commit(state, transaction and transaction.statements)
+            if commit_ts is None:
+                # decisions recovered from logs written without timestamps
+                commit_ts = clock.now()
+            clock.update(commit_ts)
+            state.last_commit_ts = max(state.last_commit_ts, commit_ts)
+        state.lock.notify_all()
 
-    with DBConnection(CURRENT_SITE) as cursor:
-        cursor.execute(
-            "select table_name from information_schema.tables where table_schema = %s",
-            (DB_NAME,),
-        )
-        existing_relations: List[str] = [
-            list(row.values())[0] for row in cursor.fetchall()
-        ]
+    _release_write_lock(state, txid)
 
-        for relation in existing_relations:
-            if relation.startswith(txid):
-                debug_log("Found relation %s", relation)
-                src_relation_name = relation
-                target_relation_name = relation.split("_", 1)[1]
-                debug_log("Dropping %s", target_relation_name)
-                cursor.execute(f"drop table `{target_relation_name}`")
-                debug_log("Renaming %s to %s", src_relation_name, target_relation_name)
-                cursor.execute(
-                    f"rename table `{src_relation_name}` to `{target_relation_name}`"
-                )
-                break
 
-    tx_log_file.write(f"{txid}: commit\n")
+@authenticate_request
+@app.post("/2pc/global-commit")
+@traced_request
+def tx_2pc_global_commit():
+    txid = request.json["txid"]
+    _finish_transaction(txid, commit=True, commit_ts=request.json.get("commit_ts"))
+
+    _log_tx(txid, "commit")
+    decisions.inc(decision="commit")
     return {"success": True}
 
 
 @authenticate_request
 @app.post("/2pc/global-abort")
+@traced_request
 def tx_2pc_global_abort():
-    global RUNNING_READ_QUERY, RUNNING_WRITE_QUERY
-    RUNNING_WRITE_QUERY = False
+    txid = request.json["txid"]
+    _finish_transaction(txid, commit=False)
+
+    _log_tx(txid, "abort")
+    decisions.inc(decision="abort")
+    return {"success": True}
+
+
+@authenticate_request
+@app.get("/2pc/status")
+def tx_2pc_status():
+    """
+    decision of a transaction coordinated from this node, asked by participants
+    that lost track of it
+
+    a transaction the coordinator's log doesn't know never prepared anywhere,
+    begin_commit is forced before the first prepare
+    """
+    txid = request.args["txid"]
+    records = [r for r in coordinator_log.records() if r.txid == txid]
+    if len(records) == 0:
+        return {"decision": "abort"}
+
+    return {"decision": decision_of(records) or "pending"}
+
+
+def in_doubt_transactions() -> List[Tuple[int, str]]:
+    """
+    (site id, txid) of the transactions a site voted to commit without
+    learning the decision
+    """
+    last_records: Dict[Tuple[int, str], TxRecord] = {}
+    for record in participant_log.records():
+        last_records[(record.site, record.txid)] = record
+
+    return [key for key, record in last_records.items() if record.type == "vote-commit"]
+
+
+def rollback_unvoted(site: Site, in_doubt: List[Tuple[int, str]]):
+    """
+    roll back the XA transactions prepared at `site` that the participant log
+    has no vote to commit for, the log isn't the only record of prepared work
+
+    the vote is forced before the prepare, so these are left over from a log
+    that lost them. no coordinator decided to commit them without the vote.
+    runs before the daemon serves requests, transactions preparing meanwhile
+    would look unvoted
+    """
+    voted = {txid for site_id, txid in in_doubt if site_id == site.id}
+    for txid in prepared_transactions(site):
+        if txid not in voted:
+            print(f"Rolling back {txid}, prepared without a vote to commit")
+            finish_recovered(site, txid, False)
 
+
+def recover_in_doubt(in_doubt: List[Tuple[int, str]], retry_interval: float = 5):
+    """
+    ask the coordinators of in doubt transactions for their decisions and
+    apply them, until every one is resolved
+    """
+    in_doubt = list(in_doubt)
+    while True:
+        for site_id, txid in list(in_doubt):
+            coordinator = int(COORDINATOR_SITE_RE.match(txid)[1])
+            try:
+                r = send_request_to_site(
+                    coordinator, "get", "/2pc/status", params={"txid": txid}
+                )
+                decision = r.json()["decision"]
+            except Exception as e:
+                print(f"Couldn't get the decision of {txid}: {e}")
+                continue
+
+            if decision == "pending":
+                continue
+
+            site = catalog.sites.where(id=site_id)[0]
+            state = participant_states[site_id]
+            with state.lock:
+                finish_recovered(site, txid, decision == "commit")
+                # the commit timestamp is lost, snapshots from before now
+                # have to retry
+                if decision == "commit":
+                    state.last_commit_ts = clock.now()
+                    _record_commit(state, None)
+            participant_log.write(TxRecord(txid, decision, site=site_id))
+            in_doubt.remove((site_id, txid))
+            debug_log("Recovered %s at site %s: %s", txid, site_id, decision)
+
+        if len(in_doubt) == 0:
+            return
+        sleep(retry_interval)
+
+
+@authenticate_request
+@app.post("/1pc/commit")
+@traced_request
+def tx_1pc_commit():
+    """
+    run statements (sql and optional rows for executemany) in one local
+    transaction, for writes that touch only this site and need no two phase
+    commit
+    """
+    state = participant_state()
     payload = request.json
 
     txid = payload["txid"]
 
-    with DBConnection(CURRENT_SITE) as cursor:
-        cursor.execute(
-            "select table_name from information_schema.tables where table_schema = %s",
-            (DB_NAME,),
-        )
-        existing_relations: List[str] = [
-            list(row.values())[0] for row in cursor.fetchall()
-        ]
+    if not _take_write_lock(state, txid):
+        _log_tx(txid, "abort", "in the middle of another query")
+        decisions.inc(decision="abort")
+        return "abort"
 
-        for relation in existing_relations:
-            if relation.startswith(txid):
-                cursor.execute(f"drop table `{relation}`")
-                break
+    if _writes_moving_fragment(state, payload["statements"], txid):
+        _release_write_lock(state, txid)
+        _log_tx(txid, "abort", "fragment is moving")
+        decisions.inc(decision="abort")
+        return "abort"
 
-    tx_log_file.write(f"{txid}: abort\n")
-    return {"success": True}
+    try:
+        with DBConnection(current_site()) as cursor:
+            cursor.execute("begin")
+            for statement in payload["statements"]:
+                debug_log(statement["sql"])
+                if statement.get("args") is None:
+                    cursor.execute(statement["sql"])
+                else:
+                    cursor.executemany(statement["sql"], statement["args"])
+            with state.lock:
+                cursor.execute("commit")
+                state.last_commit_ts = max(state.last_commit_ts, clock.now())
+                _record_commit(state, payload["statements"])
+    except Exception as e:
+        print(e)
+        _log_tx(txid, "abort", "error")
+        decisions.inc(decision="abort")
+        return "abort"
+    finally:
+        _release_write_lock(state, txid)
+
+    _log_tx(txid, "commit")
+    decisions.inc(decision="commit")
+    return "commit"
+
+
+@authenticate_request
+@app.get("/trace/events")
+def trace_events():
+    """
+    drain the trace buffer of this node, or only the events of one query
+    """
+    events = drain(request.args.get("query_id"))
+    return {"events": [asdict(event) for event in events]}
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    metrics of this daemon in the prometheus text format
+    """
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/coordinator")
+def coordinator_metrics():
+    """
+    metrics of the REPL running on this node, written by it after every query
+    """
+    if not COORDINATOR_METRICS_PATH.exists():
+        abort(HTTPStatus.NOT_FOUND, description="No coordinator running on this node")
+
+    return Response(
+        COORDINATOR_METRICS_PATH.read_text(), mimetype="text/plain; version=0.0.4"
+    )
 
 
 if __name__ == "__main__":
+    if not DEBUG:
+        in_doubt = in_doubt_transactions()
+        rollback_unvoted(CURRENT_SITE, in_doubt)
+        # nothing else writes the log yet, unless another daemon runs
+        if participant_log.lock_exclusive():
+            participant_log.compact([txid for _, txid in in_doubt])
+            participant_log.unlock_exclusive()
+        Thread(target=recover_in_doubt, args=(in_doubt,), daemon=True).start()
+
     app.run("0.0.0.0", 12117, debug=DEBUG)
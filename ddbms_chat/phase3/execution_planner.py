@@ -1,9 +1,11 @@
 from collections import defaultdict
 from dataclasses import asdict
-from typing import List
+from time import perf_counter
+from typing import Dict, List, Optional, Set
 
 import networkx as nx
 
+from ddbms_chat.config import SNAPSHOT_READS
 from ddbms_chat.models.query import SelectQuery
 from ddbms_chat.models.syscat import Site
 from ddbms_chat.models.tree import (
@@ -18,8 +20,12 @@ from ddbms_chat.phase3.utils import (
     get_component_relations,
     send_request_to_site,
 )
+from ddbms_chat.phase4.utils import open_snapshot
+from ddbms_chat.tracing import get_tracer, trace_query
 from ddbms_chat.utils import DBConnection, debug_log
 
+tracer = get_tracer("phase3.execution_planner")
+
 
 def build_relation_name(
     query_id: str, plan_idx: int, component_relations: List[str]
@@ -48,9 +54,33 @@ def get_executable_nodes(qt: nx.DiGraph):
     return None, None
 
 
+def _move_relation(
+    qt: nx.DiGraph, plan: List, node: RelationNode, steps: List[int], site_id: int
+):
+    """
+    compute a relation derived from broadcast tables only at `site_id` instead
+    """
+    for i in steps:
+        plan[i] = (site_id, *plan[i][1:])
+
+    # the site is part of the node's hash
+    parent = list(qt.predecessors(node))[0]
+    qt.remove_node(node)
+    node.site_id = site_id
+    qt.add_edge(parent, node)
+
+
 def plan_execution(qt: nx.DiGraph, query_id: str):
     plan = []
 
+    # relation -> steps computing it, for relations that only read broadcast
+    # tables. every site has their inputs, so they're computed where they're used
+    floating: Dict[str, List[int]] = {
+        node.name: []
+        for node in qt.nodes
+        if type(node) is RelationNode and node.broadcast
+    }
+
     while True:
         try:
             actionable_nodes, parent = get_executable_nodes(qt)
@@ -63,6 +93,13 @@ def plan_execution(qt: nx.DiGraph, query_id: str):
             raise ValueError("Parent node doesn't exist")
 
         if len(actionable_nodes) == 2:
+            node1, node2 = actionable_nodes
+            if node1.site_id != node2.site_id:
+                if node2.name in floating:
+                    _move_relation(qt, plan, node2, floating[node2.name], node1.site_id)
+                elif node1.name in floating:
+                    _move_relation(qt, plan, node1, floating[node1.name], node2.site_id)
+
             component_rels = get_component_relations(actionable_nodes[1].name)
             old_node_name = build_relation_name(query_id, len(plan), component_rels)
             # TODO: use semijoin optimization for joins
@@ -110,6 +147,11 @@ def plan_execution(qt: nx.DiGraph, query_id: str):
             else:
                 raise ValueError(f"Didn't expect node of type {type(parent)}")
 
+            if node1.name in floating and node2.name in floating:
+                floating[node_name] = (
+                    floating[node1.name] + floating[node2.name] + [len(plan) - 1]
+                )
+
             qt.remove_node(actionable_nodes[0])
             qt.remove_node(actionable_nodes[1])
             grandparent = list(qt.predecessors(parent))[0]
@@ -145,6 +187,11 @@ def plan_execution(qt: nx.DiGraph, query_id: str):
             else:
                 raise ValueError(f"Didn't expect node of type {type(parent)}")
 
+            if actionable_nodes[0].name in floating:
+                floating[node_name] = floating[actionable_nodes[0].name] + [
+                    len(plan) - 1
+                ]
+
             qt.remove_node(actionable_nodes[0])
             grandparent_or_none = list(qt.predecessors(parent))
             if len(grandparent_or_none) == 0:
@@ -162,14 +209,112 @@ def plan_execution(qt: nx.DiGraph, query_id: str):
     return plan
 
 
+def _record_step_stats(step_stats: Optional[List[Dict]], r, start: float, **kwargs):
+    if step_stats is None:
+        return
+
+    response = r.json()
+    step_stats.append(
+        kwargs
+        | {
+            "time": perf_counter() - start,
+            "rows": response.get("rows"),
+            "bytes_shipped": response.get("bytes_shipped", 0),
+        }
+    )
+
+
+def _snapshot_sites(plan: List, query_id: str) -> Set[int]:
+    """
+    sites whose base fragments the plan reads
+    """
+    sites = set()
+    for site_id, action, metadata, _ in plan:
+        match action:
+            case "fetch":
+                relations, site_id = [metadata[0]], metadata[1]
+            case "union" | "join":
+                relations = [metadata[0], metadata[1]]
+            case _:
+                relations = [metadata[0]]
+
+        if any(not relation.startswith(query_id) for relation in relations):
+            sites.add(site_id)
+
+    return sites
+
+
 def execute_plan(
-    plan: List, query_id: str, current_site: Site, select_query: SelectQuery
+    plan: List,
+    query_id: str,
+    current_site: Site,
+    select_query: SelectQuery,
+    step_stats: Optional[List[Dict]] = None,
+    snapshot: bool = SNAPSHOT_READS,
+):
+    """
+    run the plan and return the rows of the result
+
+    if `step_stats` is passed, sites also report rows produced and bytes shipped
+    for each step, which are appended to it along with the step's wall time.
+    with `snapshot`, every site reads its base fragments as of one timestamp
+    """
+    with trace_query(query_id), tracer.span("execute_plan", steps=len(plan)):
+        return _execute_plan(
+            plan, query_id, current_site, select_query, step_stats, snapshot
+        )
+
+
+def _execute_plan(
+    plan: List,
+    query_id: str,
+    current_site: Site,
+    select_query: SelectQuery,
+    step_stats: Optional[List[Dict]],
+    snapshot: bool,
 ):
     sites_involved = set()
 
+    if snapshot:
+        # closed by the cleanup of the query
+        sites_involved = _snapshot_sites(plan, query_id)
+        with tracer.span("snapshot", sites=len(sites_involved)):
+            open_snapshot(query_id, sites_involved)
+
+    try:
+        rows = _run_steps(
+            plan, query_id, current_site, select_query, step_stats, sites_involved
+        )
+    except Exception:
+        # don't keep the snapshots and relations of a failed query around
+        for site_id in sites_involved:
+            try:
+                send_request_to_site(site_id, "post", f"/cleanup/{query_id}")
+            except Exception as e:
+                print(e)
+        raise
+
+    for site_id in sites_involved:
+        r = send_request_to_site(site_id, "post", f"/cleanup/{query_id}")
+        if not r.ok:
+            raise ValueError(f"Cleanup failed at site {site_id}")
+
+    return rows
+
+
+def _run_steps(
+    plan: List,
+    query_id: str,
+    current_site: Site,
+    select_query: SelectQuery,
+    step_stats: Optional[List[Dict]],
+    sites_involved: Set[int],
+):
     for i, (site_id, action, metadata, new_relation_name) in enumerate(plan):
         sites_involved.add(site_id)
         payload = {"target_relation_name": new_relation_name}
+        if step_stats is not None:
+            payload["analyze"] = True
         match action:
             case "fetch":
                 payload |= {"relation_name": metadata[0], "site_id": metadata[1]}
@@ -207,30 +352,34 @@ def execute_plan(
                         "group_by": select_query.group_by,
                         "having": condition_object_to_dict(select_query.having),
                     }
-        r = send_request_to_site(site_id, "post", f"/exec/{action}", json=payload)
+        start = perf_counter()
+        with tracer.span("step", step=i + 1, site=site_id, action=action):
+            r = send_request_to_site(site_id, "post", f"/exec/{action}", json=payload)
         if not r.ok:
             raise ValueError(f"Failed to execute step {i + 1} of plan")
+        _record_step_stats(
+            step_stats, r, start, step=i + 1, site=site_id, action=action
+        )
 
-    r = send_request_to_site(
-        current_site.id,
-        "post",
-        "/exec/fetch",
-        json={
-            "relation_name": plan[-1][-1],
-            "site_id": plan[-1][0],
-            "target_relation_name": f"{query_id}-result",
-        },
-    )
+    start = perf_counter()
+    with tracer.span("step", step=len(plan) + 1, site=current_site.id, action="result"):
+        r = send_request_to_site(
+            current_site.id,
+            "post",
+            "/exec/fetch",
+            json={
+                "relation_name": plan[-1][-1],
+                "site_id": plan[-1][0],
+                "target_relation_name": f"{query_id}-result",
+                "analyze": step_stats is not None,
+            },
+        )
     if not r.ok:
         raise ValueError("Failed to retrieve results")
+    _record_step_stats(
+        step_stats, r, start, step=len(plan) + 1, site=current_site.id, action="result"
+    )
 
     with DBConnection(current_site) as cursor:
         cursor.execute(f"select * from `{query_id}-result`")
-        rows = cursor.fetchall()
-
-    for site_id in sites_involved:
-        r = send_request_to_site(site_id, "post", f"/cleanup/{query_id}")
-        if not r.ok:
-            raise ValueError(f"Cleanup failed at site {site_id}")
-
-    return rows
+        return cursor.fetchall()
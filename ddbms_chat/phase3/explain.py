@@ -0,0 +1,245 @@
+"""
+EXPLAIN and EXPLAIN ANALYZE for distributed queries
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+from rich.console import Console
+from rich.table import Table
+
+from ddbms_chat.models.query import Condition, ConditionAnd, ConditionOr, SelectQuery
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.phase2.query_tree import build_query_tree
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
+from ddbms_chat.phase3.utils import send_request_to_site
+from ddbms_chat.utils import debug_log
+
+# textbook selectivity guesses, used when a condition compares with a constant
+SELECTIVITY = {
+    "=": 0.1,
+    "!=": 0.9,
+    "<>": 0.9,
+    "<": 1 / 3,
+    ">": 1 / 3,
+    "<=": 1 / 3,
+    ">=": 1 / 3,
+    "LIKE": 0.25,
+}
+
+
+@dataclass
+class RelationEstimate:
+    rows: float
+    bytes: float
+    n_columns: int
+
+
+def fetch_site_statistics(site_ids) -> Dict[int, Dict[str, Dict]]:
+    """
+    get estimated row count and size of all relations at the given sites
+    """
+    stats = {}
+    for site_id in site_ids:
+        r = send_request_to_site(site_id, "get", "/stats")
+        if not r.ok:
+            raise ValueError(f"Couldn't fetch statistics from site {site_id}")
+        stats[site_id] = r.json()
+
+    return stats
+
+
+def _base_estimate(relation_name: str, site_id: int, stats: Dict) -> RelationEstimate:
+    relation_stats = stats.get(site_id, {}).get(relation_name, {})
+
+    n_columns = 1
+    fragments = catalog.fragments.where(name=relation_name)
+    if len(fragments) > 0:
+        fragment = fragments[0]
+        table = catalog.tables.where(id=fragment.table)[0]
+        if table.fragment_type == "V":
+            n_columns = len(fragment.logic.split(","))
+        else:
+            n_columns = len(catalog.columns.where(table=table.id))
+
+    return RelationEstimate(
+        relation_stats.get("rows", 0), relation_stats.get("bytes", 0), n_columns
+    )
+
+
+def condition_selectivity(
+    condition: Optional[Union[Condition, ConditionAnd, ConditionOr]]
+) -> float:
+    if condition is None:
+        return 1
+
+    if type(condition) is Condition:
+        return SELECTIVITY.get(condition.op.upper(), 0.5)
+
+    selectivities = [condition_selectivity(c) for c in condition.conditions]
+
+    result = 1.0
+    if type(condition) is ConditionAnd:
+        for selectivity in selectivities:
+            result *= selectivity
+        return result
+
+    # or: 1 - P(none of them match)
+    for selectivity in selectivities:
+        result *= 1 - selectivity
+    return 1 - result
+
+
+def _describe_step(action: str, metadata) -> str:
+    match action:
+        case "fetch":
+            return f"{metadata[0]} from site {metadata[1]}"
+        case "union":
+            return f"{metadata[0]} ∪ {metadata[1]}"
+        case "join":
+            return f"{metadata[0]} ⋈ {metadata[1]} on {metadata[2] or '(X)'}"
+        case "select":
+            return f"σ {metadata[1]} ({metadata[0]})"
+        case "project":
+            return f"π {metadata[1]} ({metadata[0]})"
+
+    return str(metadata)
+
+
+def estimate_plan(plan: List, stats: Dict, current_site_id: int) -> List[Dict]:
+    """
+    estimate rows, bytes and network transfer of every step of a plan
+    """
+    estimates: Dict[str, RelationEstimate] = {}
+
+    def get(relation_name: str, site_id: int) -> RelationEstimate:
+        if relation_name in estimates:
+            return estimates[relation_name]
+        return _base_estimate(relation_name, site_id, stats)
+
+    steps = []
+    for i, (site_id, action, metadata, target) in enumerate(plan):
+        shipped = 0.0
+
+        match action:
+            case "fetch":
+                src = get(metadata[0], metadata[1])
+                out = RelationEstimate(src.rows, src.bytes, src.n_columns)
+                shipped = src.bytes
+            case "union":
+                a, b = get(metadata[0], site_id), get(metadata[1], site_id)
+                out = RelationEstimate(a.rows + b.rows, a.bytes + b.bytes, a.n_columns)
+            case "join":
+                a, b = get(metadata[0], site_id), get(metadata[1], site_id)
+                condition = metadata[2]
+                if condition is not None and condition.op == "=":
+                    # assume a key/foreign key equijoin
+                    rows = max(a.rows, b.rows)
+                else:
+                    rows = a.rows * b.rows
+                width = (a.bytes / a.rows if a.rows else 0) + (
+                    b.bytes / b.rows if b.rows else 0
+                )
+                out = RelationEstimate(rows, rows * width, a.n_columns + b.n_columns)
+            case "select":
+                src = get(metadata[0], site_id)
+                selectivity = condition_selectivity(metadata[1])
+                out = RelationEstimate(
+                    src.rows * selectivity, src.bytes * selectivity, src.n_columns
+                )
+            case "project":
+                src = get(metadata[0], site_id)
+                fraction = min(1, len(metadata[1]) / max(src.n_columns, 1))
+                out = RelationEstimate(src.rows, src.bytes * fraction, len(metadata[1]))
+            case _:
+                raise ValueError(f"Can't estimate step of type {action}")
+
+        estimates[target] = out
+        steps.append(
+            {
+                "step": i + 1,
+                "site": site_id,
+                "action": action,
+                "description": _describe_step(action, metadata),
+                "est_rows": out.rows,
+                "est_bytes": out.bytes,
+                "est_bytes_shipped": shipped,
+            }
+        )
+
+    result = estimates[plan[-1][-1]]
+    steps.append(
+        {
+            "step": len(plan) + 1,
+            "site": current_site_id,
+            "action": "result",
+            "description": f"{plan[-1][-1]} from site {plan[-1][0]}",
+            "est_rows": result.rows,
+            "est_bytes": result.bytes,
+            "est_bytes_shipped": result.bytes,
+        }
+    )
+
+    return steps
+
+
+def explain_query(
+    select_query: SelectQuery, query_id: str, current_site: Site, analyze: bool = False
+) -> List[Dict]:
+    """
+    plan the query and estimate every step; with `analyze` also run it and
+    add the measured wall time, rows and bytes shipped of every step
+    """
+    qt = build_query_tree(select_query)
+    plan = plan_execution(qt, query_id)
+
+    site_ids = {step[0] for step in plan}
+    site_ids |= {step[2][1] for step in plan if step[1] == "fetch"}
+    stats = fetch_site_statistics(site_ids)
+
+    steps = estimate_plan(plan, stats, current_site.id)
+
+    if analyze:
+        step_stats = []
+        execute_plan(plan, query_id, current_site, select_query, step_stats)
+        for step, actual in zip(steps, step_stats):
+            step |= {
+                "time": actual["time"],
+                "rows": actual["rows"],
+                "bytes_shipped": actual["bytes_shipped"],
+            }
+
+    debug_log("%s", steps)
+    return steps
+
+
+def print_explain(steps: List[Dict], query_id: str, analyze: bool = False):
+    table = Table(title=f"{'EXPLAIN ANALYZE' if analyze else 'EXPLAIN'} {query_id}")
+
+    columns = ["step", "site", "action", "description", "est. rows", "est. bytes"]
+    columns.append("est. shipped")
+    if analyze:
+        columns += ["time (ms)", "rows", "shipped"]
+
+    for column in columns:
+        table.add_column(column)
+
+    for step in steps:
+        row = [
+            str(step["step"]),
+            str(step["site"]),
+            step["action"],
+            step["description"],
+            f"{step['est_rows']:.0f}",
+            f"{step['est_bytes']:.0f}",
+            f"{step['est_bytes_shipped']:.0f}",
+        ]
+        if analyze:
+            row += [
+                f"{step.get('time', 0) * 1000:.1f}",
+                str(step.get("rows")),
+                str(step.get("bytes_shipped")),
+            ]
+        table.add_row(*row)
+
+    Console().print(table)
@@ -8,20 +8,33 @@ from rich.console import Console
 from rich.pretty import pprint
 from rich.table import Table
 
-from ddbms_chat.config import HOSTNAME, PROJECT_ROOT
-from ddbms_chat.phase2.parser import parse_select, parse_sql
+from ddbms_chat.config import (
+    COORDINATOR_METRICS_PATH,
+    HOSTNAME,
+    PROJECT_ROOT,
+    RENDER_QUERY_TREES,
+)
+from ddbms_chat.metrics import write_textfile
+from ddbms_chat.phase2.fast_parser import parse_select_query
 from ddbms_chat.phase2.query_tree import build_query_tree
-from ddbms_chat.phase2.syscat import read_syscat
-from ddbms_chat.phase2.utils import to_pydot
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.phase2.utils import render_query_tree
 from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
-from ddbms_chat.phase4.utils import tx_2pc
+from ddbms_chat.phase3.explain import explain_query, print_explain
+from ddbms_chat.phase3.timeline import trace_select
+from ddbms_chat.phase4.utils import (
+    localize_statement,
+    recover_transactions,
+    tx_2pc,
+    tx_batch,
+    tx_insert,
+)
 
 history_file = PROJECT_ROOT / ".history"
 history_file.touch()
 
 
-_, _, _, syscat_sites, _ = read_syscat()
-sites = syscat_sites.where(name=HOSTNAME)
+sites = catalog.sites.where(name=HOSTNAME)
 
 if len(sites) > 0:
     CURRENT_SITE = sites[0]
@@ -30,26 +43,35 @@ else:
 
 readline.read_history_file(history_file)
 
+# transactions interrupted by the last exit of the REPL
+recover_transactions()
+
+# updates and inserts of the open begin ... commit block, None outside of one
+transaction = None
+# the last query failed, maybe on fragments the cached catalog doesn't know moved
+catalog_miss = False
+
 while True:
     try:
         qid = f"q{token_hex(3)}s{CURRENT_SITE.id}"
         query_str = input("Enter query: ")
-        cmd = query_str.strip().lower().split()[0]
+        catalog.refresh(force=catalog_miss)
+        catalog_miss = False
+        cmd = query_str.strip().lower().split()[0].rstrip(";")
 
         if cmd == "select":
-            parsed_query = parse_sql(query_str)
-            select_query = parse_select(parsed_query)
+            select_query = parse_select_query(query_str)
             pprint(select_query, expand_all=True)
             qt = build_query_tree(select_query)
 
-            if select_query.group_by:
+            if select_query.group_by and RENDER_QUERY_TREES:
                 qtcp = deepcopy(qt)
                 root_node = [n for n, d in qtcp.in_degree() if d == 0][0]
                 title = f"GroupBy {select_query.group_by}"
                 if select_query.having:
                     title += f" Having {select_query.having}"
                 qtcp.add_edge(title, root_node)
-                to_pydot(qtcp).write_png("qt-final.png")
+                render_query_tree(qtcp, "qt-final.png")
 
             execution_plan = plan_execution(qt, qid)
             rows = execute_plan(execution_plan, qid, CURRENT_SITE, select_query)
@@ -62,11 +84,49 @@ while True:
                     table.add_row(*list(map(str, row.values())))
                 console = Console()
                 console.print(table)
+        elif cmd == "explain":
+            # explain [analyze] <select query>
+            _, query_str = query_str.strip().split(maxsplit=1)
+            analyze = query_str.lower().startswith("analyze ")
+            if analyze:
+                query_str = query_str[len("analyze ") :]
+
+            select_query = parse_select_query(query_str)
+            steps = explain_query(select_query, qid, CURRENT_SITE, analyze)
+            print_explain(steps, qid, analyze)
+        elif cmd == "trace":
+            # trace <select query>
+            _, query_str = query_str.strip().split(maxsplit=1)
+            select_query = parse_select_query(query_str)
+            rows, trace_path = trace_select(select_query, qid, CURRENT_SITE)
+            print(f"{len(rows)} rows fetched, timeline written to {trace_path}")
+        elif cmd == "begin":
+            if transaction is not None:
+                raise ValueError("A transaction is already open")
+            transaction = []
+        elif cmd == "commit":
+            if transaction is None:
+                raise ValueError("No transaction is open")
+            statements, transaction = transaction, None
+            print(f"Query {qid}: {tx_batch(statements, qid)}")
+        elif cmd == "rollback":
+            if transaction is None:
+                raise ValueError("No transaction is open")
+            transaction = None
+        elif cmd in ("update", "insert") and transaction is not None:
+            # fail now instead of when the whole block commits
+            localize_statement(query_str)
+            transaction.append(query_str)
         elif cmd == "update":
-            tx_2pc(query_str, qid)
+            print(f"Query {qid}: {tx_2pc(query_str, qid)}")
+        elif cmd == "insert":
+            print(f"Query {qid}: {tx_insert(query_str, qid)}")
     except EOFError:
         break
     except Exception as e:
         print_exc()
+        catalog_miss = True
+    finally:
+        write_textfile(COORDINATOR_METRICS_PATH)
 
 atexit.register(readline.write_history_file, history_file)
@@ -0,0 +1,66 @@
+"""
+per-query timelines assembled from the trace events of all sites
+"""
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from ddbms_chat.config import PROJECT_ROOT
+from ddbms_chat.models.query import SelectQuery
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.phase2.query_tree import build_query_tree
+from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
+from ddbms_chat.phase3.utils import send_request_to_site
+from ddbms_chat.tracing import (
+    TraceEvent,
+    drain,
+    export_chrome_trace,
+    get_tracer,
+    trace_query,
+)
+
+tracer = get_tracer("phase3.timeline")
+
+
+def collect_timeline(query_id: str, site_ids: Iterable[int]) -> List[TraceEvent]:
+    """
+    drain the events of `query_id` from this process and the given sites
+    """
+    events = drain(query_id)
+    for site_id in site_ids:
+        r = send_request_to_site(
+            site_id, "get", "/trace/events", params={"query_id": query_id}
+        )
+        if not r.ok:
+            raise ValueError(f"Couldn't fetch trace events from site {site_id}")
+        events += [TraceEvent(**event) for event in r.json()["events"]]
+
+    events.sort(key=lambda event: event.timestamp)
+    return events
+
+
+def trace_select(
+    select_query: SelectQuery,
+    query_id: str,
+    current_site: Site,
+    path: Optional[Path] = None,
+):
+    """
+    run the query with tracing enabled on every site it touches and write its
+    timeline to `path` (trace-<query id>.json by default)
+
+    returns the rows of the result and the path of the trace
+    """
+    with trace_query(query_id, sampled=True), tracer.span("query"):
+        with tracer.span("plan"):
+            qt = build_query_tree(select_query)
+            plan = plan_execution(qt, query_id)
+        rows = execute_plan(plan, query_id, current_site, select_query)
+
+    site_ids = {current_site.id} | {step[0] for step in plan}
+    site_ids |= {step[2][1] for step in plan if step[1] == "fetch"}
+    events = collect_timeline(query_id, sorted(site_ids))
+
+    path = path or PROJECT_ROOT / f"trace-{query_id}.json"
+    export_chrome_trace(path, events)
+
+    return rows, path
@@ -1,15 +1,31 @@
 import re
-from typing import Dict, List, Optional, Union
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Union
 
 import requests
 
+from ddbms_chat.hlc import HLC_HEADER, clock
+from ddbms_chat.metrics import Counter, Histogram, route_of
 from ddbms_chat.models.query import Condition, ConditionAnd, ConditionOr
 from ddbms_chat.models.syscat import Column, Site, Table
 from ddbms_chat.phase1.syscat_tables import fill_tables
-from ddbms_chat.phase2.syscat import read_syscat
+from ddbms_chat.phase2.replicas import track_request
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.tracing import get_tracer, trace_headers
 from ddbms_chat.utils import DBConnection
 
-_, _, _, syscat_sites, _ = read_syscat()
+tracer = get_tracer("phase3.utils")
+
+client_request_seconds = Histogram(
+    "ddbms_chat_client_request_duration_seconds",
+    "latency of requests sent to sites, as seen by the sender",
+    ["site", "route"],
+)
+client_requests = Counter(
+    "ddbms_chat_client_requests_total",
+    "requests sent to sites by status code",
+    ["site", "route", "status"],
+)
 
 
 def get_component_relations(rel_name: str) -> List[str]:
@@ -20,6 +36,19 @@ def get_component_relations(rel_name: str) -> List[str]:
     return sorted(rel_name.split("-", 1)[1].split("-"))
 
 
+def _send_http(ip: str, method: str, endpoint: str, **kwargs):
+    method_fn = {
+        "get": requests.get,
+        "post": requests.post,
+    }
+
+    return method_fn[method](f"http://{ip}:12117{endpoint}", **kwargs)
+
+
+# sends the requests of send_request_to_site, replaced by simulated clusters
+transport: Callable = _send_http
+
+
 def send_request_to_site(
     site_id: Optional[int],
     method: str,
@@ -27,14 +56,19 @@ def send_request_to_site(
     params: Optional[Dict] = None,
     headers: Optional[Dict] = None,
     json: Optional[Dict] = None,
+    timeout: Optional[float] = None,
 ):
     """
     Send request to site after verifyng it is running
 
-    Also manages authentication related stuff
+    Also manages authentication related stuff and passes on the trace context
+    and the hybrid logical clock
     """
     if site_id:
-        sites = syscat_sites.where(id=site_id)
+        sites = catalog.sites.where(id=site_id)
+        if len(sites) == 0 and catalog.refresh(force=True):
+            # added since the catalog was loaded
+            sites = catalog.sites.where(id=site_id)
         if len(sites) == 0:
             raise ValueError(f"Site {site_id} not present in system catalog")
 
@@ -47,23 +81,38 @@ def send_request_to_site(
         name = "local_node"
         password = ""
 
-    r = requests.get(f"http://{ip}:12117/ping", timeout=5)
+    start = perf_counter()
+    with tracer.span("ping", site=site_id):
+        r = transport(ip, "get", "/ping", timeout=5)
+    client_request_seconds.observe(perf_counter() - start, site=name, route="/ping")
     if not r.ok:
         raise ValueError(f"Site {name} is down")
 
-    method_fn = {
-        "get": requests.get,
-        "post": requests.post,
-    }
-
-    req_headers = (headers or {}) | {"Authorization": password}
+    route = route_of(endpoint)
+    start = perf_counter()
+    with tracer.span(
+        "request", site=site_id, method=method, endpoint=endpoint
+    ) as span, track_request(site_id):
+        req_headers = (
+            (headers or {})
+            | trace_headers()
+            | {"Authorization": password, HLC_HEADER: str(clock.now())}
+        )
 
-    r = method_fn[method](
-        f"http://{ip}:12117{endpoint}",
-        params=params,
-        headers=req_headers,
-        json=json,
-    )
+        r = transport(
+            ip,
+            method,
+            endpoint,
+            params=params,
+            headers=req_headers,
+            json=json,
+            timeout=timeout,
+        )
+        span.set(status=r.status_code, response_bytes=len(r.content))
+    client_request_seconds.observe(perf_counter() - start, site=name, route=route)
+    client_requests.inc(site=name, route=route, status=r.status_code)
+    if HLC_HEADER in r.headers:
+        clock.update(int(r.headers[HLC_HEADER]))
     return r
 
 
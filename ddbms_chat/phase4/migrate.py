@@ -0,0 +1,636 @@
+"""
+online migration of fragments between sites, and a rebalancer proposing them
+
+a migration copies a fragment to its new site while writes to it go on:
+
+1. the old site opens a snapshot of the fragment and captures the statements
+   committed to it from then on
+2. the new site fetches the fragment as of the snapshot
+3. the captured statements are replayed at the new site, in rounds, until few
+   are left
+4. cutover: writes to the fragment vote abort at the old site, the last
+   captured statements are replayed and the allocation changes on all sites
+   in one 2pc transaction
+5. once every node has reloaded the catalog, the old copy is dropped
+
+writes to the fragment only abort during the cutover, and on nodes that
+haven't reloaded the catalog yet. bulk loads write fragments without
+transactions and must not run during a migration
+
+hash fragmented (CH) tables also grow by a fragment on a new site: it takes an
+even share of the slots of the others, and the rows of those slots, with the
+rows derived from them, move to it in one 2pc transaction together with the
+catalog change
+"""
+import argparse
+from dataclasses import dataclass, replace
+from datetime import datetime
+from secrets import token_hex
+from time import sleep, time
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from ddbms_chat.config import HOSTNAME
+from ddbms_chat.models.syscat import Allocation, Fragment, Table
+from ddbms_chat.phase1.app_tables import setup_tables
+from ddbms_chat.phase2.ingest import insert_rows_sql
+from ddbms_chat.phase2.routing import (
+    HashSlots,
+    format_slots,
+    get_router,
+    hash_keys,
+    split_slots,
+)
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.phase3.utils import send_request_to_site
+from ddbms_chat.phase4.utils import commit_statements, run_2pc
+from ddbms_chat.utils import DBConnection, PyQL, debug_log
+
+# captured statements left after a catch-up round for the fragment to freeze
+CATCH_UP_THRESHOLD = 32
+CATCH_UP_ROUNDS = 20
+# statements replayed in one local transaction
+REPLAY_BATCH = 500
+# times a step that aborts because a site is busy is tried
+ATTEMPTS = 10
+
+# statistics of /stats making up the load of a fragment
+LOAD_KEYS = ("reads", "writes")
+
+
+def _new_id() -> str:
+    sites = catalog.sites.where(name=HOSTNAME)
+    site_id = sites[0].id if len(sites) > 0 else catalog.sites[0].id
+    return f"q{token_hex(3)}s{site_id}"
+
+
+def _post(site_id: int, endpoint: str, payload: Optional[Dict] = None) -> Dict:
+    r = send_request_to_site(site_id, "post", endpoint, json=payload or {})
+    if not r.ok:
+        raise ValueError(f"{endpoint} failed at site {site_id}: {r.text}")
+    return r.json()
+
+
+def _retry(run, what: str):
+    """
+    run `run` until it doesn't abort, waiting longer after every abort
+    """
+    for attempt in range(ATTEMPTS):
+        outcome = run()
+        if outcome != "abort":
+            return outcome
+        sleep(0.05 * 2**attempt)
+
+    raise ValueError(f"{what} aborted {ATTEMPTS} times")
+
+
+def _replay(site_id: int, statements: List[Dict]):
+    """
+    run captured statements at `site_id`, in order
+    """
+    for i in range(0, len(statements), REPLAY_BATCH):
+        batch = statements[i : i + REPLAY_BATCH]
+        _retry(
+            lambda: commit_statements(_new_id(), {site_id: batch}),
+            f"Replaying statements at site {site_id}",
+        )
+
+
+def _catch_up(fragment: Fragment, from_site: int, to_site: int, position: int) -> int:
+    """
+    replay the captured writes from `position` on, returns the new position
+    """
+    captured = _post(
+        from_site, "/migrate/changes", {"fragment": fragment.name, "after": position}
+    )
+    if captured["incomplete"]:
+        raise ValueError(
+            f"Site {from_site} committed writes it can't replay, restart the migration"
+        )
+
+    _replay(to_site, captured["changes"])
+    debug_log("Replayed %s statements to %s", len(captured["changes"]), fragment.name)
+    return captured["position"]
+
+
+def _reallocate(fragment: Fragment, from_site: int, to_site: int):
+    """
+    move the copy of the fragment on `from_site` to `to_site` in the catalog,
+    on every site at once
+    """
+    if catalog.installed:
+        allocation = PyQL(
+            [
+                Allocation(
+                    a.fragment,
+                    to_site
+                    if a.fragment == fragment.id and a.site == from_site
+                    else a.site,
+                )
+                for a in catalog.allocation
+            ]
+        )
+        catalog.install((allocation, *catalog.relations[1:]))
+        return
+
+    version = int(time() * 1000)
+    statements = [
+        {
+            "sql": f"update `allocation` set `site` = {to_site} "
+            f"where `fragment` = {fragment.id} and `site` = {from_site}"
+        },
+        {"sql": f"update `syscat_version` set `version` = {version} where `id` = 1"},
+    ]
+    # a commit that isn't acknowledged yet is still a commit, recovery sends it
+    _retry(
+        lambda: run_2pc(_new_id(), {site.id: statements for site in catalog.sites}),
+        "Changing the allocation",
+    )
+    catalog.refresh(force=True)
+
+
+def migrate_fragment(
+    fragment_name: str, to_site: int, from_site: Optional[int] = None
+) -> int:
+    """
+    move the fragment's copy on `from_site` (its only one by default) to
+    `to_site` while writes go on, returns the number of writes replayed
+    """
+    fragments = catalog.fragments.where(name=fragment_name)
+    if len(fragments) == 0:
+        raise ValueError(f"Fragment {fragment_name} not found")
+    fragment: Fragment = fragments[0]
+
+    table = catalog.tables.where(id=fragment.table)[0]
+    if table.fragment_type == "B":
+        raise ValueError(f"{table.name} is broadcast, every site stores it")
+
+    replicas = catalog.replicas(fragment.id)
+    if from_site is None:
+        if len(replicas) > 1:
+            raise ValueError(f"{fragment_name} has replicas on sites {replicas}")
+        from_site = replicas[0]
+    if from_site not in replicas:
+        raise ValueError(f"Site {from_site} doesn't store {fragment_name}")
+    if to_site in replicas:
+        raise ValueError(f"Site {to_site} already stores {fragment_name}")
+    to = catalog.sites.where(id=to_site)
+    if len(to) == 0:
+        raise ValueError(f"Site {to_site} not found")
+
+    migration_id = _new_id()
+    debug_log("Migration %s of %s", migration_id, fragment_name)
+
+    # a copy left behind by a failed migration
+    with DBConnection(to[0]) as cursor:
+        cursor.execute(f"drop table if exists `{fragment.name}`")
+    setup_tables(
+        PyQL([fragment]),
+        catalog.tables,
+        catalog.columns,
+        PyQL([Allocation(fragment.id, to_site)]),
+        catalog.sites,
+    )
+
+    _post(
+        from_site,
+        "/migrate/start",
+        {"migration_id": migration_id, "fragment": fragment.name},
+    )
+    try:
+        copy_name = f"{migration_id}_copy-{fragment.name}"
+        _post(
+            to_site,
+            "/exec/fetch",
+            {
+                "relation_name": fragment.name,
+                "site_id": from_site,
+                "target_relation_name": copy_name,
+            },
+        )
+        copy_sql = f"insert into `{fragment.name}` select * from `{copy_name}`"
+        _replay(to_site, [{"sql": copy_sql}])
+        # drops the copies and closes the snapshot
+        for site_id in (from_site, to_site):
+            _post(site_id, f"/cleanup/{migration_id}")
+
+        position = 0
+        for _ in range(CATCH_UP_ROUNDS):
+            new_position = _catch_up(fragment, from_site, to_site, position)
+            caught_up = new_position - position <= CATCH_UP_THRESHOLD
+            position = new_position
+            if caught_up:
+                break
+
+        _post(from_site, "/migrate/freeze", {"fragment": fragment.name})
+        position = _catch_up(fragment, from_site, to_site, position)
+        _reallocate(fragment, from_site, to_site)
+    except Exception:
+        for site_id, endpoint in [
+            (from_site, "/migrate/finish"),
+            (from_site, f"/cleanup/{migration_id}"),
+            (to_site, f"/cleanup/{migration_id}"),
+        ]:
+            try:
+                _post(site_id, endpoint, {"fragment": fragment.name})
+            except Exception as e:
+                print(e)
+        with DBConnection(to[0]) as cursor:
+            cursor.execute(f"drop table if exists `{fragment.name}`")
+        raise
+
+    # nodes that haven't reloaded the catalog still read the old copy
+    if not catalog.installed:
+        sleep(2 * catalog.refresh_interval)
+    _post(from_site, "/migrate/finish", {"fragment": fragment.name, "drop": True})
+
+    debug_log("Moved %s from site %s to %s", fragment_name, from_site, to_site)
+    return position
+
+
+def _fragment_name(table: Table) -> str:
+    names = {f.name for f in catalog.fragments}
+    n = len(catalog.fragments.where(table=table.id)) + 1
+    while f"{table.name}_{n}" in names:
+        n += 1
+    return f"{table.name}_{n}"
+
+
+def _json_value(value):
+    if type(value) is datetime:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _moving_rows(fragment: Fragment, key: str, slots: List[int], n_slots: int):
+    """
+    rows of the fragment whose `key` hashes to one of `slots`
+    """
+    site = catalog.sites.where(id=catalog.replicas(fragment.id)[0])[0]
+    with DBConnection(site) as cursor:
+        cursor.execute(f"select * from `{fragment.name}`")
+        rows = cursor.fetchall()
+    if len(rows) == 0:
+        return []
+
+    keys = np.array([row[key] for row in rows])
+    moving = np.isin(hash_keys(keys) % np.uint64(n_slots), slots)
+    return [row for row, move in zip(rows, moving) if move]
+
+
+def split_hash_fragments(table_name: str, site_id: int) -> int:
+    """
+    add a fragment of hash fragmented `table_name` on `site_id`, and one of
+    every table derived from it, returns the number of rows moved
+
+    writes to the fragments giving up slots abort from the start until every
+    node has reloaded the catalog
+    """
+    tables = catalog.tables.where(name=table_name)
+    if len(tables) == 0 or tables[0].fragment_type != "CH":
+        raise ValueError(f"{table_name} isn't hash fragmented")
+    table: Table = tables[0]
+    if len(catalog.sites.where(id=site_id)) == 0:
+        raise ValueError(f"Site {site_id} not found")
+
+    router = get_router(table_name)
+    slots = [HashSlots(f.logic).slots for f in router.fragments]
+    remaining, taken = split_slots(slots, router.n_slots)
+    if len(taken) == 0:
+        raise ValueError(f"{table_name} has no slots left to give")
+
+    column = router.columns[0]
+    # fragment id -> its new logic and the slots it gives up
+    logic: Dict[int, str] = {}
+    given: Dict[int, List[int]] = {}
+    for fragment, before, after in zip(router.fragments, slots, remaining):
+        if len(after) < len(before):
+            logic[fragment.id] = f"{column}#{router.n_slots}:{format_slots(after)}"
+            given[fragment.id] = sorted(set(before) - set(after))
+
+    next_id = max(f.id for f in catalog.fragments) + 1
+    fragment = Fragment(
+        next_id,
+        _fragment_name(table),
+        f"{column}#{router.n_slots}:{format_slots(taken)}",
+        next_id,
+        table.id,
+    )
+    new_fragments = [fragment]
+    # (fragment, fragment its rows move to, key column, slots moving)
+    moves = [
+        (f, fragment, column, given[f.id]) for f in router.fragments if f.id in given
+    ]
+
+    children: Set[str] = set()
+    for child in catalog.tables.where(fragment_type="DH"):
+        child_router = get_router(child.name)
+        if child_router.parent.table.id != table.id:
+            continue
+        children.add(child.name)
+        child_fragment = Fragment(
+            next_id + len(new_fragments),
+            _fragment_name(child),
+            child_router.fragments[0].logic,
+            fragment.id,
+            child.id,
+        )
+        new_fragments.append(child_fragment)
+        moves += [
+            (f, child_fragment, child_router.orig_key, given[f.parent])
+            for f in child_router.fragments
+            if f.parent in given
+        ]
+    for other in catalog.tables.where(fragment_type="DH"):
+        if get_router(other.name).parent.table.name in children:
+            raise ValueError(f"Splitting {table_name} can't move {other.name}")
+
+    split_id = _new_id()
+    debug_log("Split %s of %s to site %s", split_id, table_name, site_id)
+
+    # copies left behind by a failed split
+    site = catalog.sites.where(id=site_id)[0]
+    with DBConnection(site) as cursor:
+        for f in new_fragments:
+            cursor.execute(f"drop table if exists `{f.name}`")
+    allocation = [Allocation(f.id, site_id) for f in new_fragments]
+    setup_tables(
+        PyQL(new_fragments),
+        catalog.tables,
+        catalog.columns,
+        PyQL(allocation),
+        catalog.sites,
+    )
+
+    # (site, fragment) giving up rows, writes to them vote abort
+    frozen = [
+        (replica, f.name) for f, *_ in moves for replica in catalog.replicas(f.id)
+    ]
+    moved = 0
+    try:
+        for replica, name in frozen:
+            _post(
+                replica,
+                "/migrate/start",
+                {"migration_id": split_id, "fragment": name, "snapshot": False},
+            )
+        for replica, name in frozen:
+            _post(replica, "/migrate/freeze", {"fragment": name})
+
+        statements: Dict[int, List[Dict]] = {}
+        for f, to, key, given_slots in moves:
+            rows = _moving_rows(f, key, given_slots, router.n_slots)
+            if len(rows) == 0:
+                continue
+            moved += len(rows)
+
+            pkeys = [c.name for c in catalog.columns.where(table=f.table, pk=1)]
+            delete = {
+                "sql": f"delete from `{f.name}` where "
+                + " and ".join(f"`{c}` = %s" for c in pkeys),
+                "args": [[_json_value(row[c]) for c in pkeys] for row in rows],
+            }
+            for replica in catalog.replicas(f.id):
+                statements.setdefault(replica, []).append(delete)
+
+            columns = list(rows[0])
+            statements.setdefault(site_id, []).append(
+                {
+                    "sql": insert_rows_sql(to.name, columns),
+                    "args": [[_json_value(row[c]) for c in columns] for row in rows],
+                }
+            )
+
+        if not catalog.installed:
+            version = int(time() * 1000)
+            change = [
+                {
+                    "sql": "insert into `fragment` "
+                    "(`id`, `name`, `logic`, `parent`, `table`) "
+                    "values (%s, %s, %s, %s, %s)",
+                    "args": [
+                        [f.id, f.name, f.logic, f.parent, f.table]
+                        for f in new_fragments
+                    ],
+                },
+                {
+                    "sql": "update `fragment` set `logic` = %s where `id` = %s",
+                    "args": [
+                        [text, fragment_id] for fragment_id, text in logic.items()
+                    ],
+                },
+                {
+                    "sql": "insert into `allocation` (`fragment`, `site`) "
+                    "values (%s, %s)",
+                    "args": [[a.fragment, a.site] for a in allocation],
+                },
+                {
+                    "sql": f"update `syscat_version` set `version` = {version} "
+                    "where `id` = 1"
+                },
+            ]
+            for other in catalog.sites:
+                statements.setdefault(other.id, []).extend(change)
+
+        if statements:
+            attempts = iter(range(ATTEMPTS))
+            # a commit that isn't acknowledged yet is still a commit
+            _retry(
+                lambda: run_2pc(f"{split_id}-{next(attempts)}", statements),
+                f"Splitting {table_name}",
+            )
+
+        if catalog.installed:
+            fragments = [
+                replace(f, logic=logic[f.id]) if f.id in logic else f
+                for f in catalog.fragments
+            ]
+            catalog.install(
+                (
+                    PyQL(catalog.allocation.items + allocation),
+                    catalog.columns,
+                    PyQL(fragments + new_fragments),
+                    catalog.sites,
+                    catalog.tables,
+                )
+            )
+        else:
+            catalog.refresh(force=True)
+    except Exception:
+        for replica, name in frozen:
+            try:
+                _post(replica, "/migrate/finish", {"fragment": name})
+            except Exception as e:
+                print(e)
+        with DBConnection(site) as cursor:
+            for f in new_fragments:
+                cursor.execute(f"drop table if exists `{f.name}`")
+        raise
+
+    # nodes that haven't reloaded the catalog route to the old fragments
+    if not catalog.installed:
+        sleep(2 * catalog.refresh_interval)
+    for replica, name in frozen:
+        _post(replica, "/migrate/finish", {"fragment": name})
+
+    debug_log("Split %s to %s, moved %s rows", table_name, fragment.name, moved)
+    return moved
+
+
+@dataclass
+class Move:
+    # a fragment and the fragments derived from it on the same site
+    fragments: List[str]
+    from_site: int
+    to_site: int
+    # reads and writes of the fragments
+    load: int
+    bytes: int
+
+
+def fetch_fragment_stats() -> Dict[int, Dict[str, Dict]]:
+    """
+    site id -> base fragment -> rows, bytes, reads and writes at the site
+    """
+    stats = {}
+    for site in catalog.sites:
+        r = send_request_to_site(site.id, "get", "/stats")
+        if not r.ok:
+            raise ValueError(f"Couldn't fetch statistics from site {site.id}")
+        stats[site.id] = r.json()
+
+    return stats
+
+
+def propose_moves(
+    stats: Dict[int, Dict[str, Dict]], tolerance: float = 0.2, max_moves: int = 4
+) -> List[Move]:
+    """
+    moves from the busiest site to the idlest one until no site has more than
+    `tolerance` above the mean load, or `max_moves`
+
+    a site's load is the reads and writes of the fragments it stores. a fragment
+    moves together with the fragments derived from it on the same site, so
+    the joins between them stay local. every move takes the unit whose load is
+    closest to half the difference between the two sites
+    """
+    # (site, fragment id of the unit) -> fragments of the unit
+    units: Dict[Tuple[int, int], List[Fragment]] = {}
+    for fragment in catalog.fragments:
+        table = catalog.tables.where(id=fragment.table)[0]
+        if table.fragment_type == "B":
+            continue
+        for site_id in catalog.replicas(fragment.id):
+            root = fragment.id
+            if table.fragment_type == "DH" and site_id in catalog.replicas(
+                fragment.parent
+            ):
+                root = fragment.parent
+            units.setdefault((site_id, root), []).append(fragment)
+
+    def measure(site_id: int, fragments: List[Fragment], keys: Tuple) -> int:
+        return sum(
+            stats.get(site_id, {}).get(f.name, {}).get(key, 0)
+            for f in fragments
+            for key in keys
+        )
+
+    site_load = {site.id: 0 for site in catalog.sites}
+    for (site_id, _), fragments in units.items():
+        site_load[site_id] += measure(site_id, fragments, LOAD_KEYS)
+
+    mean = sum(site_load.values()) / max(len(site_load), 1)
+    moves: List[Move] = []
+    while len(moves) < max_moves and mean > 0:
+        busiest = max(site_load, key=site_load.get)
+        idlest = min(site_load, key=site_load.get)
+        if site_load[busiest] <= mean * (1 + tolerance):
+            break
+
+        gap = site_load[busiest] - site_load[idlest]
+        candidates = [
+            (key, fragments, measure(busiest, fragments, LOAD_KEYS))
+            for key, fragments in units.items()
+            if key[0] == busiest
+            and not any(idlest in catalog.replicas(f.id) for f in fragments)
+        ]
+        # moving more than the gap only moves the imbalance
+        candidates = [c for c in candidates if 0 < c[2] < gap]
+        if len(candidates) == 0:
+            break
+
+        key, fragments, load = min(candidates, key=lambda c: abs(c[2] - gap / 2))
+        moves.append(
+            Move(
+                [f.name for f in fragments],
+                busiest,
+                idlest,
+                load,
+                measure(busiest, fragments, ("bytes",)),
+            )
+        )
+        del units[key]
+        units[(idlest, key[1])] = fragments
+        site_load[busiest] -= load
+        site_load[idlest] += load
+
+    return moves
+
+
+def rebalance(
+    tolerance: float = 0.2, max_moves: int = 4, apply: bool = False
+) -> List[Move]:
+    """
+    propose moves from the reads and writes every site served since its
+    daemon started, and with `apply` migrate them one fragment at a time
+    """
+    moves = propose_moves(fetch_fragment_stats(), tolerance, max_moves)
+    if apply:
+        for move in moves:
+            for fragment_name in move.fragments:
+                migrate_fragment(fragment_name, move.to_site, move.from_site)
+
+    return moves
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m ddbms_chat.phase4.migrate")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    move = commands.add_parser("move", help="move a fragment to another site")
+    move.add_argument("fragment")
+    move.add_argument("to_site", type=int)
+    move.add_argument(
+        "--from", dest="from_site", type=int, help="replica to move, if it has several"
+    )
+
+    balance = commands.add_parser(
+        "rebalance", help="propose moves evening out the load of the sites"
+    )
+    balance.add_argument("--tolerance", type=float, default=0.2)
+    balance.add_argument("--max-moves", type=int, default=4)
+    balance.add_argument("--apply", action="store_true", help="run the moves")
+
+    split = commands.add_parser(
+        "split", help="add a fragment of a hash fragmented table on a site"
+    )
+    split.add_argument("table")
+    split.add_argument("site", type=int)
+
+    args = parser.parse_args()
+    if args.command == "split":
+        moved = split_hash_fragments(args.table, args.site)
+        print(f"Added a fragment of {args.table} on site {args.site}")
+        print(f"Moved {moved} rows")
+    elif args.command == "move":
+        replayed = migrate_fragment(args.fragment, args.to_site, args.from_site)
+        print(f"Moved {args.fragment} to site {args.to_site}")
+        print(f"Replayed {replayed} writes committed while copying")
+    else:
+        for m in rebalance(args.tolerance, args.max_moves, args.apply):
+            print(
+                f"{'Moved' if args.apply else 'Move'} {', '.join(m.fragments)} "
+                f"from site {m.from_site} to {m.to_site}: "
+                f"{m.load} reads and writes, {m.bytes} bytes"
+            )
@@ -0,0 +1,57 @@
+"""
+snapshots of distributed reads
+
+a read picks a timestamp of the hybrid logical clock and opens a snapshot at
+every site it reads from. a site opens it once every transaction that
+prepared there before the timestamp is decided, and only if it hasn't
+installed a commit with a later timestamp, so the snapshots of all sites hold
+exactly the transactions committed at or before the timestamp (clock-si).
+the snapshot itself is the database's own multiversioning: a consistent
+snapshot transaction in mysql, a read transaction on the write-ahead log in
+sqlite. writers don't wait for snapshots and snapshots don't wait for writers
+"""
+from threading import Lock
+from time import time
+from typing import Dict, List
+
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.utils import DBConnection, debug_log
+
+
+class ReadSnapshot:
+    """
+    the state of `site` as of hybrid logical clock timestamp `ts`
+    """
+
+    def __init__(self, site: Site, ts: int):
+        self.site = site
+        self.ts = ts
+        self.opened_at = time()
+        self.connection = DBConnection(site)
+        self.cursor = self.connection.__enter__()
+        # the steps of a query don't share the connection at the same time
+        self.lock = Lock()
+        self.closed = False
+
+        if getattr(self.cursor, "dialect", "mysql") == "mysql":
+            self.cursor.execute("start transaction with consistent snapshot, read only")
+        else:
+            # the first read fixes the snapshot of a deferred transaction
+            self.cursor.execute("begin")
+            self.cursor.execute("select count(*) from sqlite_master")
+
+    def select(self, sql: str) -> List[Dict]:
+        debug_log(sql)
+        with self.lock:
+            self.cursor.execute(sql)
+            return list(self.cursor.fetchall())
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            try:
+                self.cursor.execute("rollback")
+            finally:
+                self.connection.__exit__(None, None, None)
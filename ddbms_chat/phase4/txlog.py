@@ -0,0 +1,220 @@
+"""
+append-only transaction logs of 2pc coordinators and participants
+
+every record is one json line. records a recovery depends on (the
+coordinator's commit decision, a participant's vote to commit) are forced:
+`write` returns once they are on disk. concurrent transactions share their
+fsyncs, the thread that syncs makes the records every other thread appended
+so far durable too (group commit), so a busy node pays far fewer fsyncs than
+it forces records
+
+every process writing a log holds a shared lock on it (a `.lock` file next to
+it) for as long as it runs. rewriting the log takes the lock exclusively, so
+it only happens while no other process has the log open
+"""
+import fcntl
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from threading import Condition
+from time import time
+from typing import Dict, List, Optional
+
+from ddbms_chat.config import COORDINATOR_TX_LOG_PATH, PARTICIPANT_TX_LOG_PATH
+from ddbms_chat.metrics import Counter, Histogram
+
+# coordinator: begin_commit, commit, abort, one_phase_commit, end_of_transaction
+# participant: vote-commit, vote-abort, vote-read-only, commit, abort
+RECORD_TYPES = {
+    "begin_commit",
+    "commit",
+    "abort",
+    "one_phase_commit",
+    "end_of_transaction",
+    "vote-commit",
+    "vote-abort",
+    "vote-read-only",
+}
+
+fsyncs = Counter("ddbms_chat_txlog_fsyncs_total", "fsyncs of transaction logs", ["log"])
+fsync_records = Histogram(
+    "ddbms_chat_txlog_fsync_records",
+    "records made durable by one fsync of a transaction log",
+    ["log"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+
+@dataclass
+class TxRecord:
+    txid: str
+    type: str
+    # participant sites of the transaction on the coordinator's begin_commit,
+    # the sites that prepared on its commit
+    sites: List[int] = field(default_factory=list)
+    # site a participant record is written for
+    site: Optional[int] = None
+    # why a participant voted to abort
+    reason: Optional[str] = None
+    # hybrid logical clock timestamp of the coordinator's commit
+    ts: Optional[int] = None
+    time: float = field(default_factory=time)
+
+    def __post_init__(self):
+        if self.type not in RECORD_TYPES:
+            raise ValueError(f"Unknown transaction log record type {self.type}")
+
+
+class TxLog:
+    def __init__(self, path: Path, name: str):
+        self.path = Path(path)
+        self.name = name
+        self._file = None
+        self._cond = Condition()
+        # records appended and records known to be on disk
+        self._written = 0
+        self._durable = 0
+        self._syncing = False
+        self._lock_file = None
+        self._exclusive = False
+
+    def _lock(self, operation: int) -> bool:
+        if self._lock_file is None:
+            self._lock_file = open(self.path.with_suffix(".lock"), "a")
+        try:
+            fcntl.flock(self._lock_file.fileno(), operation)
+        except BlockingIOError:
+            return False
+        return True
+
+    def lock_exclusive(self) -> bool:
+        """
+        lock the log for this process alone, held until `unlock_exclusive`.
+        False if another process uses the log, this one shares it then
+        """
+        with self._cond:
+            self._exclusive = self._lock(fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if not self._exclusive:
+                self._lock(fcntl.LOCK_SH)
+            return self._exclusive
+
+    def unlock_exclusive(self):
+        """
+        share the log with other processes again, this one keeps writing
+        """
+        with self._cond:
+            self._lock(fcntl.LOCK_SH)
+            self._exclusive = False
+
+    def reopen(self, path: Path):
+        """
+        continue the log in another file
+        """
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+                self._exclusive = False
+            self.path = Path(path)
+
+    def write(self, record: TxRecord, force: bool = False):
+        with self._cond:
+            if self._file is None:
+                if self._lock_file is None:
+                    # waits for a process rewriting the log
+                    self._lock(fcntl.LOCK_SH)
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(asdict(record)) + "\n")
+            # other processes (the status endpoint) read the file
+            self._file.flush()
+            self._written += 1
+            position = self._written
+
+            while force and self._durable < position:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+
+                # sync everything appended so far, others append meanwhile
+                self._syncing = True
+                target = self._written
+                fd = self._file.fileno()
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+
+                fsyncs.inc(log=self.name)
+                fsync_records.observe(target - self._durable, log=self.name)
+                self._durable = max(self._durable, target)
+
+    def records(self) -> List[TxRecord]:
+        with self._cond:
+            if self._file is not None:
+                self._file.flush()
+
+        if not self.path.exists():
+            return []
+
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(TxRecord(**json.loads(line)))
+                except (ValueError, TypeError):
+                    # a record torn by a crash, nothing after it was written
+                    break
+
+        return records
+
+    def compact(self, keep: List[str]):
+        """
+        drop the records of every transaction not in `keep`
+
+        needs the exclusive lock, the log is replaced by a new file
+        """
+        assert self._exclusive
+        records = [r for r in self.records() if r.txid in keep]
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(asdict(record)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp_path, self.path)
+
+
+def transaction_states(records: List[TxRecord]) -> Dict[str, List[TxRecord]]:
+    """
+    txid -> its records, in the order they were written
+    """
+    states: Dict[str, List[TxRecord]] = {}
+    for record in records:
+        states.setdefault(record.txid, []).append(record)
+    return states
+
+
+def decision_of(records: List[TxRecord]) -> Optional[str]:
+    """
+    "commit" or "abort" if the records contain the decision
+    """
+    for record in reversed(records):
+        if record.type in ("commit", "abort"):
+            return record.type
+    return None
+
+
+coordinator_log = TxLog(COORDINATOR_TX_LOG_PATH, "coordinator")
+participant_log = TxLog(PARTICIPANT_TX_LOG_PATH, "participant")
@@ -1,70 +1,493 @@
-from ddbms_chat.phase2.syscat import read_syscat
-from ddbms_chat.phase3.utils import send_request_to_site
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+from threading import Thread
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from ddbms_chat.config import TX_EARLY_REPLY, TX_PRESUMED_ABORT, TX_TIMEOUT
+from ddbms_chat.hlc import clock
+from ddbms_chat.models.query import (
+    Condition,
+    ConditionAnd,
+    ConditionOr,
+    InsertQuery,
+    UpdateQuery,
+)
+from ddbms_chat.models.syscat import Fragment
+from ddbms_chat.phase2.fast_parser import (
+    parse_insert_query,
+    parse_query,
+    parse_update_query,
+)
+from ddbms_chat.phase2.ingest import insert_rows_sql
+from ddbms_chat.phase2.routing import candidate_fragments, get_router, literal_value
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.phase3.utils import (
+    construct_select_condition_string,
+    send_request_to_site,
+)
+from ddbms_chat.phase4.txlog import (
+    TxRecord,
+    coordinator_log,
+    decision_of,
+    transaction_states,
+)
 from ddbms_chat.utils import debug_log
 
-syscat_allocation, _, syscat_fragment, _, syscat_table = read_syscat()
 
-tx_log_file = open("tx-coordinator.log", "w+")
+def _add_statement(statements: Dict[int, List[Dict]], fragment: Fragment, statement):
+    """
+    write `statement` to every replica of the fragment
+    """
+    for site in catalog.replicas(fragment.id):
+        statements.setdefault(site, []).append(statement)
 
 
-def tx_2pc(update_sql: str, query_id: str):
-    split_sql = update_sql.strip().split()
-    relation_name = split_sql[1].strip("`")
-    table_id = syscat_table.where(name=relation_name)[0].id
-    fragments = syscat_fragment.where(table=table_id)
+def _fan_out(
+    endpoint: str, payloads: Dict[int, Dict], wait_for_replies: bool = True
+) -> Dict[int, Optional[str]]:
+    """
+    post `payloads` to their sites concurrently
 
-    debug_log("Found %s fragments: %s", len(fragments), fragments.items)
+    returns the response of every site, None if its request failed or didn't
+    finish within TX_TIMEOUT seconds. without `wait_for_replies` the requests
+    are only sent, and nothing is returned
+    """
 
-    tx_log_file.write(f"{query_id}: begin_commit\n")
+    def send(site: int, payload: Dict) -> str:
+        r = send_request_to_site(
+            site, "post", endpoint, json=payload, timeout=TX_TIMEOUT
+        )
+        if not r.ok:
+            debug_log("%s failed at site %s\n%s", endpoint, site, r.reason)
+            raise ValueError("Request failed")
+        debug_log("Got response %s from site %s", r.text, site)
+        return r.text
 
-    responses = []
-    for frag in fragments:
-        sql = " ".join([split_sql[0], f"`{frag.name}`", *split_sql[2:]])
-        site = syscat_allocation.where(fragment=frag.id)[0].site
+    if len(payloads) == 0:
+        return {}
 
-        try:
-            r = send_request_to_site(
-                site, "post", "/2pc/prepare", json={"sql": sql, "txid": query_id}
-            )
-            if not r.ok:
-                debug_log("Failed in prepare\n%s", (r.reason,))
-                raise ValueError("Request failed")
-            debug_log("Got response %s", (r.text,))
-            responses.append(r.text)
-        except Exception as e:
-            print(e)
-            tx_log_file.write(f"{query_id}: abort\n")
-            tx_log_file.write(f"{query_id}: end_of_transaction\n")
-            return
-
-    for frag in fragments:
-        site = syscat_allocation.where(fragment=frag.id)[0].site
-
-        if not all(x == "vote-commit" for x in responses):
-            debug_log("Global abort, not all did vote-commit")
-            try:
-                r = send_request_to_site(
-                    site, "post", "/2pc/global-abort", json={"txid": query_id}
-                )
-                if not r.ok:
-                    debug_log("global-abort failed\n%s", (r.reason,))
-                    raise ValueError("Request failed")
-            except Exception as e:
-                debug_log("aborted")
-                tx_log_file.write(f"{query_id}: abort\n")
-                tx_log_file.write(f"{query_id}: end_of_transaction\n")
-                print(e)
-                return
+    executor = ThreadPoolExecutor(max_workers=len(payloads), thread_name_prefix="2pc")
+    # copy the context so the requests carry the trace of this transaction
+    futures = {
+        site: executor.submit(copy_context().run, send, site, payload)
+        for site, payload in payloads.items()
+    }
+    if not wait_for_replies:
+        executor.shutdown(wait=False)
+        return {}
+
+    done, _ = wait(futures.values(), timeout=TX_TIMEOUT)
+    # requests that timed out finish in the background
+    executor.shutdown(wait=False)
+
+    responses: Dict[int, Optional[str]] = {}
+    for site, future in futures.items():
+        if future not in done:
+            print(f"{endpoint} timed out at site {site}")
+            responses[site] = None
+        elif future.exception() is not None:
+            print(future.exception())
+            responses[site] = None
         else:
-            debug_log("Global commit")
-            try:
-                r = send_request_to_site(
-                    site, "post", "/2pc/global-commit", json={"txid": query_id}
+            responses[site] = future.result()
+
+    return responses
+
+
+def _send_commit(query_id: str, sites: List[int], commit_ts: Optional[int]) -> str:
+    acks = _fan_out(
+        "/2pc/global-commit",
+        {site: {"txid": query_id, "commit_ts": commit_ts} for site in sites},
+    )
+    if None in acks.values():
+        # recovery sends the decision again
+        return "failed"
+
+    coordinator_log.write(TxRecord(query_id, "end_of_transaction"))
+    return "commit"
+
+
+def run_2pc(
+    query_id: str,
+    statements: Dict[int, List[Dict]],
+    presumed_abort: bool = TX_PRESUMED_ABORT,
+    early_reply: bool = TX_EARLY_REPLY,
+) -> str:
+    """
+    two phase commit of the statements (sql and optional rows for executemany)
+    of every participating site, each site prepares all of its statements in
+    one request
+
+    both phases contact all participants concurrently, a participant that
+    doesn't vote within TX_TIMEOUT seconds votes to abort. participants that
+    vote abort have already aborted and participants that changed nothing
+    vote read-only and have already committed, neither takes part in the
+    second phase
+
+    with `presumed_abort`, a transaction the coordinator has no decision for
+    counts as aborted: only commits are forced to the log and acknowledged,
+    aborts are sent without waiting. with `early_reply`, the outcome is
+    returned once the commit decision is durable and the participants learn it
+    in the background
+
+    returns the outcome: "commit", "abort" or "failed" (a participant did not
+    acknowledge the commit)
+    """
+    # participants recovering from a crash ask for the decision. the record
+    # only tells them it is pending, with presumed abort it needn't survive a
+    # crash of this node
+    coordinator_log.write(
+        TxRecord(query_id, "begin_commit", sites=list(statements)),
+        force=not presumed_abort,
+    )
+
+    votes = _fan_out(
+        "/2pc/prepare",
+        {
+            site: {"txid": query_id, "statements": site_statements}
+            for site, site_statements in statements.items()
+        },
+    )
+
+    if not all(vote in ("vote-commit", "vote-read-only") for vote in votes.values()):
+        debug_log("Global abort, not all did vote-commit")
+        coordinator_log.write(TxRecord(query_id, "abort"), force=not presumed_abort)
+
+        # participants that timed out may still have prepared, read-only ones
+        # already left the transaction
+        sites = [site for site, vote in votes.items() if vote in ("vote-commit", None)]
+        payloads = {site: {"txid": query_id} for site in sites}
+        if presumed_abort:
+            _fan_out("/2pc/global-abort", payloads, wait_for_replies=False)
+            coordinator_log.write(TxRecord(query_id, "end_of_transaction"))
+        elif None not in _fan_out("/2pc/global-abort", payloads).values():
+            coordinator_log.write(TxRecord(query_id, "end_of_transaction"))
+        return "abort"
+
+    sites = [site for site, vote in votes.items() if vote == "vote-commit"]
+    if len(sites) == 0:
+        debug_log("All participants read-only")
+        coordinator_log.write(TxRecord(query_id, "end_of_transaction"))
+        return "commit"
+
+    debug_log("Global commit")
+    # the votes carried the clocks of the participants, the commit is ordered
+    # after every prepare
+    commit_ts = clock.now()
+    # a commit decision must survive a crash before any participant learns it
+    coordinator_log.write(
+        TxRecord(query_id, "commit", sites=sites, ts=commit_ts), force=True
+    )
+
+    if early_reply:
+        Thread(
+            target=copy_context().run, args=(_send_commit, query_id, sites, commit_ts)
+        ).start()
+        return "commit"
+
+    return _send_commit(query_id, sites, commit_ts)
+
+
+def _condition_columns(
+    condition: Union[Condition, ConditionAnd, ConditionOr, None]
+) -> Set[str]:
+    if condition is None:
+        return set()
+
+    if type(condition) is Condition:
+        return {
+            side.split(".", 1)[1]
+            for side in (condition.lhs, condition.rhs)
+            if literal_value(side) is None and "." in side
+        }
+
+    return set().union(*[_condition_columns(c) for c in condition.conditions])
+
+
+def localize_update(update: UpdateQuery) -> Dict[int, List[Dict]]:
+    """
+    site id -> statements running `update` on the fragments it can change
+
+    horizontal and derived horizontal fragments are pruned with the where
+    condition, vertical fragments that hold none of the updated columns are
+    skipped and the others only set their own columns
+    """
+    table = catalog.tables.where(name=update.table)[0]
+    fragments = catalog.fragments.where(table=table.id)
+    where_columns = _condition_columns(update.where)
+    where_sql = (
+        f" where {construct_select_condition_string(update.where)}"
+        if update.where is not None
+        else ""
+    )
+
+    # fragment -> columns it sets
+    targets: List[Tuple[Fragment, List[str]]] = []
+
+    if table.fragment_type == "V":
+        for fragment in fragments:
+            fragment_columns = fragment.logic.split(",")
+            columns = [c for c in update.assignments if c in fragment_columns]
+            if len(columns) == 0:
+                continue
+
+            missing = where_columns - set(fragment_columns)
+            if missing:
+                raise ValueError(
+                    f"Updates of {columns} in {table.name} can't filter on {missing}, "
+                    f"they are in other fragments than {fragment.name}"
                 )
-                if not r.ok:
-                    raise ValueError("Request failed")
-            except Exception as e:
-                tx_log_file.write(f"{query_id}: failed\n")
-                tx_log_file.write(f"{query_id}: end_of_transaction\n")
-                print(e)
-                return
+            targets.append((fragment, columns))
+    elif table.fragment_type in ("H", "CH", "DH"):
+        router = get_router(table.name)
+        moved = [c for c in update.assignments if c in router.columns]
+        if moved:
+            raise ValueError(
+                f"Can't update {moved} in {table.name}, rows would change fragments"
+            )
+
+        fragment_ids = None
+        if update.where is not None:
+            fragment_ids = candidate_fragments(router, update.where)
+        targets = [
+            (fragment, list(update.assignments))
+            for fragment in fragments
+            if fragment_ids is None or fragment.id in fragment_ids
+        ]
+    else:
+        targets = [(fragment, list(update.assignments)) for fragment in fragments]
+
+    debug_log("Updating fragments %s", [f.name for f, _ in targets])
+
+    statements: Dict[int, List[Dict]] = {}
+    for fragment, columns in targets:
+        assignments = ", ".join(f"`{c}` = {update.assignments[c]}" for c in columns)
+        sql = f"update `{fragment.name}` set {assignments}{where_sql}"
+        _add_statement(statements, fragment, {"sql": sql})
+
+    return statements
+
+
+def tx_2pc(update_sql: str, query_id: str) -> str:
+    """
+    run an update on the fragments it can change, with two phase commit if
+    they are on more than one site
+
+    an update pruned to the fragments of a single site commits in one local
+    transaction, like single site inserts. returns the outcome: "commit",
+    "abort" or "failed" (a participant did not acknowledge the commit)
+    """
+    statements = localize_update(parse_update_query(update_sql))
+
+    debug_log("Updating at sites %s", list(statements))
+
+    # no statements if no fragment can hold a matching row
+    return commit_statements(query_id, statements)
+
+
+def route_insert(insert: InsertQuery) -> Dict[int, List[Dict]]:
+    """
+    site id -> parameterized statements (sql and rows) inserting the rows of
+    `insert` into the fragments they belong to, one statement per fragment
+    """
+    table = catalog.tables.where(name=insert.table)[0]
+    fragments = catalog.fragments.where(table=table.id)
+
+    # fragment id -> (fragment, columns, rows)
+    fragment_rows: Dict[int, Tuple[Fragment, List[str], List[List]]] = {}
+
+    if table.fragment_type in ("-", "B"):
+        fragment_rows[fragments[0].id] = (fragments[0], insert.columns, insert.rows)
+    elif table.fragment_type == "V":
+        for fragment in fragments:
+            columns = [c for c in fragment.logic.split(",") if c in insert.columns]
+            indexes = [insert.columns.index(c) for c in columns]
+            rows = [[row[i] for i in indexes] for row in insert.rows]
+            fragment_rows[fragment.id] = (fragment, columns, rows)
+    elif table.fragment_type in ("H", "CH", "DH"):
+        router = get_router(table.name)
+        missing = [c for c in router.columns if c not in insert.columns]
+        if missing:
+            raise ValueError(f"Inserts into {table.name} need values for {missing}")
+
+        for row in insert.rows:
+            fragment = router.route(dict(zip(insert.columns, row)))
+            if fragment.id not in fragment_rows:
+                fragment_rows[fragment.id] = (fragment, insert.columns, [])
+            fragment_rows[fragment.id][2].append(row)
+    else:
+        raise ValueError(f"Unknown fragment type {table.fragment_type}")
+
+    statements: Dict[int, List[Dict]] = {}
+    for fragment, columns, rows in fragment_rows.values():
+        _add_statement(
+            statements,
+            fragment,
+            {"sql": insert_rows_sql(fragment.name, columns), "args": rows},
+        )
+
+    return statements
+
+
+def commit_statements(query_id: str, statements: Dict[int, List[Dict]]) -> str:
+    """
+    run the statements of every site as one transaction, in one local
+    transaction when there is a single site and with two phase commit
+    otherwise. returns the outcome like `tx_2pc`
+    """
+    if len(statements) == 0:
+        return "commit"
+
+    if len(statements) > 1:
+        return run_2pc(query_id, statements)
+
+    [(site, site_statements)] = statements.items()
+    coordinator_log.write(TxRecord(query_id, "one_phase_commit", sites=[site]))
+    try:
+        r = send_request_to_site(
+            site,
+            "post",
+            "/1pc/commit",
+            json={"txid": query_id, "statements": site_statements},
+        )
+        if not r.ok:
+            raise ValueError("Request failed")
+        outcome = r.text
+    except Exception as e:
+        print(e)
+        outcome = "abort"
+
+    # the site committed or aborted on its own, nothing to recover
+    coordinator_log.write(TxRecord(query_id, outcome))
+    coordinator_log.write(TxRecord(query_id, "end_of_transaction"))
+    return outcome
+
+
+def tx_insert(insert_sql: str, query_id: str) -> str:
+    """
+    insert rows into the fragments they belong to
+
+    the rows of a single site are committed in one local transaction, inserts
+    spanning sites (vertical fragments, rows of several horizontal fragments)
+    use two phase commit. returns the outcome like `tx_2pc`
+    """
+    statements = route_insert(parse_insert_query(insert_sql))
+
+    debug_log("Inserting at sites %s", list(statements))
+
+    return commit_statements(query_id, statements)
+
+
+def localize_statement(sql: str) -> Dict[int, List[Dict]]:
+    """
+    site id -> statements running the update or insert `sql` on the fragments
+    it writes
+    """
+    query = parse_query(sql)
+    if type(query) is UpdateQuery:
+        return localize_update(query)
+    if type(query) is InsertQuery:
+        return route_insert(query)
+
+    raise ValueError("Only updates and inserts can be part of a transaction")
+
+
+def tx_batch(sqls: List[str], query_id: str) -> str:
+    """
+    run updates and inserts, possibly of different tables, as one transaction
+
+    the statements are grouped by site, every participant prepares all of its
+    statements, in the order they were given, in one request. returns the
+    outcome like `tx_2pc`
+    """
+    statements: Dict[int, List[Dict]] = {}
+    for sql in sqls:
+        for site, site_statements in localize_statement(sql).items():
+            statements.setdefault(site, []).extend(site_statements)
+
+    debug_log("Batch of %s statements at sites %s", len(sqls), list(statements))
+
+    return commit_statements(query_id, statements)
+
+
+def recover_transactions():
+    """
+    finish the two phase commits this node coordinated that were interrupted
+
+    undecided transactions are aborted, participants of decided ones get the
+    decision again. transactions whose participants can't be reached stay in
+    the log for the next recovery. skipped while another process on this node
+    uses the log, its transactions may still be running
+    """
+    if not coordinator_log.lock_exclusive():
+        print("Another coordinator is running on this node, skipping recovery")
+        return
+
+    try:
+        _recover_transactions()
+    finally:
+        coordinator_log.unlock_exclusive()
+
+
+def _recover_transactions():
+    unfinished = []
+    for txid, records in transaction_states(coordinator_log.records()).items():
+        if records[0].type == "one_phase_commit" or any(
+            r.type == "end_of_transaction" for r in records
+        ):
+            continue
+
+        decision = decision_of(records)
+        commit_ts = None
+        if decision == "commit":
+            # the participants that voted commit, begin_commit may be missing
+            # with presumed abort
+            commit_record = next(r for r in records if r.type == "commit")
+            sites, commit_ts = commit_record.sites, commit_record.ts
+        else:
+            if decision is None:
+                coordinator_log.write(TxRecord(txid, "abort"))
+            decision = "abort"
+            sites = records[0].sites
+
+        endpoint = "/2pc/global-commit" if decision == "commit" else "/2pc/global-abort"
+        acks = _fan_out(
+            endpoint, {site: {"txid": txid, "commit_ts": commit_ts} for site in sites}
+        )
+        if None in acks.values():
+            unfinished.append(txid)
+            continue
+
+        coordinator_log.write(TxRecord(txid, "end_of_transaction"))
+        print(f"Recovered {txid}: {decision}")
+
+    coordinator_log.compact(unfinished)
+
+
+# times a read asks its sites for a snapshot before giving up
+SNAPSHOT_ATTEMPTS = 5
+
+
+def open_snapshot(query_id: str, sites: Set[int]) -> int:
+    """
+    open snapshots of `sites` for the steps of query `query_id`, all at the
+    same timestamp, and return it
+
+    a site that already installed a commit after the timestamp refuses, the
+    read tries again with a later one. the snapshots are closed by /cleanup
+    """
+    for _ in range(SNAPSHOT_ATTEMPTS):
+        ts = clock.now()
+        replies = _fan_out(
+            "/snapshot/open",
+            {site: {"query_id": query_id, "ts": ts} for site in sites},
+        )
+        if None in replies.values():
+            raise ValueError(f"Couldn't open a snapshot for {query_id}")
+
+        if all(json.loads(reply)["opened"] for reply in replies.values()):
+            debug_log("Snapshot of %s at %s", query_id, ts)
+            return ts
+
+    raise ValueError(f"No snapshot for {query_id} after {SNAPSHOT_ATTEMPTS} attempts")
@@ -0,0 +1,115 @@
+"""
+local transactions of 2pc participants
+
+a participant runs the statements of a distributed transaction in an XA
+transaction (`XA START` ... `XA PREPARE`) and keeps it open until the
+coordinator's decision, so a write costs as much as the rows it touches and
+keeps the indexes and constraints of the fragment. sqlite (simulated sites)
+has no XA, there the prepared state is a write transaction held open on its
+own connection
+"""
+from typing import Dict, List, Optional
+
+from ddbms_chat.models.syscat import Site
+from ddbms_chat.utils import DBConnection, debug_log
+
+
+class LocalTransaction:
+    """
+    the part of distributed transaction `txid` that runs on `site`
+    """
+
+    def __init__(self, site: Site, txid: str):
+        self.site = site
+        self.txid = txid
+        self.connection = DBConnection(site)
+        self.cursor = self.connection.__enter__()
+        self.xa = getattr(self.cursor, "dialect", "mysql") == "mysql"
+        # "active", "prepared" or "closed"
+        self.status = "active"
+        # rows the statements changed, as reported by the database
+        self.rows_changed = 0
+        # hybrid logical clock timestamp of the prepare, snapshots at or after
+        # it wait for the decision
+        self.prepare_ts: Optional[int] = None
+        # statements it ran (sql and rows), replayed by fragment migrations
+        self.statements: List[Dict] = []
+
+        if self.xa:
+            self.cursor.execute("xa start %s", (txid,))
+        else:
+            # takes the database write lock now instead of at the first write
+            self.cursor.execute("begin immediate")
+
+    def execute(self, sql: str, args: Optional[List] = None):
+        debug_log(sql)
+        self.statements.append({"sql": sql, "args": args})
+        if args is None:
+            rows = self.cursor.execute(sql)
+        else:
+            rows = self.cursor.executemany(sql, args)
+        self.rows_changed += rows or 0
+
+    def prepare(self):
+        if self.xa:
+            self.cursor.execute("xa end %s", (self.txid,))
+            self.cursor.execute("xa prepare %s", (self.txid,))
+        self.status = "prepared"
+
+    def commit(self):
+        try:
+            if self.xa:
+                self.cursor.execute("xa commit %s", (self.txid,))
+            else:
+                self.cursor.execute("commit")
+        finally:
+            self.close()
+
+    def rollback(self):
+        try:
+            if self.xa and self.status == "active":
+                self.cursor.execute("xa end %s", (self.txid,))
+            if self.xa:
+                self.cursor.execute("xa rollback %s", (self.txid,))
+            else:
+                self.cursor.execute("rollback")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.status != "closed":
+            self.status = "closed"
+            self.connection.__exit__(None, None, None)
+
+
+def prepared_transactions(site: Site) -> List[str]:
+    """
+    txids of the XA transactions prepared at the site and not finished yet,
+    whichever connection prepared them. none on sqlite sites, which roll back
+    the transactions of closed connections
+    """
+    with DBConnection(site) as cursor:
+        if getattr(cursor, "dialect", "mysql") != "mysql":
+            return []
+
+        cursor.execute("xa recover")
+        return [
+            data.decode() if isinstance(data, bytes) else data
+            for data in (row["data"] for row in cursor.fetchall())
+        ]
+
+
+def finish_recovered(site: Site, txid: str, commit: bool):
+    """
+    commit or roll back an XA transaction prepared by a connection that no
+    longer exists, e.g. before the daemon restarted
+
+    transactions that aren't prepared at the site are ignored, they either
+    never prepared or were already finished
+    """
+    if txid not in prepared_transactions(site):
+        return
+
+    with DBConnection(site) as cursor:
+        action = "commit" if commit else "rollback"
+        cursor.execute(f"xa {action} %s", (txid,))
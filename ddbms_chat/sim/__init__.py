@@ -0,0 +1,5 @@
+"""
+simulated cluster: every site is a sqlite database in this process, requests
+between sites are dispatched to the daemon's flask app directly and charged to
+a network cost model (see cluster.py)
+"""
@@ -0,0 +1,292 @@
+"""
+N sites in one process
+
+every site stores its fragments in its own sqlite database (WAL mode). requests
+between sites go straight to the daemon's flask app instead of over http, and
+are charged to a `NetworkModel`. by default no time passes for the network:
+the cost goes to a virtual clock, so large what-if experiments (32 sites, slow
+links) run as fast as the sites can execute their sql
+
+    with SimCluster(8, NetworkModel(latency=0.002)) as cluster:
+        cluster.load(generate(DataSpec()))
+        rows = cluster.run("select * from `group` where `id` = 3")
+"""
+import json as jsonlib
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from secrets import token_hex
+from threading import Lock
+from time import sleep
+from typing import Dict, List, Optional, Tuple
+
+from ddbms_chat.config import COORDINATOR_TX_LOG_PATH, PARTICIPANT_TX_LOG_PATH
+from ddbms_chat.models.syscat import Allocation, Column, Fragment, Site, Table
+from ddbms_chat.phase1.app_tables import setup_tables
+from ddbms_chat.phase2.app_tables import fill_app_tables
+from ddbms_chat.phase2.fast_parser import parse_select_query
+from ddbms_chat.phase2.ingest import ingest_csv
+from ddbms_chat.phase2.query_tree import build_query_tree
+from ddbms_chat.phase2.routing import HASH_SLOTS, format_slots
+from ddbms_chat.phase2.syscat import SysCatRelations, catalog
+from ddbms_chat.phase3 import utils
+from ddbms_chat.phase3.execution_planner import execute_plan, plan_execution
+from ddbms_chat.phase4.txlog import coordinator_log, participant_log
+from ddbms_chat.sim import sqlite
+from ddbms_chat.syscat.columns import COLUMNS
+from ddbms_chat.syscat.tables import TABLES
+from ddbms_chat.utils import SQLITE_SITES, PyQL
+
+
+@dataclass
+class NetworkModel:
+    # seconds, one way
+    latency: float = 0.0005
+    # bytes per second, 1 Gbit/s
+    bandwidth: float = 125_000_000
+    # (from site id, to site id) -> (latency, bandwidth), for slow links
+    links: Dict[Tuple[int, int], Tuple[float, float]] = field(default_factory=dict)
+
+    def cost(self, src: int, dst: int, n_bytes: int) -> float:
+        """
+        seconds to send `n_bytes` from site `src` to site `dst`
+        """
+        if src == dst:
+            return 0.0
+
+        latency, bandwidth = self.links.get((src, dst), (self.latency, self.bandwidth))
+        return latency + n_bytes / bandwidth
+
+
+class VirtualClock:
+    """
+    simulated network time, optionally also spent for real
+    """
+
+    def __init__(self, realtime: bool = False):
+        self.realtime = realtime
+        self.now = 0.0
+        self._lock = Lock()
+
+    def advance(self, seconds: float):
+        with self._lock:
+            self.now += seconds
+        if self.realtime:
+            sleep(seconds)
+
+
+class SimResponse:
+    """
+    the parts of requests.Response the code base uses
+    """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.get_data()
+        self.ok = self.status_code < 400
+        self.reason = response.status
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+
+def _id(value) -> int:
+    return value if type(value) is int else value.id
+
+
+def build_catalog(sites: List[Site], replicas: int = 1) -> SysCatRelations:
+    """
+    the chat schema fragmented over `sites`: user vertically in three, group
+    hashed into one fragment per site with message derived from it, and
+    group_member broadcast to every site
+
+    every fragment is stored on `replicas` consecutive sites, starting at the
+    one above
+    """
+    n_sites = len(sites)
+    tables = PyQL([Table(t.id, t.name, t.fragment_type) for t in TABLES])
+    columns = PyQL(
+        [
+            Column(c.id, c.name, _id(c.table), c.type, c.pk, c.notnull, c.unique)
+            for c in COLUMNS
+        ]
+    )
+    table_ids = {table.name: table.id for table in tables}
+    broadcast = {table.name for table in tables if table.fragment_type == "B"}
+
+    fragments: List[Fragment] = []
+    allocation: List[Allocation] = []
+
+    def add(name: str, logic: str, table: str, site: int, parent=None) -> Fragment:
+        fragment_id = len(fragments) + 1
+        fragment = Fragment(
+            fragment_id, name, logic, parent or fragment_id, table_ids[table]
+        )
+        fragments.append(fragment)
+        if table in broadcast:
+            # stored on every site without allocation rows
+            return fragment
+        for replica in range(min(replicas, n_sites)):
+            replica_site = sites[(site + replica) % n_sites]
+            allocation.append(Allocation(fragment_id, replica_site.id))
+        return fragment
+
+    user_fragments = ["id,username,last_seen", "id,name,status", "id,phone,email"]
+    for i, logic in enumerate(user_fragments):
+        add(f"user_{i + 1}", logic, "user", i % n_sites)
+
+    n_slots = max(HASH_SLOTS, n_sites)
+    for i in range(n_sites):
+        slots = range(i * n_slots // n_sites, (i + 1) * n_slots // n_sites)
+        group_fragment = add(
+            f"group_{i + 1}", f"id#{n_slots}:{format_slots(slots)}", "group", i
+        )
+        add(f"message_{i + 1}", "mgroup|id", "message", i, group_fragment.id)
+
+    add("group_member", "", "group_member", n_sites - 1)
+
+    return (
+        PyQL(allocation),
+        columns,
+        PyQL(sorted(fragments, key=lambda f: f.id)),
+        PyQL(sites),
+        tables,
+    )
+
+
+class SimCluster:
+    def __init__(
+        self,
+        n_sites: int = 4,
+        network: Optional[NetworkModel] = None,
+        directory: Optional[Path] = None,
+        realtime: bool = False,
+        coordinator: int = 1,
+        replicas: int = 1,
+    ):
+        self.network = network or NetworkModel()
+        self.replicas = replicas
+        self.clock = VirtualClock(realtime)
+        self.coordinator = coordinator
+
+        self._own_directory = directory is None
+        self.directory = Path(directory or tempfile.mkdtemp(prefix="ddbms-sim-"))
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.sites = [
+            Site(id=i, name=f"sim{i}", ip=f"sim{i}", user="", password="")
+            for i in range(1, n_sites + 1)
+        ]
+        self.sites_by_ip = {site.ip: site for site in self.sites}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def start(self):
+        catalog.install(build_catalog(self.sites, self.replicas))
+
+        # the daemon looks itself up in the catalog on import
+        from ddbms_chat.phase3 import daemon
+
+        self._daemon = daemon
+        self.client = daemon.app.test_client()
+
+        for site in self.sites:
+            path = self.directory / f"site{site.id}.sqlite3"
+            sqlite.connect(path).close()
+            SQLITE_SITES[site.id] = path
+
+        self._previous_transport = utils.transport
+        utils.transport = self.send
+
+        coordinator_log.reopen(self.directory / "tx-coordinator.log")
+        participant_log.reopen(self.directory / "tx-participant.log")
+
+    def stop(self):
+        utils.transport = self._previous_transport
+        coordinator_log.reopen(COORDINATOR_TX_LOG_PATH)
+        participant_log.reopen(PARTICIPANT_TX_LOG_PATH)
+        for site in self.sites:
+            SQLITE_SITES.pop(site.id, None)
+        catalog.reset()
+
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @property
+    def coordinator_site(self) -> Site:
+        return self.sites[self.coordinator - 1]
+
+    def send(self, ip: str, method: str, endpoint: str, **kwargs) -> SimResponse:
+        """
+        transport for send_request_to_site
+        """
+        site = self.sites_by_ip[ip]
+        # requests sent while serving another site come from that site
+        sender = self._daemon.served_site_var.get() or self.coordinator_site
+
+        token = self._daemon.served_site_var.set(site)
+        try:
+            response = self.client.open(
+                endpoint,
+                method=method.upper(),
+                query_string=kwargs.get("params"),
+                headers=kwargs.get("headers"),
+                json=kwargs.get("json"),
+            )
+        finally:
+            self._daemon.served_site_var.reset(token)
+
+        payload = kwargs.get("json")
+        request_bytes = len(endpoint) + (len(jsonlib.dumps(payload)) if payload else 0)
+        self.clock.advance(
+            self.network.cost(sender.id, site.id, request_bytes)
+            + self.network.cost(site.id, sender.id, len(response.get_data()))
+        )
+
+        return SimResponse(response)
+
+    def load(self, table_rows: Dict[str, List]):
+        """
+        create the fragments and insert the rows through the fragmentation path
+        """
+        setup_tables(
+            catalog.fragments,
+            catalog.tables,
+            catalog.columns,
+            catalog.allocation,
+            catalog.sites,
+        )
+        fill_app_tables(table_rows)
+
+    def load_csv(self, directory: Path):
+        """
+        create the fragments and stream the csv files of `directory` into them
+        """
+        setup_tables(
+            catalog.fragments,
+            catalog.tables,
+            catalog.columns,
+            catalog.allocation,
+            catalog.sites,
+        )
+        ingest_csv(directory)
+
+    def run(self, sql: str) -> List[Dict]:
+        """
+        run a select query with the coordinator site as the client
+        """
+        query_id = f"q{token_hex(3)}s{self.coordinator}"
+        select_query = parse_select_query(sql)
+        plan = plan_execution(build_query_tree(select_query), query_id)
+        return execute_plan(plan, query_id, self.coordinator_site, select_query)
@@ -0,0 +1,147 @@
+"""
+sqlite storage for simulated sites
+
+`SQLiteCursor` accepts the mysql flavoured sql the rest of the code base
+generates and returns rows as dicts, like pymysql's DictCursor
+"""
+import re
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from ddbms_chat.config import DB_NAME
+
+# (pattern, replacement) turning mysql-isms into sqlite
+TRANSLATIONS = [
+    (re.compile(rf"`{DB_NAME}`\.|\b{DB_NAME}\."), ""),
+    (re.compile(r"\)\s*engine\s*=\s*\w+.*$", re.IGNORECASE | re.DOTALL), ")"),
+    (
+        re.compile(r"^\s*rename\s+table\s+(\S+)\s+to\s+(\S+)\s*$", re.IGNORECASE),
+        r"alter table \1 rename to \2",
+    ),
+]
+# statements without a sqlite equivalent, skipped
+IGNORED_RE = re.compile(r"^\s*(un)?lock\s+tables\b", re.IGNORECASE)
+
+INSERT_BATCH_SIZE = 1000
+
+# stored the way mysql prints them
+sqlite3.register_adapter(datetime, lambda value: value.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def translate(sql: str) -> Optional[str]:
+    """
+    sqlite version of a mysql statement, None if it should be skipped
+    """
+    if IGNORED_RE.match(sql):
+        return None
+
+    for pattern, replacement in TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+
+    return sql.replace("%s", "?")
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    # autocommit, like the pymysql connections. prepared 2pc transactions are
+    # finished by whichever thread serves the decision
+    conn = sqlite3.connect(
+        path, timeout=30, isolation_level=None, check_same_thread=False
+    )
+    conn.row_factory = _dict_factory
+    conn.execute("pragma journal_mode = wal")
+    conn.execute("pragma synchronous = normal")
+    return conn
+
+
+class SQLiteCursor:
+    dialect = "sqlite"
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    def execute(self, sql: str, args=()):
+        translated = translate(sql)
+        if translated is None:
+            return 0
+
+        self.cursor.execute(translated, tuple(args or ()))
+        return self.cursor.rowcount
+
+    def executemany(self, sql: str, args):
+        translated = translate(sql)
+        if translated is None:
+            return 0
+
+        self.cursor.executemany(translated, args)
+        return self.cursor.rowcount
+
+    def fetchone(self) -> Optional[Dict]:
+        return self.cursor.fetchone()
+
+    def fetchall(self) -> List[Dict]:
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+def _literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if type(value) in (int, float):
+        return repr(value)
+    if type(value) is datetime:
+        value = value.strftime("%Y-%m-%d %H:%M:%S")
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _column_definition(column: Dict) -> str:
+    # columns of expressions (count(`id`)) have no declared type, none keeps
+    # the affinity of their values like the mysql types would
+    name = column["name"].replace("`", "``")
+    return f"`{name}` {column['type']}".rstrip()
+
+
+def dump_relation(path: Path, relation_name: str) -> str:
+    """
+    the relation as sql, laid out like the output of mysqldump so that
+    /exec/fetch loads it the same way
+    """
+    conn = connect(path)
+    try:
+        columns = conn.execute(f"pragma table_info(`{relation_name}`)").fetchall()
+        if len(columns) == 0:
+            raise ValueError(f"Relation {relation_name} doesn't exist")
+
+        lines = [
+            f"DROP TABLE IF EXISTS `{relation_name}`;",
+            f"CREATE TABLE `{relation_name}` (",
+            ",\n".join(_column_definition(c) for c in columns),
+            ") ENGINE=InnoDB;",
+            f"LOCK TABLES `{relation_name}` WRITE;",
+        ]
+
+        rows = conn.execute(f"select * from `{relation_name}`").fetchall()
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            values = ",".join(
+                "(" + ",".join(_literal(v) for v in row.values()) + ")"
+                for row in rows[i : i + INSERT_BATCH_SIZE]
+            )
+            lines.append(f"INSERT INTO `{relation_name}` VALUES {values};")
+
+        lines.append("UNLOCK TABLES;")
+    finally:
+        conn.close()
+
+    return "\n".join(lines)
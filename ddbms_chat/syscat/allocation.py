@@ -17,6 +17,5 @@ ALLOCATION = PyQL(
         Allocation(FRAGMENTS[8], SITES[1]),
         Allocation(FRAGMENTS[9], SITES[2]),
         Allocation(FRAGMENTS[10], SITES[3]),
-        Allocation(FRAGMENTS[11], SITES[3]),
     ]
 )
@@ -17,10 +17,16 @@ FRAGMENTS = PyQL(
         Fragment(
             id=3, name="user_3", logic="id,phone,email", parent=3, table=TABLES[0]
         ),
-        Fragment(id=4, name="group_1", logic="id%4==0", parent=4, table=TABLES[1]),
-        Fragment(id=5, name="group_2", logic="id%4==1", parent=5, table=TABLES[1]),
-        Fragment(id=6, name="group_3", logic="id%4==2", parent=6, table=TABLES[1]),
-        Fragment(id=7, name="group_4", logic="id%4==3", parent=7, table=TABLES[1]),
+        Fragment(id=4, name="group_1", logic="id#256:0-63", parent=4, table=TABLES[1]),
+        Fragment(
+            id=5, name="group_2", logic="id#256:64-127", parent=5, table=TABLES[1]
+        ),
+        Fragment(
+            id=6, name="group_3", logic="id#256:128-191", parent=6, table=TABLES[1]
+        ),
+        Fragment(
+            id=7, name="group_4", logic="id#256:192-255", parent=7, table=TABLES[1]
+        ),
         Fragment(id=8, name="message_1", logic="mgroup|id", parent=4, table=TABLES[2]),
         Fragment(id=9, name="message_2", logic="mgroup|id", parent=5, table=TABLES[2]),
         Fragment(id=10, name="message_3", logic="mgroup|id", parent=6, table=TABLES[2]),
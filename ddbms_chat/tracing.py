@@ -0,0 +1,362 @@
+"""
+low overhead structured tracing
+
+every module gets a tracer named after its path inside the package, e.g.
+`phase2.parser`. DDBMS_CHAT_TRACE is a comma separated list of glob patterns
+selecting the components to trace (`phase2.*,phase3.daemon`), DDBMS_CHAT_DEBUG
+traces everything. a disabled tracer costs a flag and a context variable
+lookup per call.
+
+events go into an in-memory ring buffer which exporters drain
+
+spans nest: every span records the span it was opened in as its parent. the
+current query id and span are sent along with requests to other sites (see
+`trace_headers`), so that spans recorded by the daemons while serving a
+request become children of the coordinator span that sent it. requests
+carrying a trace context are traced irrespective of DDBMS_CHAT_TRACE
+"""
+import json
+import os
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from fnmatch import fnmatchcase
+from random import getrandbits
+from threading import Lock
+from time import perf_counter, time
+from typing import Deque, Dict, List, Mapping, Optional
+
+from ddbms_chat.config import HOSTNAME
+
+TRACE_PATTERNS = [
+    pattern.strip()
+    for pattern in os.getenv("DDBMS_CHAT_TRACE", "").split(",")
+    if pattern.strip()
+]
+if os.getenv("DDBMS_CHAT_DEBUG"):
+    TRACE_PATTERNS = ["*"]
+
+TRACE_BUFFER_SIZE = int(os.getenv("DDBMS_CHAT_TRACE_BUFFER", "10000"))
+
+QUERY_ID_HEADER = "X-DDBMS-Query-Id"
+PARENT_SPAN_HEADER = "X-DDBMS-Parent-Span"
+
+# id of the query being processed, attached to every event
+query_id_var: ContextVar[Optional[str]] = ContextVar("query_id", default=None)
+# innermost open span
+span_id_var: ContextVar[Optional[str]] = ContextVar("span_id", default=None)
+# trace every component, set for queries traced explicitly
+sampled_var: ContextVar[bool] = ContextVar("sampled", default=False)
+
+
+@dataclass
+class TraceEvent:
+    timestamp: float
+    component: str
+    name: str
+    query_id: Optional[str] = None
+    site: Optional[int] = None
+    step: Optional[int] = None
+    # seconds, only for spans
+    duration: Optional[float] = None
+    fields: Dict = field(default_factory=dict)
+    span_id: Optional[str] = None
+    parent_id: Optional[str] = None
+    # host which recorded the event
+    node: str = HOSTNAME
+
+
+_buffer: Deque[TraceEvent] = deque(maxlen=TRACE_BUFFER_SIZE)
+_drain_lock = Lock()
+
+
+def _new_span_id() -> str:
+    return f"{getrandbits(64):016x}"
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = (
+        "tracer",
+        "name",
+        "fields",
+        "timestamp",
+        "start",
+        "span_id",
+        "parent_id",
+        "token",
+    )
+
+    def __init__(self, tracer: "Tracer", name: str, fields: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.span_id = _new_span_id()
+        self.parent_id = span_id_var.get()
+        self.token = span_id_var.set(self.span_id)
+        self.timestamp = time()
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        duration = perf_counter() - self.start
+        span_id_var.reset(self.token)
+        if exc_type is not None:
+            self.fields["error"] = repr(exc_value)
+        self.tracer._emit(
+            self.name,
+            self.fields,
+            self.timestamp,
+            duration,
+            self.span_id,
+            self.parent_id,
+        )
+        return False
+
+
+class Tracer:
+    __slots__ = ("component", "configured")
+
+    def __init__(self, component: str, configured: bool):
+        self.component = component
+        # selected with DDBMS_CHAT_TRACE
+        self.configured = configured
+
+    @property
+    def enabled(self) -> bool:
+        return self.configured or sampled_var.get()
+
+    def event(self, name: str, **fields):
+        if not self.enabled:
+            return
+        self._emit(name, fields, time(), None, None, span_id_var.get())
+
+    def span(self, name: str, **fields):
+        """
+        context manager recording the duration of its body
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, fields)
+
+    def _emit(
+        self,
+        name: str,
+        fields: Dict,
+        timestamp: float,
+        duration: Optional[float],
+        span_id: Optional[str],
+        parent_id: Optional[str],
+    ):
+        query_id = fields.pop("query_id", None) or query_id_var.get()
+        _buffer.append(
+            TraceEvent(
+                timestamp,
+                self.component,
+                name,
+                query_id,
+                fields.pop("site", None),
+                fields.pop("step", None),
+                duration,
+                fields,
+                span_id,
+                parent_id,
+            )
+        )
+
+
+@contextmanager
+def trace_query(query_id: str, sampled: bool = False):
+    """
+    attach `query_id` to all events emitted inside the block
+
+    with `sampled`, every component traces the query, on all sites it touches
+    """
+    token = query_id_var.set(query_id)
+    sampled_token = sampled_var.set(True) if sampled else None
+    try:
+        yield
+    finally:
+        if sampled_token is not None:
+            sampled_var.reset(sampled_token)
+        query_id_var.reset(token)
+
+
+def trace_headers() -> Dict[str, str]:
+    """
+    headers carrying the trace context to another site, empty when not tracing
+    """
+    span_id = span_id_var.get()
+    if span_id is None:
+        return {}
+
+    return {QUERY_ID_HEADER: query_id_var.get() or "", PARENT_SPAN_HEADER: span_id}
+
+
+@contextmanager
+def continue_trace(headers: Mapping[str, str]):
+    """
+    continue the trace of the site that sent a request with `headers`
+    """
+    parent_id = headers.get(PARENT_SPAN_HEADER)
+    if not parent_id:
+        yield
+        return
+
+    tokens = (
+        query_id_var.set(headers.get(QUERY_ID_HEADER) or None),
+        span_id_var.set(parent_id),
+        sampled_var.set(True),
+    )
+    try:
+        yield
+    finally:
+        sampled_var.reset(tokens[2])
+        span_id_var.reset(tokens[1])
+        query_id_var.reset(tokens[0])
+
+
+_tracers: Dict[str, Tracer] = {}
+
+
+def component_enabled(component: str) -> bool:
+    return any(fnmatchcase(component, pattern) for pattern in TRACE_PATTERNS)
+
+
+def get_tracer(component: str) -> Tracer:
+    tracer = _tracers.get(component)
+    if tracer is None:
+        tracer = _tracers[component] = Tracer(component, component_enabled(component))
+    return tracer
+
+
+def module_component(module_globals: Dict) -> str:
+    """
+    component name of a module, works for modules run with `python -m` too
+    """
+    spec = module_globals.get("__spec__")
+    name = spec.name if spec is not None else module_globals.get("__name__", "")
+    return name[len("ddbms_chat.") :] if name.startswith("ddbms_chat.") else name
+
+
+def _pop_all() -> List[TraceEvent]:
+    events = []
+    while True:
+        try:
+            events.append(_buffer.popleft())
+        except IndexError:
+            return events
+
+
+def drain(query_id: Optional[str] = None) -> List[TraceEvent]:
+    """
+    remove and return all buffered events, or only those of `query_id`
+    """
+    with _drain_lock:
+        pending = _pop_all()
+        if query_id is None:
+            return pending
+
+        events, kept = [], []
+        for event in pending:
+            (events if event.query_id == query_id else kept).append(event)
+
+        # rebuild the buffer: the other events, then those appended meanwhile.
+        # a full buffer drops the oldest events, like `append` does
+        appended = _pop_all()
+        _buffer.extend(kept)
+        _buffer.extend(appended)
+
+    return events
+
+
+def export_jsonl(path, events: Optional[List[TraceEvent]] = None):
+    """
+    append events (by default, everything buffered) to a json lines file
+    """
+    if events is None:
+        events = drain()
+
+    with open(path, "a") as f:
+        for event in events:
+            f.write(json.dumps(asdict(event), default=str) + "\n")
+
+
+def export_chrome_trace(path, events: List[TraceEvent]):
+    """
+    write events in the chrome trace event format, which chrome://tracing and
+    https://ui.perfetto.dev load. every host is a process, every component a
+    thread. timestamps are the wall clocks of the hosts, so spans of different
+    hosts are only as well aligned as their clocks
+    """
+    trace_events = []
+    pids: Dict[str, int] = {}
+    tids: Dict[tuple, int] = {}
+
+    for event in sorted(events, key=lambda e: e.timestamp):
+        if event.node not in pids:
+            pids[event.node] = len(pids) + 1
+            trace_events.append(
+                {
+                    "name": "process_name",
+                    "ph": "M",
+                    "pid": pids[event.node],
+                    "args": {"name": event.node},
+                }
+            )
+        pid = pids[event.node]
+
+        if (event.node, event.component) not in tids:
+            tids[(event.node, event.component)] = len(tids) + 1
+            trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tids[(event.node, event.component)],
+                    "args": {"name": event.component},
+                }
+            )
+
+        trace_event = {
+            "name": event.name,
+            "cat": event.component,
+            "ts": event.timestamp * 1e6,
+            "pid": pid,
+            "tid": tids[(event.node, event.component)],
+            "args": {
+                "query_id": event.query_id,
+                "site": event.site,
+                "step": event.step,
+                "span_id": event.span_id,
+                "parent_id": event.parent_id,
+            }
+            | event.fields,
+        }
+        if event.duration is None:
+            trace_event |= {"ph": "i", "s": "t"}
+        else:
+            trace_event |= {"ph": "X", "dur": event.duration * 1e6}
+        trace_events.append(trace_event)
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace_events}, f, default=str)
@@ -2,31 +2,52 @@ from __future__ import annotations
 
 import inspect
 import logging
-import os
-import re
-from copy import deepcopy
+import sys
+from pathlib import Path
 from types import GeneratorType
-from typing import Dict, Generic, List, TypeVar
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
 
 import pymysql
 from pymysql.cursors import DictCursor
 
 from ddbms_chat.config import DB_NAME
+from ddbms_chat.metrics import Gauge
 from ddbms_chat.models.syscat import Site
+from ddbms_chat.sim import sqlite
+from ddbms_chat.tracing import get_tracer, module_component
 
 log = logging.getLogger("ddbms_chat")
 
+db_connections_in_use = Gauge(
+    "ddbms_chat_db_connections_in_use",
+    "open connections to a site's database",
+    ["site"],
+)
+
 T = TypeVar("T")
 
 
 class PyQL(Generic[T]):
+    """
+    sql-like queries over a list of objects
+
+    `where` lazily builds a hash index for every combination of attributes it is
+    queried with, so repeated lookups are O(1). results are views that share
+    the underlying objects with this list; treat them as read-only
+    """
+
     def __init__(self, item_list: List[T], filter: Dict = {}):
         self.items: List[T] = item_list
         self.filter = filter
+        # attribute names -> attribute values -> matching items
+        self._indexes: Dict[Tuple[str, ...], Optional[Dict[Tuple, PyQL[T]]]] = {}
 
     def __len__(self) -> int:
         return len(self.items)
 
+    def __iter__(self) -> Iterator[T]:
+        return iter(self.items)
+
     def __getitem__(self, idx) -> T:
         try:
             return self.items[idx]
@@ -47,22 +68,71 @@ class PyQL(Generic[T]):
 
         return PyQL(self.items + o.items, self.filter | o.filter)
 
-    def where(self, **kwargs):
-        current_list = deepcopy(self.items)
-        filtered_list = []
-        for k, v in kwargs.items():
-            for item in current_list:
-                if getattr(item, k) == v:
-                    filtered_list.append(item)
+    def __getstate__(self):
+        # indexes are cheap to rebuild, don't pickle them
+        return {"items": self.items, "filter": self.filter}
+
+    def __setstate__(self, state):
+        self.__init__(state["items"], state["filter"])
+
+    def _build_index(self, keys: Tuple[str, ...]) -> Optional[Dict[Tuple, PyQL[T]]]:
+        buckets: Dict[Tuple, List[T]] = {}
+        try:
+            for item in self.items:
+                value = tuple(getattr(item, k) for k in keys)
+                bucket = buckets.get(value)
+                if bucket is None:
+                    buckets[value] = [item]
+                else:
+                    bucket.append(item)
+        except TypeError:
+            # unhashable attribute values, fall back to scanning
+            return None
+
+        return {
+            value: PyQL(bucket, dict(zip(keys, value)))
+            for value, bucket in buckets.items()
+        }
+
+    def _scan(self, kwargs: Dict) -> PyQL[T]:
+        return PyQL(
+            [
+                item
+                for item in self.items
+                if all(getattr(item, k) == v for k, v in kwargs.items())
+            ],
+            kwargs,
+        )
+
+    def where(self, **kwargs) -> PyQL[T]:
+        keys = tuple(sorted(kwargs))
 
-            current_list = deepcopy(filtered_list)
-            filtered_list = []
+        if keys not in self._indexes:
+            self._indexes[keys] = self._build_index(keys)
+
+        index = self._indexes[keys]
+        if index is None:
+            return self._scan(kwargs)
+
+        try:
+            match = index.get(tuple(kwargs[k] for k in keys))
+        except TypeError:
+            return self._scan(kwargs)
 
-        return PyQL(current_list, kwargs)
+        if match is None:
+            return PyQL([], kwargs)
+
+        return match
+
+
+# site id -> database file of the sites of a simulated cluster (ddbms_chat.sim)
+SQLITE_SITES: Dict[int, Path] = {}
 
 
 class DBConnection:
-    def __init__(self, site: Site, connect_db: bool = True):
+    def __init__(self, site: Site, connect_db: bool = True, local_infile: bool = False):
+        self.site_id = site.id
+        self.sqlite_path = SQLITE_SITES.get(site.id)
         self.kwargs = {
             "host": site.ip,
             "user": site.user,
@@ -73,17 +143,86 @@ class DBConnection:
 
         if connect_db:
             self.kwargs["database"] = DB_NAME
+        if local_infile:
+            self.kwargs["local_infile"] = True
 
     def __enter__(self):
-        self.conn = pymysql.connect(**self.kwargs)
-        self.cursor = self.conn.cursor()
+        if self.sqlite_path is not None:
+            self.conn = sqlite.connect(self.sqlite_path)
+            self.cursor = sqlite.SQLiteCursor(self.conn)
+        else:
+            self.conn = pymysql.connect(**self.kwargs)
+            self.cursor = self.conn.cursor()
+        db_connections_in_use.inc(site=self.site_id)
 
         return self.cursor
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
+        db_connections_in_use.dec(site=self.site_id)
         self.conn.close()
 
 
+def list_relations(cursor) -> List[str]:
+    """
+    names of all relations in the database of a site
+    """
+    if getattr(cursor, "dialect", "mysql") == "sqlite":
+        cursor.execute("select name from sqlite_master where type = 'table'")
+    else:
+        cursor.execute(
+            "select table_name from information_schema.tables where table_schema = %s",
+            (DB_NAME,),
+        )
+    return [list(row.values())[0] for row in cursor.fetchall()]
+
+
+def list_columns(cursor, relation_name: str) -> List[str]:
+    if getattr(cursor, "dialect", "mysql") == "sqlite":
+        cursor.execute(f"select name from pragma_table_info('{relation_name}')")
+    else:
+        cursor.execute(
+            "select column_name from information_schema.columns "
+            "where table_schema = %s and table_name = %s",
+            (DB_NAME, relation_name),
+        )
+    return [list(row.values())[0] for row in cursor.fetchall()]
+
+
+def relation_sizes(cursor) -> Dict[str, Dict[str, int]]:
+    """
+    estimated rows and bytes of every relation
+    """
+    if getattr(cursor, "dialect", "mysql") == "sqlite":
+        sizes = {}
+        for relation in list_relations(cursor):
+            cursor.execute(f"select count(*) as n_rows from `{relation}`")
+            n_rows = cursor.fetchone()["n_rows"]
+            try:
+                cursor.execute(
+                    "select sum(pgsize) as n_bytes from dbstat where name = %s",
+                    (relation,),
+                )
+                n_bytes = cursor.fetchone()["n_bytes"]
+            except Exception:
+                # sqlite built without the dbstat table
+                n_bytes = 0
+            sizes[relation] = {"rows": n_rows, "bytes": int(n_bytes or 0)}
+        return sizes
+
+    cursor.execute(
+        "select table_name as name, table_rows as n_rows, data_length as n_bytes "
+        "from information_schema.tables where table_schema = %s",
+        (DB_NAME,),
+    )
+    return {
+        row["name"]: {
+            "rows": int(row["n_rows"] or 0),
+            "bytes": int(row["n_bytes"] or 0),
+        }
+        for row in cursor.fetchall()
+    }
+
+
 def inspect_object(o):
     members = inspect.getmembers(o)
     values = {}
@@ -108,10 +247,17 @@ def inspect_object(o):
 
 
 def debug_log(msg: str, *args):
-    caller_name = inspect.stack()[1].function
+    """
+    log a debug message prefixed with the caller's name
+
+    cheap when debug logging is off; the caller's module has to be enabled
+    through DDBMS_CHAT_TRACE (see ddbms_chat.tracing)
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return
 
-    if debug_caller_re := os.getenv("DDBMS_CHAT_DEBUG_ONLY"):
-        if re.match(debug_caller_re, caller_name) is None:
-            return
+    frame = sys._getframe(1)
+    if not get_tracer(module_component(frame.f_globals)).enabled:
+        return
 
-    log.debug(f"[{caller_name}] {msg}", stacklevel=2, *args)
+    log.debug(f"[{frame.f_code.co_name}] {msg}", *args, stacklevel=2)
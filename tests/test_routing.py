@@ -0,0 +1,66 @@
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from ddbms_chat.models.query import Condition
+from ddbms_chat.models.syscat import Allocation, Fragment, Site, Table
+from ddbms_chat.phase2.routing import (
+    candidate_fragments,
+    get_router,
+    hash_key,
+    hash_keys,
+)
+from ddbms_chat.phase2.syscat import catalog
+from ddbms_chat.utils import PyQL
+
+
+@pytest.fixture
+def router():
+    table = Table(id=1, name="item", fragment_type="H")
+    fragments = [
+        Fragment(
+            id=i + 1, name=f"item_{i + 1}", logic=f"id%2=={i}", parent=i + 1, table=1
+        )
+        for i in range(2)
+    ]
+    catalog.install(
+        (
+            PyQL([Allocation(fragment=f.id, site=f.id) for f in fragments]),
+            PyQL([]),
+            PyQL(fragments),
+            PyQL(
+                [Site(id=i, name=f"s{i}", ip="", user="", password="") for i in (1, 2)]
+            ),
+            PyQL([table]),
+        )
+    )
+    yield get_router("item")
+    catalog.reset()
+
+
+def test_candidate_fragments_of_literals(router):
+    assert candidate_fragments(router, Condition("item.id", "=", "5")) == {2}
+    # a quoted number can't be routed by the predicates, every fragment is read
+    assert candidate_fragments(router, Condition("item.id", "=", "'5'")) is None
+
+
+@pytest.mark.parametrize(
+    "keys",
+    [
+        np.array([0, 5, -1, 2**62]),
+        np.array([2**64 - 1, 7], dtype=np.uint64),
+        np.array([5.0, -3.0, 1.5, np.nan]),
+        np.array(["5", "5.0", "abc", "1.50"]),
+        np.array([5, "5", 5.0, Decimal("5"), b"5", True, None], dtype=object),
+    ],
+)
+def test_hash_keys_match_hash_key(keys):
+    slots = hash_keys(keys) % np.uint64(256)
+    assert slots.tolist() == [hash_key(k) % 256 for k in keys.tolist()]
+
+
+def test_numeric_keys_hash_like_the_integer():
+    assert {hash_key(k) for k in (5, "5", 5.0, "5.0", Decimal("5"), b"5")} == {
+        hash_key(5)
+    }
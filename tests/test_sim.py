@@ -0,0 +1,28 @@
+from collections import Counter
+
+import pytest
+
+from ddbms_chat.bench.datagen import DataSpec, generate
+from ddbms_chat.sim.cluster import SimCluster
+
+
+@pytest.fixture(scope="module")
+def cluster():
+    with SimCluster(4) as cluster:
+        data = generate(DataSpec(users=50, groups=10, messages=500))
+        cluster.load(data)
+        yield cluster, data
+
+
+def test_aggregate_over_fragmented_relation(cluster):
+    cluster, data = cluster
+
+    assert cluster.run("select count(id) from `message`") == [
+        {"count(`id`)": len(data["message"])}
+    ]
+
+    rows = cluster.run(
+        "select M.mgroup, count(M.id) from `message` M group by M.mgroup"
+    )
+    expected = Counter(message.mgroup for message in data["message"])
+    assert {row["mgroup"]: row["count(`id`)"] for row in rows} == expected